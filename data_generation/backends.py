@@ -0,0 +1,96 @@
+"""
+Declarative configuration of the image generation backends.
+
+Every backend has a `type` which selects the module implementing it (see `engine.BACKEND_TYPES`) and a `folder`
+which is the model folder name used in the `occ/model/split/lang` image tree. Diffusers backends additionally
+specify the pipeline class, the pretrained weights at a revision and the sampling parameters. A revision which is not
+a commit hash (e.g. the "main" branch) is resolved to the commit it points to when the model is loaded (see
+`diffusers_backend.resolve_revision`), so the text embedding cache, which is keyed by that commit, is invalidated when
+the weights are updated upstream. `text_embeddings` selects how prompts are encoded (see
+`diffusers_backend.TEXT_EMBEDDINGS`). The OpenAI backend sends up to `concurrency` requests at a time, paced to the
+requests and images per minute limits of the account. The Midjourney backend keeps up to `concurrency` prompts in
+flight, which should match the concurrent job limit of the Midjourney plan. With `gateway` it receives new messages
+from the Discord gateway and only polls the channel every `fallback_interval` seconds (or every `poll_interval`
+seconds while the gateway is disconnected).
+
+`seconds_per_image` and `cost_per_image` (marginal API price in USD) are the defaults of the job planner (see
+`planner.py`), which prefers the throughput measured in past runs once there is a run history.
+"""
+
+BACKENDS = {
+    'flux': {
+        'type': 'diffusers',
+        'description': 'FLUX.1-dev',
+        'pipeline': 'diffusers.pipelines.flux.FluxPipeline',
+        'model_id': 'black-forest-labs/FLUX.1-dev',
+        'revision': 'main',
+        'torch_dtype': 'bfloat16',
+        'pretrained_kwargs': {},
+        'num_inference_steps': 50,
+        'guidance_scale': 3.5,
+        'height': 1024,
+        'width': 1024,
+        'text_embeddings': 'flux',
+        'folder': 'flux-1-dev',
+        'seconds_per_image': 25.0,
+        'cost_per_image': 0.0,
+    },
+    'stable-diffusion-3': {
+        'type': 'diffusers',
+        'description': 'Stable Diffusion 3 Medium',
+        'pipeline': 'diffusers.StableDiffusion3Pipeline',
+        'model_id': 'stabilityai/stable-diffusion-3-medium-diffusers',
+        'revision': 'main',
+        'torch_dtype': 'float16',
+        'pretrained_kwargs': {},
+        'num_inference_steps': 50,
+        'guidance_scale': 7.0,
+        'height': 1024,
+        'width': 1024,
+        'text_embeddings': 'sd3',
+        'folder': 'stable-diffusion-3',
+        'seconds_per_image': 8.0,
+        'cost_per_image': 0.0,
+    },
+    'playground': {
+        'type': 'diffusers',
+        'description': 'Playground v2.5',
+        'pipeline': 'diffusers.DiffusionPipeline',
+        'model_id': 'playgroundai/playground-v2.5-1024px-aesthetic',
+        'revision': 'main',
+        'torch_dtype': 'float16',
+        'pretrained_kwargs': {'variant': 'fp16'},
+        'num_inference_steps': 50,
+        'guidance_scale': 3.0,
+        'height': 1024,
+        'width': 1024,
+        'text_embeddings': 'sdxl',
+        'folder': 'playground-v2-5',
+        'seconds_per_image': 6.0,
+        'cost_per_image': 0.0,
+    },
+    'dall-e-3': {
+        'type': 'openai',
+        'description': 'DALL-E 3',
+        'model_id': 'dall-e-3',
+        'concurrency': 4,
+        'requests_per_minute': 7,
+        'images_per_minute': 7,
+        'folder': 'dall-e-3',
+        'seconds_per_image': 9.0,
+        'cost_per_image': 0.04,
+    },
+    'midjourney': {
+        'type': 'midjourney',
+        'description': 'Midjourney v6.1',
+        'model_id': 'midjourney-v6-1',
+        'concurrency': 3,
+        'poll_interval': 5,
+        'timeout': 900,
+        'gateway': True,
+        'fallback_interval': 60,
+        'folder': 'midjourney-v6-1',
+        'seconds_per_image': 20.0,
+        'cost_per_image': 0.0,
+    },
+}
@@ -0,0 +1,101 @@
+"""
+Helpers shared by the benchmark scripts (`benchmark_generation.py` and `benchmark_postprocessing.py`).
+
+Every benchmark case runs in a fresh process, so its peak memory is not inflated by earlier cases. Results are
+written as JSON together with the environment and the commit they were measured at, so runs of different commits can
+be compared with `--baseline`.
+"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+from PIL import Image
+
+
+def peak_rss_mb(children=False):
+    """ Return the peak resident set size of the current process (or of its largest finished child) in MB. """
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1 << 20 if platform.system() == 'Darwin' else 1 << 10), 1)
+
+
+def run_isolated(function, case):
+    """ Run a benchmark case in a fresh process, so cases do not share memory peaks or warmed up state. """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(function, case).result()
+
+
+def synthetic_image(resolution, rng):
+    """ Return a smooth random RGB image, which compresses like a generated image rather than like pure noise. """
+    small = Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8))
+    image = np.asarray(small.resize((resolution, resolution), Image.BICUBIC), dtype=np.int16)
+    image += rng.integers(-4, 5, image.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8))
+
+
+def environment(**versions):
+    """
+    Return the platform and the commit a benchmark ran with.
+
+    Args:
+        versions: Versions of libraries the benchmark depends on by name.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=directory).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                                    text=True, cwd=directory).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        **versions,
+    }
+
+
+def save_results(path, report):
+    """ Write the results of a benchmark run to a JSON file. """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+
+def load_baseline(path, case_key):
+    """
+    Load the results of an earlier benchmark run.
+
+    Args:
+        path (str): Path of the JSON results, or None.
+        case_key (callable): Returns the settings identifying a result.
+
+    Returns:
+        dict: The results by case key (empty without a path).
+    """
+    if not path:
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return {case_key(result): result for result in json.load(f)['results']}
+
+
+def relative_change(result, baseline, key, field='files_per_second'):
+    """ Return the change of a result field against the same case of a baseline run as text, e.g. "+3.2%". """
+    previous = baseline.get(key, {}).get(field)
+    if not previous or result.get(field) is None:
+        return ''
+    return f"{100 * (result[field] / previous - 1):+.1f}%"
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from backends import BACKENDS
+from benchmark import (environment, load_baseline, peak_rss_mb, relative_change, run_isolated, save_results,
+                       synthetic_image)
+from diffusers_backend import TEXT_EMBEDDINGS, generate_images, get_embedding_cache, to_numpy
+from image_writer import IMAGE_FORMATS, ImageWriter
+from jobs import PromptJob
+from manifest import CompletionManifest
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# The backend each pipeline family is benchmarked as. The sampling parameters are taken from the backend, while the
+# weights are replaced with a tiny randomly initialized pipeline of the same architecture.
+FAMILY_BACKENDS = {
+    'flux': 'flux',
+    'sd3': 'stable-diffusion-3',
+    'sdxl': 'playground',
+}
+
+# Shapes of the random prompt embeddings of every family, which match the tiny pipeline configurations below. The
+# pipelines have no text encoders or tokenizers (which would have to be downloaded), so prompts always go through the
+# text embedding cache.
+TINY_EMBEDDINGS = {
+    'flux': {'prompt_embeds': (1, 16, 32), 'pooled_prompt_embeds': (1, 32)},
+    'sd3': {'prompt_embeds': (1, 16, 32), 'pooled_prompt_embeds': (1, 64),
+            'negative_prompt_embeds': (1, 16, 32), 'negative_pooled_prompt_embeds': (1, 64)},
+    'sdxl': {'prompt_embeds': (1, 16, 64), 'pooled_prompt_embeds': (1, 32),
+             'negative_prompt_embeds': (1, 16, 64), 'negative_pooled_prompt_embeds': (1, 32)},
+}
+
+
+def tiny_flux():
+    """ Build a FLUX pipeline with a single transformer block of each type and a one-level VAE. """
+    from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxPipeline, FluxTransformer2DModel
+
+    transformer = FluxTransformer2DModel(patch_size=1, in_channels=4, num_layers=1, num_single_layers=1,
+                                         attention_head_dim=16, num_attention_heads=2, joint_attention_dim=32,
+                                         pooled_projection_dim=32, axes_dims_rope=[4, 4, 8])
+    vae = AutoencoderKL(sample_size=32, in_channels=3, out_channels=3, block_out_channels=(4,), layers_per_block=1,
+                        latent_channels=1, norm_num_groups=1, use_quant_conv=False, use_post_quant_conv=False,
+                        shift_factor=0.0609, scaling_factor=1.5035)
+    return FluxPipeline(scheduler=FlowMatchEulerDiscreteScheduler(), vae=vae, transformer=transformer,
+                        text_encoder=None, tokenizer=None, text_encoder_2=None, tokenizer_2=None)
+
+
+def tiny_sd3():
+    """ Build a Stable Diffusion 3 pipeline with a single transformer block and a one-level VAE. """
+    from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, SD3Transformer2DModel, \
+        StableDiffusion3Pipeline
+
+    transformer = SD3Transformer2DModel(sample_size=32, patch_size=1, in_channels=4, num_layers=1,
+                                        attention_head_dim=8, num_attention_heads=4, caption_projection_dim=32,
+                                        joint_attention_dim=32, pooled_projection_dim=64, out_channels=4)
+    vae = AutoencoderKL(sample_size=32, in_channels=3, out_channels=3, block_out_channels=(4,), layers_per_block=1,
+                        latent_channels=4, norm_num_groups=1, use_quant_conv=False, use_post_quant_conv=False,
+                        shift_factor=0.0609, scaling_factor=1.5035)
+    return StableDiffusion3Pipeline(scheduler=FlowMatchEulerDiscreteScheduler(), vae=vae, transformer=transformer,
+                                    text_encoder=None, tokenizer=None, text_encoder_2=None, tokenizer_2=None,
+                                    text_encoder_3=None, tokenizer_3=None)
+
+
+def tiny_sdxl():
+    """ Build an SDXL pipeline (the architecture of Playground v2.5) with a two-level UNet and VAE. """
+    from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+
+    unet = UNet2DConditionModel(block_out_channels=(2, 4), layers_per_block=2, sample_size=32, in_channels=4,
+                                out_channels=4, down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+                                up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"), attention_head_dim=(2, 4),
+                                use_linear_projection=True, addition_embed_type="text_time",
+                                addition_time_embed_dim=8, transformer_layers_per_block=(1, 2),
+                                projection_class_embeddings_input_dim=80, cross_attention_dim=64, norm_num_groups=1)
+    scheduler = EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, steps_offset=1,
+                                       beta_schedule="scaled_linear", timestep_spacing="leading")
+    vae = AutoencoderKL(block_out_channels=[32, 64], in_channels=3, out_channels=3,
+                        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+                        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"], latent_channels=4, sample_size=128)
+    return StableDiffusionXLPipeline(vae=vae, unet=unet, scheduler=scheduler, text_encoder=None, tokenizer=None,
+                                     text_encoder_2=None, tokenizer_2=None, add_watermarker=False)
+
+
+# The tiny pipelines are not on the Hub, so they get a fixed commit hash, which is never resolved
+TINY_REVISION = '0' * 40
+
+TINY_PIPELINES = {
+    'flux': tiny_flux,
+    'sd3': tiny_sd3,
+    'sdxl': tiny_sdxl,
+}
+
+
+def tiny_backend(family, cache_dir, resolution, steps):
+    """ Return the backend configuration of a tiny pipeline, based on the backend the family is benchmarked as. """
+    return dict(BACKENDS[FAMILY_BACKENDS[family]], description=f"tiny random {family}",
+                model_id=f"benchmark/tiny-{family}", revision=TINY_REVISION, torch_dtype='float32',
+                pretrained_kwargs={}, num_inference_steps=steps, height=resolution, width=resolution,
+                folder=f"tiny-{family}", embedding_cache=cache_dir)
+
+
+def benchmark_jobs(num_prompts, num_images):
+    """ Return synthetic prompt jobs of distinct occupations. """
+    indices = tuple(range(num_images))
+    return [PromptJob('benchmark', 'en', f"occupation {i}", f"A photo of the face of a benchmark occupation {i}.",
+                      indices) for i in range(num_prompts)]
+
+
+def fill_embedding_cache(backend, jobs, seed):
+    """ Save random embeddings of all prompts (and of the empty negative prompt) to the text embedding cache. """
+    cache = get_embedding_cache(backend)
+    family = TEXT_EMBEDDINGS[backend['text_embeddings']]
+    shapes = TINY_EMBEDDINGS[backend['text_embeddings']]
+    generator = torch.Generator().manual_seed(seed)
+    for prompt in sorted({job.prompt for job in jobs}):
+        cache.save(prompt, {name: to_numpy(torch.randn(shapes[name], generator=generator), torch.float32)
+                            for name in family['names']})
+    if family['shared']:
+        cache.save("", {name: to_numpy(torch.randn(shapes[name], generator=generator), torch.float32)
+                        for name in family['shared']})
+
+
+def run_generation_case(case):
+    """
+    Generate images with a tiny pipeline through `diffusers_backend.generate_images` and measure the run.
+
+    Every case runs in a fresh process, so the peak memory is that of the case alone. A warm-up batch is generated
+    before the measured run.
+
+    Args:
+        case (dict): The family, batch_size, save_workers, image_format, num_prompts, num_images, resolution, steps,
+            seed, threads and work_dir of the case.
+
+    Returns:
+        dict: The case and its measurements.
+    """
+    if case['threads']:
+        torch.set_num_threads(case['threads'])
+    torch.manual_seed(case['seed'])
+
+    work_dir = tempfile.mkdtemp(dir=case['work_dir'])
+    try:
+        backend = tiny_backend(case['family'], os.path.join(work_dir, 'embeddings'), case['resolution'],
+                               case['steps'])
+        build_start = time.perf_counter()
+        pipe = TINY_PIPELINES[case['family']]().to('cpu')
+        pipe.set_progress_bar_config(disable=True)
+        build_seconds = time.perf_counter() - build_start
+
+        jobs = benchmark_jobs(case['num_prompts'], case['num_images'])
+        fill_embedding_cache(backend, jobs, case['seed'])
+
+        with ImageWriter(0, 1, case['image_format']) as writer:
+            generate_images(jobs[:case['batch_size']], pipe, backend, os.path.join(work_dir, 'warmup'),
+                            CompletionManifest(os.path.join(work_dir, 'warmup.jsonl')), writer, case['batch_size'])
+        rss_before = peak_rss_mb()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+        image_dir = os.path.join(work_dir, 'images')
+        manifest = CompletionManifest(os.path.join(work_dir, '.manifest.jsonl'))
+        metrics.start(labels={'family': case['family']})
+        start = time.perf_counter()
+        with ImageWriter(case['save_workers'], 2 * case['batch_size'] * case['num_images'],
+                         case['image_format']) as writer:
+            generate_images(jobs, pipe, backend, image_dir, manifest, writer, batch_size=case['batch_size'])
+        seconds = time.perf_counter() - start
+        snapshot = metrics.snapshot()
+
+        images = snapshot['counters'].get('images_saved', 0)
+        pipeline = snapshot['timings'].get('pipeline', {'sum': 0.0})
+        save = snapshot['timings'].get('save', {'sum': 0.0, 'count': 0})
+        return {
+            **{key: value for key, value in case.items() if key != 'work_dir'},
+            'images': images,
+            'seconds': round(seconds, 4),
+            'images_per_second': round(images / seconds, 3) if seconds else None,
+            'pipeline_seconds': round(pipeline['sum'], 4),
+            # Everything the loop spends outside the pipeline: embedding loads, batching, handing images to the
+            # writer, waiting for the save queue and recording the manifest
+            'overhead_seconds': round(seconds - pipeline['sum'], 4),
+            'overhead_ms_per_image': round(1000 * (seconds - pipeline['sum']) / images, 3) if images else None,
+            'save_ms_per_image': round(1000 * save['sum'] / save['count'], 3) if save['count'] else None,
+            'build_seconds': round(build_seconds, 3),
+            'rss_before_mb': rss_before,
+            'peak_rss_mb': peak_rss_mb(),
+            'cuda_peak_mb': round(torch.cuda.max_memory_allocated() / (1 << 20), 1)
+            if torch.cuda.is_available() else None,
+            'failed': case['num_prompts'] * case['num_images'] - images,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_save_case(case):
+    """
+    Measure the cost of encoding and saving full resolution images with the image writer.
+
+    Args:
+        case (dict): The image_format, save_workers, resolution, num_images, seed and work_dir of the case.
+
+    Returns:
+        dict: The case and its measurements.
+    """
+    rng = np.random.default_rng(case['seed'])
+    images = [synthetic_image(case['resolution'], rng) for _ in range(min(case['num_images'], 8))]
+    work_dir = tempfile.mkdtemp(dir=case['work_dir'])
+    try:
+        rss_before = peak_rss_mb()
+        metrics.start()
+        start = time.perf_counter()
+        with ImageWriter(case['save_workers'], 2 * max(case['save_workers'], 1), case['image_format']) as writer:
+            for i in range(case['num_images']):
+                writer.submit(images[i % len(images)], os.path.join(work_dir, f"{i}.{case['image_format']}"), key=i)
+            errors = [error for _, error in writer.flush() if error is not None]
+        seconds = time.perf_counter() - start
+        save = metrics.snapshot()['timings'].get('save', {'sum': 0.0, 'count': 0})
+        size = sum(entry.stat().st_size for entry in os.scandir(work_dir))
+        return {
+            **{key: value for key, value in case.items() if key != 'work_dir'},
+            'seconds': round(seconds, 4),
+            'images_per_second': round(case['num_images'] / seconds, 3),
+            'save_ms_per_image': round(1000 * save['sum'] / save['count'], 3) if save['count'] else None,
+            'mb_per_image': round(size / case['num_images'] / (1 << 20), 3),
+            'mb_per_second': round(size / seconds / (1 << 20), 2),
+            'rss_before_mb': rss_before,
+            'peak_rss_mb': peak_rss_mb(),
+            'failed': len(errors),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def add_batching_speedup(results):
+    """ Add the throughput of every generation case relative to batch size one with the same other settings. """
+    baseline = {(r['family'], r['save_workers'], r['image_format']): r['images_per_second']
+                for r in results if r['batch_size'] == 1}
+    for result in results:
+        reference = baseline.get((result['family'], result['save_workers'], result['image_format']))
+        result['batching_speedup'] = round(result['images_per_second'] / reference, 3) if reference else None
+
+
+def case_key(result):
+    """ Return the settings identifying a result, to match it with the same case of another run. """
+    if 'family' in result:
+        return 'generation', result['family'], result['batch_size'], result['save_workers'], result['image_format']
+    return 'save', result['image_format'], result['save_workers'], result['resolution']
+
+
+def print_results(results, baseline=None):
+    """ Print the results as a table, with the throughput change against the results of a baseline run. """
+    print(f"{'case':<36} {'img/s':>8} {'speedup':>8} {'overhead':>10} {'save':>9} {'peak RSS':>9} {'vs base':>8}")
+    for result in results:
+        key = case_key(result)
+        name = " ".join(str(part) for part in key[1:])
+        change = relative_change(result, baseline or {}, key, 'images_per_second')
+        speedup = f"{result['batching_speedup']:.2f}x" if result.get('batching_speedup') else ''
+        overhead = f"{result['overhead_ms_per_image']:.1f}ms" if result.get('overhead_ms_per_image') is not None \
+            else ''
+        save = f"{result['save_ms_per_image']:.1f}ms" if result.get('save_ms_per_image') is not None else ''
+        print(f"{key[0] + ' ' + name:<36} {result['images_per_second']:>8.2f} {speedup:>8} {overhead:>10} "
+              f"{save:>9} {result['peak_rss_mb']:>7.0f}MB {change:>8}")
+
+
+def main():
+    work_dir = args.work_directory or tempfile.mkdtemp(prefix='bafis-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    generation = []
+    for family in args.families:
+        for save_workers in args.save_workers:
+            for batch_size in args.batch_sizes:
+                case = {'family': family, 'batch_size': batch_size, 'save_workers': save_workers,
+                        'image_format': args.image_format, 'num_prompts': args.num_prompts,
+                        'num_images': args.num_images, 'resolution': args.resolution, 'steps': args.steps,
+                        'seed': args.seed, 'threads': args.threads, 'work_dir': work_dir}
+                logger.info(f"Running generation case {case}")
+                generation.append(run_isolated(run_generation_case, case))
+    add_batching_speedup(generation)
+
+    saves = []
+    for image_format in args.save_formats:
+        for save_workers in args.save_workers:
+            case = {'image_format': image_format, 'save_workers': save_workers, 'resolution': args.save_resolution,
+                    'num_images': args.save_images, 'seed': args.seed, 'work_dir': work_dir}
+            logger.info(f"Running save case {case}")
+            saves.append(run_isolated(run_save_case, case))
+
+    if not args.work_directory:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    import diffusers
+
+    results = generation + saves
+    save_results(args.output, {'environment': environment(torch=torch.__version__, diffusers=diffusers.__version__,
+                                                          torch_threads=torch.get_num_threads()),
+                               'config': vars(args), 'results': results})
+    print_results(results, load_baseline(args.baseline, case_key))
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Benchmark the generation loop on CPU with tiny random-weight '
+                                                 'pipelines, without downloading any model.')
+    parser.add_argument('--families', default=sorted(TINY_PIPELINES), type=str, nargs='+',
+                        choices=sorted(TINY_PIPELINES),
+                        help='Which pipeline families to benchmark')
+    parser.add_argument('--batch_sizes', default=[1, 2, 4], type=int, nargs='+',
+                        help='Which batch sizes to benchmark (include 1 to measure the batching speedup)')
+    parser.add_argument('--save_workers', default=[0, 2], type=int, nargs='+',
+                        help='Which numbers of image writer threads to benchmark (0 saves synchronously)')
+    parser.add_argument('--num_prompts', default=16, type=int,
+                        help='How many prompts to generate images for per case')
+    parser.add_argument('--num_images', default=2, type=int,
+                        help='How many images to generate per prompt')
+    parser.add_argument('--resolution', default=32, type=int,
+                        help='Height and width of the images of the tiny pipelines')
+    parser.add_argument('--steps', default=4, type=int,
+                        help='Number of inference steps of the tiny pipelines')
+    parser.add_argument('--image_format', default='png', type=str, choices=sorted(IMAGE_FORMATS),
+                        help='Which format the generation cases save images in')
+    parser.add_argument('--save_formats', default=sorted(IMAGE_FORMATS), type=str, nargs='+',
+                        choices=sorted(IMAGE_FORMATS),
+                        help='Which formats to measure the cost of saving full resolution images for')
+    parser.add_argument('--save_resolution', default=1024, type=int,
+                        help='Height and width of the images of the save cases')
+    parser.add_argument('--save_images', default=32, type=int,
+                        help='How many images to save per save case')
+    parser.add_argument('--threads', default=None, type=int,
+                        help='Number of torch threads (default: torch default)')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Random seed of the weights, embeddings and images')
+    parser.add_argument('--work_directory', default=None, type=str,
+                        help='Where to write the images of the cases (default: a temporary directory, which is '
+                             'removed afterwards)')
+    parser.add_argument('--output', default='../logs/benchmarks/generation.json', type=str,
+                        help='Path of the JSON results')
+    parser.add_argument('--baseline', default=None, type=str,
+                        help='JSON results of an earlier run to compare the throughput with')
+
+    args = parser.parse_args()
+    main()
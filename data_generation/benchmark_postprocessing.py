@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import csv
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from benchmark import (environment, load_baseline, peak_rss_mb, relative_change, run_isolated, save_results,
+                       synthetic_image)
+from compress_dataset import build_derivatives, compress_images_to_thumbnail, compress_images_to_webp
+from generate_dataset import LINK_MODES, add_prompt_to_metadata, enumerate_dataset
+from jobs import image_name
+
+logger = logging.getLogger(__name__)
+
+# Layout of the synthetic corpus below the occupation folders. Every (model, split, language) folder of an occupation
+# gets `images_per_prompt` images, so the number of occupations follows from the corpus size.
+CORPUS_MODELS = ['flux-1-dev', 'dall-e-3']
+CORPUS_SPLIT = 'benchmark_occupations_direct'
+CORPUS_LANGUAGES = ['de', 'en']
+CORPUS_PROMPTS = {
+    'de': "Ein Foto vom Gesicht eines {occupation}.",
+    'en': "A photo of the face of a {occupation}.",
+}
+
+# Post-processing stages in pipeline order. `parallel` stages are run at every worker count, the others once per
+# corpus size. `input` is what the throughput in MB/s is measured on.
+STAGES = {
+    'enumerate_dataset': {'parallel': True, 'input': 'images'},
+    'add_prompt_to_metadata': {'parallel': False, 'input': 'metadata'},
+    'compress_images_to_webp': {'parallel': False, 'input': 'images'},
+    'compress_images_to_thumbnail': {'parallel': False, 'input': 'images'},
+    'build_derivatives': {'parallel': True, 'input': 'images'},
+}
+
+
+def build_corpus(corpus_dir, num_images, resolution=1024, images_per_prompt=4, distinct_images=16, seed=0):
+    """
+    Create a synthetic `occ/model/split/lang` image tree and the prompt file of its split.
+
+    Only `distinct_images` images are encoded; the tree is filled with copies of them, which keeps building large
+    corpora fast. An existing corpus with the same parameters is reused.
+
+    Args:
+        corpus_dir (str): The directory to create the corpus in, with the image tree in "images" and the prompt file
+            in "prompts".
+        num_images (int): The number of images of the corpus.
+        resolution (int): Height and width of the images.
+        images_per_prompt (int): The number of images in every (occupation, model, split, language) folder.
+        distinct_images (int): The number of distinct images.
+        seed (int): Random seed of the images.
+
+    Returns:
+        tuple: The image directory, the prompt directory and the total size of the images in bytes.
+    """
+    image_dir = os.path.join(corpus_dir, 'images')
+    prompts_dir = os.path.join(corpus_dir, 'prompts')
+    marker = os.path.join(corpus_dir, 'corpus.txt')
+    parameters = f"{num_images} {resolution} {images_per_prompt} {distinct_images} {seed}"
+    if os.path.exists(marker):
+        with open(marker, 'r', encoding='utf-8') as f:
+            if f.read() == parameters:
+                return image_dir, prompts_dir, sum(entry.stat().st_size for entry in scan_files(image_dir))
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    os.makedirs(prompts_dir)
+
+    template_dir = os.path.join(corpus_dir, 'templates')
+    os.makedirs(template_dir)
+    rng = np.random.default_rng(seed)
+    templates = [os.path.join(template_dir, f"{i}.png") for i in range(distinct_images)]
+    for template in templates:
+        synthetic_image(resolution, rng).save(template, 'PNG')
+
+    per_occupation = len(CORPUS_MODELS) * len(CORPUS_LANGUAGES) * images_per_prompt
+    occupations = [f"Benchmarker{i}" for i in range(-(-num_images // per_occupation))]
+    created, size = 0, 0
+    for occupation in occupations:
+        for model in CORPUS_MODELS:
+            for lang in CORPUS_LANGUAGES:
+                directory = os.path.join(image_dir, occupation, model, CORPUS_SPLIT, lang)
+                os.makedirs(directory)
+                prompt = CORPUS_PROMPTS[lang].format(occupation=occupation)
+                for i in range(min(images_per_prompt, num_images - created)):
+                    path = os.path.join(directory, image_name(prompt, i))
+                    shutil.copyfile(templates[created % len(templates)], path)
+                    size += os.path.getsize(path)
+                    created += 1
+
+    with open(os.path.join(prompts_dir, f"{CORPUS_SPLIT}.csv"), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['occupation'] + CORPUS_LANGUAGES)
+        for occupation in occupations:
+            writer.writerow([occupation] + [CORPUS_PROMPTS[lang].format(occupation=occupation)
+                                            for lang in CORPUS_LANGUAGES])
+
+    shutil.rmtree(template_dir)
+    with open(marker, 'w', encoding='utf-8') as f:
+        f.write(parameters)
+    return image_dir, prompts_dir, size
+
+
+def scan_files(directory):
+    """ Yield the directory entries of all files below a directory. """
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_files(entry.path)
+        else:
+            yield entry
+
+
+def tree_size(directory):
+    """ Return the number and total size in bytes of the files below a directory. """
+    if not os.path.isdir(directory):
+        return 0, 0
+    sizes = [entry.stat(follow_symlinks=False).st_size for entry in scan_files(directory)]
+    return len(sizes), sum(sizes)
+
+
+def run_stage_case(case):
+    """
+    Run a post-processing stage on a corpus and measure it.
+
+    Every case runs in a fresh process. The output of the earlier stages which a stage depends on (the dataset
+    directory with its metadata file for `add_prompt_to_metadata`) is prepared before the measurement starts.
+
+    Args:
+        case (dict): The stage, workers, num_images, image_dir, prompts_dir, input_bytes, link_mode and work_dir of
+            the case.
+
+    Returns:
+        dict: The case and its measurements.
+    """
+    work_dir = tempfile.mkdtemp(dir=case['work_dir'])
+    stage, image_dir, workers = case['stage'], case['image_dir'], case['workers']
+    dataset_dir = os.path.join(work_dir, 'dataset')
+    metadata_file = os.path.join(dataset_dir, 'metadata.json')
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            if stage == 'add_prompt_to_metadata':
+                enumerate_dataset(image_dir, dataset_dir, link_mode=case['link_mode'])
+
+            input_bytes = os.path.getsize(metadata_file) if STAGES[stage]['input'] == 'metadata' \
+                else case['input_bytes']
+            rss_before = peak_rss_mb()
+            start = time.perf_counter()
+            if stage == 'enumerate_dataset':
+                enumerate_dataset(image_dir, dataset_dir, link_mode=case['link_mode'], max_workers=workers)
+                output_dir = dataset_dir
+            elif stage == 'add_prompt_to_metadata':
+                add_prompt_to_metadata(metadata_file, prompts_dir=case['prompts_dir'])
+                output_dir = None
+            elif stage == 'compress_images_to_webp':
+                output_dir = os.path.join(work_dir, 'webp')
+                compress_images_to_webp(image_dir, output_dir)
+            elif stage == 'compress_images_to_thumbnail':
+                output_dir = os.path.join(work_dir, 'thumbnails')
+                compress_images_to_thumbnail(image_dir, output_dir)
+            else:
+                output_dir = os.path.join(work_dir, 'derivatives')
+                build_derivatives(image_dir, webp_dir=os.path.join(output_dir, 'webp'),
+                                  thumbnail_dirs={128: os.path.join(output_dir, 'thumbnails')}, max_workers=workers)
+            seconds = time.perf_counter() - start
+        logger.debug(output.getvalue())
+
+        # Linked images are not written, so only count the bytes of files with their own data
+        if output_dir is None:
+            output_bytes = os.path.getsize(metadata_file)
+        elif stage == 'enumerate_dataset':
+            output_bytes = sum(entry.stat().st_size for entry in scan_files(output_dir)
+                               if entry.stat().st_nlink == 1 and not entry.is_symlink())
+        else:
+            output_bytes = tree_size(output_dir)[1]
+
+        return {
+            **{key: value for key, value in case.items() if key not in ('work_dir', 'image_dir', 'prompts_dir')},
+            'files': case['num_images'],
+            'seconds': round(seconds, 4),
+            'files_per_second': round(case['num_images'] / seconds, 2) if seconds else None,
+            'input_mb': round(input_bytes / (1 << 20), 2),
+            'mb_per_second': round(input_bytes / (1 << 20) / seconds, 2) if seconds else None,
+            'output_mb': round(output_bytes / (1 << 20), 2),
+            'rss_before_mb': rss_before,
+            'peak_rss_mb': peak_rss_mb(),
+            # Worker processes of build_derivatives
+            'children_peak_rss_mb': peak_rss_mb(children=True) or None,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def case_key(result):
+    """ Return the settings identifying a result, to match it with the same case of another run. """
+    return result['stage'], result['num_images'], result['workers']
+
+
+def print_results(results, baseline):
+    """ Print the results as a table with the bottleneck stage of every corpus size. """
+    print(f"{'stage':<30} {'images':>8} {'workers':>7} {'seconds':>9} {'files/s':>9} {'MB/s':>8} {'peak RSS':>9} "
+          f"{'vs base':>8}")
+    for result in results:
+        workers = result['workers'] if result['workers'] is not None else '-'
+        peak = max(result['peak_rss_mb'], result['children_peak_rss_mb'] or 0)
+        print(f"{result['stage']:<30} {result['num_images']:>8} {workers:>7} {result['seconds']:>9.3f} "
+              f"{result['files_per_second']:>9.1f} {result['mb_per_second']:>8.1f} {peak:>7.0f}MB "
+              f"{relative_change(result, baseline, case_key(result)):>8}")
+
+    for num_images in sorted({result['num_images'] for result in results}):
+        # The slowest stage at its best worker count
+        best = {}
+        for result in results:
+            if result['num_images'] == num_images:
+                best[result['stage']] = min(best.get(result['stage'], float('inf')), result['seconds'])
+        stage = max(best, key=best.get)
+        print(f"Bottleneck at {num_images} images: {stage} ({best[stage]:.2f}s of {sum(best.values()):.2f}s)")
+
+
+def main():
+    work_dir = args.work_directory or tempfile.mkdtemp(prefix='bafis-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    for num_images in args.sizes:
+        corpus_start = time.perf_counter()
+        image_dir, prompts_dir, input_bytes = build_corpus(os.path.join(work_dir, f"corpus-{num_images}"),
+                                                           num_images, args.resolution, args.images_per_prompt,
+                                                           args.distinct_images, args.seed)
+        logger.info(f"Corpus of {num_images} images ({input_bytes / (1 << 20):.0f} MB) ready in "
+                    f"{time.perf_counter() - corpus_start:.1f}s")
+
+        for stage in args.stages:
+            for workers in args.workers if STAGES[stage]['parallel'] else [None]:
+                case = {'stage': stage, 'workers': workers, 'num_images': num_images, 'resolution': args.resolution,
+                        'image_dir': image_dir, 'prompts_dir': prompts_dir, 'input_bytes': input_bytes,
+                        'link_mode': args.link_mode, 'work_dir': work_dir}
+                logger.info(f"Running {stage} on {num_images} images with {workers or 1} workers")
+                results.append(run_isolated(run_stage_case, case))
+
+        if not args.keep_corpus:
+            shutil.rmtree(os.path.join(work_dir, f"corpus-{num_images}"), ignore_errors=True)
+
+    if not args.work_directory:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    import pandas as pd
+    import PIL
+
+    save_results(args.output, {'environment': environment(pillow=PIL.__version__, pandas=pd.__version__),
+                               'config': vars(args), 'results': results})
+    print_results(results, load_baseline(args.baseline, case_key))
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Benchmark the dataset post-processing stages on a synthetic PNG '
+                                                 'corpus.')
+    parser.add_argument('--sizes', default=[100, 1000], type=int, nargs='+',
+                        help='Corpus sizes in images to benchmark')
+    parser.add_argument('--workers', default=[1, 4, 8], type=int, nargs='+',
+                        help='Worker counts for the parallel stages (enumerate_dataset and build_derivatives)')
+    parser.add_argument('--stages', default=list(STAGES), type=str, nargs='+', choices=list(STAGES),
+                        help='Which stages to benchmark')
+    parser.add_argument('--resolution', default=1024, type=int,
+                        help='Height and width of the corpus images')
+    parser.add_argument('--images_per_prompt', default=4, type=int,
+                        help='How many images every occ/model/split/lang folder contains')
+    parser.add_argument('--distinct_images', default=16, type=int,
+                        help='How many distinct images the corpus is filled with')
+    parser.add_argument('--link_mode', default='auto', type=str, choices=LINK_MODES,
+                        help='How enumerate_dataset places images (see generate_dataset.py)')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Random seed of the corpus images')
+    parser.add_argument('--work_directory', default=None, type=str,
+                        help='Where to build the corpora and the stage outputs (default: a temporary directory, which '
+                             'is removed afterwards). Use a directory on the file system of the real dataset.')
+    parser.add_argument('--keep_corpus', action='store_true',
+                        help='Keep the corpora in the work directory to reuse them in the next run')
+    parser.add_argument('--output', default='../logs/benchmarks/postprocessing.json', type=str,
+                        help='Path of the JSON results')
+    parser.add_argument('--baseline', default=None, type=str,
+                        help='JSON results of an earlier run to compare the throughput with')
+
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+CHECKSUM_FILE = '.checksums.json'
+
+IMAGE_EXTENSIONS = ('.png', '.webp')
+
+# Temporary files of interrupted downloads and saves
+TEMP_EXTENSIONS = ('.part', '.tmp')
+
+# Run state which changes with every run, e.g. the completion manifest, metrics, plans and caches in JSON lines and the
+# Prometheus textfile. Like hidden files (e.g. `.manifest.jsonl`), it is not part of the recorded data.
+RUN_STATE_EXTENSIONS = ('.jsonl', '.prom')
+
+
+def content_hash(path):
+    """ Return the SHA-256 hash of the content of a file. """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_recorded(path):
+    """ Check whether a file belongs to the recorded data, i.e. it is not hidden, temporary or run state. """
+    parts = path.split(os.sep)
+    return not any(part.startswith('.') for part in parts) and not path.endswith(TEMP_EXTENSIONS + RUN_STATE_EXTENSIONS)
+
+
+def list_files(directory):
+    """
+    Return the paths of all recorded files of a directory tree relative to the directory (see `is_recorded`). Hidden
+    directories are not descended into.
+    """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            path = os.path.relpath(os.path.join(root, file), directory)
+            if is_recorded(path):
+                paths.append(path)
+    return sorted(paths)
+
+
+def file_state(path):
+    """ Return the size and modification time in nanoseconds of a file. """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def check_image(path):
+    """ Decode an image completely and return the error message, or None if it is intact. """
+    try:
+        with Image.open(path) as img:
+            img.load()
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def load_checksums(directory, checksum_file=None):
+    """ Load the checksum manifest of a directory as a dict of relative path -> [size, mtime_ns, sha256, error]. """
+    checksum_file = checksum_file or os.path.join(directory, CHECKSUM_FILE)
+    if not os.path.exists(checksum_file):
+        return {}
+    with open(checksum_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checksums(directory, checksums, checksum_file=None):
+    """ Save the checksum manifest of a directory atomically. """
+    checksum_file = checksum_file or os.path.join(directory, CHECKSUM_FILE)
+    temp_file = checksum_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(checksums, f, indent=0, sort_keys=True)
+    os.replace(temp_file, checksum_file)
+
+
+def build_checksums(directory, checksum_file=None, max_workers=8):
+    """
+    Record the size, modification time and SHA-256 hash of every file of a directory tree, e.g. the `images` tree or
+    the enumerated dataset. Images are also decoded once, and the decoding error of a truncated image is recorded.
+    Files whose size and modification time match an existing manifest are not hashed again.
+
+    Args:
+        directory (str): The directory to record.
+        checksum_file (str): The path of the manifest. Defaults to `.checksums.json` in the directory.
+        max_workers (int): The number of threads hashing files in parallel.
+
+    Returns:
+        dict: The manifest, relative path -> [size, mtime_ns, sha256, error]. The error is None for intact images and
+            other files.
+    """
+    start_time = time.perf_counter()
+    previous = load_checksums(directory, checksum_file)
+    checksums = {}
+    pending = []
+
+    for path in list_files(directory):
+        size, mtime_ns = file_state(os.path.join(directory, path))
+        entry = previous.get(path)
+        if entry is not None and entry[:2] == [size, mtime_ns]:
+            checksums[path] = entry
+        else:
+            pending.append((path, size, mtime_ns))
+
+    def record(item):
+        path, size, mtime_ns = item
+        file_path = os.path.join(directory, path)
+        error = check_image(file_path) if path.lower().endswith(IMAGE_EXTENSIONS) else None
+        return path, [size, mtime_ns, content_hash(file_path), error]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for path, entry in executor.map(record, pending):
+            checksums[path] = entry
+
+    save_checksums(directory, checksums, checksum_file)
+    undecodable = sum(1 for entry in checksums.values() if entry[3] is not None)
+    print(f"Recorded {len(checksums)} files, hashed {len(pending)} new or changed files "
+          f"in {time.perf_counter() - start_time:.1f}s, {undecodable} undecodable images")
+    return checksums
+
+
+def verify_checksums(directory, checksum_file=None, max_workers=8, full=False):
+    """
+    Verify a directory tree against its checksum manifest.
+
+    Only files whose size or modification time differ from the manifest are hashed again, unless `full` is set. Images
+    which are hashed are also decoded again, while unchanged images are reported undecodable from the manifest.
+
+    Args:
+        directory (str): The directory to verify.
+        checksum_file (str): The path of the manifest. Defaults to `.checksums.json` in the directory.
+        max_workers (int): The number of threads hashing files in parallel.
+        full (bool): Hash and decode all files.
+
+    Returns:
+        dict: The relative paths of the missing, corrupt (content changed), undecodable and unrecorded files.
+    """
+    start_time = time.perf_counter()
+    checksums = load_checksums(directory, checksum_file)
+    if not checksums:
+        raise FileNotFoundError(f"No checksum manifest for {directory}, build it first")
+
+    report = {'missing': [], 'corrupt': [], 'undecodable': [], 'unrecorded': []}
+    pending = []
+    for path, (size, mtime_ns, sha256, error) in sorted(checksums.items()):
+        # Manifests built before run state was excluded may still contain it
+        if not is_recorded(path):
+            continue
+        file_path = os.path.join(directory, path)
+        try:
+            state = file_state(file_path)
+        except FileNotFoundError:
+            report['missing'].append(path)
+            continue
+        if full or state != (size, mtime_ns):
+            pending.append((path, sha256))
+        elif error is not None:
+            report['undecodable'].append(path)
+
+    def check(item):
+        path, sha256 = item
+        file_path = os.path.join(directory, path)
+        if content_hash(file_path) != sha256:
+            return path, 'corrupt'
+        if path.lower().endswith(IMAGE_EXTENSIONS) and check_image(file_path) is not None:
+            return path, 'undecodable'
+        return path, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for path, problem in executor.map(check, pending):
+            if problem is not None:
+                report[problem].append(path)
+
+    report['unrecorded'] = [path for path in list_files(directory) if path not in checksums]
+
+    print(f"Verified {len(checksums)} files, re-hashed {len(pending)} in {time.perf_counter() - start_time:.1f}s: "
+          + ", ".join(f"{len(paths)} {problem}" for problem, paths in report.items()))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record and verify the checksums of an image directory')
+    parser.add_argument('command', choices=['build', 'verify'],
+                        help='build (or update) the checksum manifest, or verify the directory against it')
+    parser.add_argument('--directory', default='../images', type=str,
+                        help='Path to the directory to record or verify, e.g. ../images or ../images_dataset')
+    parser.add_argument('--checksum_file', default=None, type=str,
+                        help=f'Path of the checksum manifest (default: {CHECKSUM_FILE} in the directory)')
+    parser.add_argument('--workers', default=8, type=int,
+                        help='Number of threads hashing files in parallel')
+    parser.add_argument('--full', action='store_true',
+                        help='Verify: hash and decode all files, not only changed ones')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_checksums(args.directory, args.checksum_file, max_workers=args.workers)
+    else:
+        problems = verify_checksums(args.directory, args.checksum_file, max_workers=args.workers, full=args.full)
+        for kind in ('missing', 'corrupt', 'undecodable'):
+            for problem_path in problems[kind]:
+                print(f"{kind}: {problem_path}")
+        sys.exit(1 if any(problems[kind] for kind in ('missing', 'corrupt', 'undecodable')) else 0)
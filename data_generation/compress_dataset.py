@@ -1,5 +1,6 @@
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
 
@@ -50,14 +51,131 @@ def compress_images_to_thumbnail(source_dir, target_dir):
                     img.save(target_file_path, 'PNG')
 
 
+def is_up_to_date(source_file_path, target_file_path):
+    """ Check whether a target file exists and is newer than its source file. """
+    try:
+        return os.path.getmtime(target_file_path) >= os.path.getmtime(source_file_path)
+    except OSError:
+        return False
+
+
+def save_atomic(img, target_file_path, image_format):
+    """ Save an image to a temporary file and rename it, so an interrupted save never looks up to date. """
+    os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
+    temp_file_path = target_file_path + '.tmp'
+    try:
+        img.save(temp_file_path, image_format)
+        os.replace(temp_file_path, target_file_path)
+    except Exception:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+
+
+def build_image_derivatives(source_file_path, targets):
+    """
+    Decode a source image once and write all of its derivatives.
+
+    Args:
+        source_file_path(str): The path of the source image.
+        targets(list): A list of (target_file_path, size) tuples. A size of None writes the full image as WebP,
+            other sizes write PNG thumbnails fitting into size x size pixels.
+
+    Returns:
+        tuple: The source file path and the error message, or None if all derivatives were written.
+    """
+    try:
+        with Image.open(source_file_path) as img:
+            img.load()
+
+            # Build thumbnails from the largest to the smallest, each from the previous one
+            thumbnail = img
+            for target_file_path, size in sorted(targets, key=lambda target: -(target[1] or float('inf'))):
+                if size is None:
+                    save_atomic(img, target_file_path, 'WEBP')
+                else:
+                    thumbnail = thumbnail.copy()
+                    thumbnail.thumbnail((size, size))
+                    save_atomic(thumbnail, target_file_path, 'PNG')
+        return source_file_path, None
+    except Exception as e:
+        return source_file_path, str(e)
+
+
+def build_derivatives(source_dir, webp_dir=None, thumbnail_dirs=None, max_workers=None):
+    """
+    Build the WebP versions and thumbnails of all images in the source directory in one pass on a process pool and
+    recreate the directory structure in the target directories. Every source image is decoded once for all of its
+    derivatives, and derivatives which are newer than their source image are skipped.
+
+    Args:
+        source_dir(str): The directory containing the images to convert.
+        webp_dir(str): The directory where the WebP images will be saved. If None, no WebP images are built.
+        thumbnail_dirs(dict): The directories where the thumbnails will be saved by thumbnail size in pixels.
+        max_workers(int): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        dict: The number of built, skipped and failed source images.
+    """
+    thumbnail_dirs = thumbnail_dirs or {}
+    tasks = []
+    skipped = 0
+
+    for root, _, files in os.walk(source_dir):
+        relative_path = os.path.relpath(root, source_dir)
+
+        for file in files:
+            if not file.lower().endswith('.png'):
+                continue
+            source_file_path = os.path.join(root, file)
+            name = os.path.splitext(file)[0]
+
+            targets = []
+            if webp_dir is not None:
+                targets.append((os.path.join(webp_dir, relative_path, name + '.webp'), None))
+            for size, thumbnail_dir in thumbnail_dirs.items():
+                targets.append((os.path.join(thumbnail_dir, relative_path, name + '.png'), size))
+
+            stale = [target for target in targets if not is_up_to_date(source_file_path, target[0])]
+            if stale:
+                tasks.append((source_file_path, stale))
+            else:
+                skipped += 1
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(build_image_derivatives, *zip(*tasks), chunksize=16) if tasks else []
+        for source_file_path, error in results:
+            if error is not None:
+                print(f"Error converting {source_file_path}: {error}")
+                failed += 1
+
+    return {'built': len(tasks) - failed, 'skipped': skipped, 'failed': failed}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Compress image dataset')
     parser.add_argument('--source_directory', default='../images', type=str,
                         help='Path to the directory containing the images to compress')
     parser.add_argument('--target_directory', default='../images_thumbnail', type=str,
-                        help='Path to the directory where the compressed images will be saved')
+                        help='Path to the directory where the thumbnails will be saved. With several thumbnail '
+                             'sizes, the size is appended to the directory name (e.g. ../images_thumbnail_256)')
+    parser.add_argument('--thumbnail_sizes', default=[128], type=int, nargs='*',
+                        help='Thumbnail sizes in pixels to build')
+    parser.add_argument('--webp_directory', default=None, type=str,
+                        help='Path to the directory where WebP versions of the images will be saved')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of worker processes (default: number of CPUs)')
 
     args = parser.parse_args()
 
-    compress_images_to_thumbnail(args.source_directory, args.target_directory)
+    if len(args.thumbnail_sizes) == 1:
+        thumbnail_directories = {args.thumbnail_sizes[0]: args.target_directory}
+    else:
+        thumbnail_directories = {size: f"{args.target_directory}_{size}" for size in args.thumbnail_sizes}
+
+    counts = build_derivatives(args.source_directory, webp_dir=args.webp_directory,
+                               thumbnail_dirs=thumbnail_directories, max_workers=args.workers)
+    print(f"Built {counts['built']} images, skipped {counts['skipped']} up to date images, "
+          f"{counts['failed']} failed.")
     print("Compression complete.")
@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
+import asyncio
 import logging
 import os
-import argparse
-import time
 
 import backoff
 import openai
 from openai import RateLimitError
 
-from utils import load_dataset, save_image_from_url
+from engine import build_parser, run
+from jobs import image_directory, image_name
+from metrics import metrics
+from rate_limit import TokenBucket
+from utils import save_image_from_url
 from dotenv import load_dotenv
 
 logging.basicConfig(
@@ -22,14 +25,26 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-# Set up OpenAI client
+# Set up OpenAI clients. Both use OPENAI_BASE_URL if set, e.g. to test against a local stub server.
 client = openai.OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
     organization=os.getenv("OPENAI_ORG_ID"),
 )
+# Rate limit errors are retried by `generate_image_async` after draining the rate limiters
+async_client = openai.AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    organization=os.getenv("OPENAI_ORG_ID"),
+    max_retries=0,
+)
+
+
+def count_retry(details):
+    """ Backoff handler which counts rate limited requests. """
+    metrics.increment('api_retries')
 
 
-@backoff.on_exception(backoff.expo, RateLimitError)
+@backoff.on_exception(backoff.expo, RateLimitError, on_backoff=count_retry)
+@metrics.timed('api_request')
 def generate_image(prompt, model_name):
     """
     Generate an image using OpenAIs API with the specified model and prompt.
@@ -54,92 +69,138 @@ def generate_image(prompt, model_name):
     )
 
 
-def generate_images(dataset_map, model_name, image_dir, language, num_images):
+def drain_limiters(details):
+    """ Backoff handler which pauses all requests sharing the rate limiters of a rate limited request. """
+    count_retry(details)
+    for limiter in details['kwargs'].get('limiters', ()):
+        limiter.drain()
+
+
+@backoff.on_exception(backoff.expo, RateLimitError, max_tries=8, on_backoff=drain_limiters)
+async def generate_image_async(prompt, model_name, limiters=()):
     """
-    Generate images for each prompt in the dataset using the specified model, language, and number of images and save
-    them to the image directory.
+    Generate an image using OpenAIs API asynchronously. Every request waits for a token of each rate limiter before it
+    is sent. This function uses exponential backoff to handle rate limit errors.
 
     Args:
-    dataset_map (dict): A dictionary with keys as filenames and values as pandas DataFrames.
+    prompt (str): The prompt to generate an image for.
 
     model_name (str): The name of the model to use for image generation.
 
+    limiters (list): The TokenBucket rate limiters shared by all requests.
+
+    Returns:
+    response: The response from the OpenAI API.
+    """
+    with metrics.timer('rate_limit_wait'):
+        for limiter in limiters:
+            await limiter.acquire()
+
+    with metrics.timer('api_request'):
+        return await async_client.images.generate(
+            prompt=prompt,
+            model=model_name,
+            n=1,
+            quality="standard",
+            response_format="url",
+            size="1024x1024",
+            style="natural",
+        )
+
+
+def load_model(backend):
+    """ Return the OpenAI model name of the backend. The API client is shared by the whole module. """
+    return backend['model_id']
+
+
+def generate_images(jobs, model_name, backend, image_dir, manifest, writer, batch_size=1):
+    """
+    Generate the pending images of each prompt job using the specified model and save them to the image directory.
+
+    Args:
+    jobs (list): A list of PromptJob tuples to generate images for.
+
+    model_name (str): The name of the model to use for image generation.
+
+    backend (dict): The backend configuration (see `backends.BACKENDS`).
+
     image_dir (str): The directory to save the images to.
 
-    language (str): The language to prompt in. Can be "english" or "german", except for the splits "direct_feminine"
-    and "german_gender_star", which are only available in German.
+    manifest (CompletionManifest): The manifest to record every saved image in.
+
+    writer (ImageWriter): Unused, the downloaded images are saved as they are.
 
-    num_images (int): The number of images to generate per prompt.
+    batch_size (int): Unused, the API generates one image per request.
     """
-    # Map language to column name in the dataset
-    lang = "de" if language == "german" else "en"
+    if backend['concurrency'] > 1:
+        asyncio.run(generate_images_async(jobs, model_name, backend, image_dir, manifest))
+        return
 
-    for file, data in dataset_map.items():
-        split = file.split(".")[0]
+    for job in jobs:
+        prompt = job.prompt
+        for i in job.indices:
+            try:
+                response = generate_image(prompt, model_name)
+                logger.info(f"Response for prompt {prompt}: {response.data[0]}")
 
-        occupations = data['occupation']
+                image_url = response.data[0].url
 
-        if lang not in data:
-            logger.error(f"Language {lang} not found in {file}")
-            continue
-        prompts = data[lang]
+                # Create a directory for the generated image
+                path = image_directory(image_dir, job, backend['folder'])
+                if not os.path.exists(path):
+                    os.makedirs(path)
 
-        for occ, prompt in zip(occupations, prompts):
-            for i in range(num_images):
-                try:
-                    response = generate_image(prompt, model_name)
-                    logger.info(f"Response for prompt {prompt}: {response.data[0]}")
+                if save_image_from_url(image_url, os.path.join(path, image_name(prompt, i))):
+                    manifest.add(manifest.key(backend['folder'], job, i))
 
-                    image_url = response.data[0].url
+            except openai.OpenAIError as e:
+                metrics.increment('api_errors')
+                logger.error(f"An error occurred with prompt {prompt}: {str(e)}")
 
-                    # Create a name for the generated image based on the prompt
-                    image_name = prompt.replace(" ", "_").replace(",", "").replace(".", "") + ".png"
 
-                    # Create a directory for the generated image
-                    path = os.path.join(os.curdir, image_dir, occ, model_name, split, lang)
-                    if not os.path.exists(path):
-                        os.makedirs(path)
+async def generate_images_async(jobs, model_name, backend, image_dir, manifest):
+    """
+    Generate the pending images of each prompt job with up to `backend['concurrency']` requests in flight. Requests
+    are paced by token buckets for the requests per minute and images per minute limits of the account, so that
+    throughput stays close to the limits without running into rate limit errors.
+
+    Args:
+    jobs (list): A list of PromptJob tuples to generate images for.
+
+    model_name (str): The name of the model to use for image generation.
+
+    backend (dict): The backend configuration (see `backends.BACKENDS`).
 
-                    image_path = os.path.join(path, image_name)
-                    if os.path.exists(image_path):
-                        image_path = os.path.join(path, image_name.replace(".png", f"_{int(time.time())}.png"))
+    image_dir (str): The directory to save the images to.
 
-                    save_image_from_url(image_url, image_path)
+    manifest (CompletionManifest): The manifest to record every saved image in.
+    """
+    limiters = [TokenBucket(backend['requests_per_minute']), TokenBucket(backend['images_per_minute'])]
+    slots = asyncio.Semaphore(backend['concurrency'])
 
-                except openai.OpenAIError as e:
-                    logger.error(f"An error occurred with prompt {prompt}: {str(e)}")
+    async def generate(job, i):
+        async with slots:
+            try:
+                response = await generate_image_async(job.prompt, model_name, limiters=limiters)
+                logger.info(f"Response for prompt {job.prompt}: {response.data[0]}")
 
+                path = image_directory(image_dir, job, backend['folder'])
+                os.makedirs(path, exist_ok=True)
 
-def main(args):
-    data = load_dataset(args.data, args.split, args.test, args.seed)
+                image_path = os.path.join(path, image_name(job.prompt, i))
+                if await asyncio.to_thread(save_image_from_url, response.data[0].url, image_path):
+                    manifest.add(manifest.key(backend['folder'], job, i))
 
-    # Pretty print the data frame
-    for file, df in data.items():
-        print(f"\nData from {file}:")
-        print(df.head())
+            except openai.OpenAIError as e:
+                metrics.increment('api_errors')
+                logger.error(f"An error occurred with prompt {job.prompt}: {str(e)}")
 
-    generate_images(data, args.model, args.dest, args.language, args.num_images)
+    await asyncio.gather(*(generate(job, i) for job in jobs for i in job.indices))
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Generate images using DALL-E.')
-    parser.add_argument('--model', default='dall-e-3', type=str,
-                        help='which model to evaluate')
-    parser.add_argument('--data', default='magbig', type=str,
-                        help='Which dataset to use')
-    parser.add_argument('--split', default=None, type=str,
-                        help='Which split of the dataset to use')
-    parser.add_argument('--language', default='german', type=str,
-                        choices=['english', 'german'],
-                        help='What languages to prompt in')
-    parser.add_argument('--num_images', default=4, type=int,
-                        help='How many images to generate per prompt')
-    parser.add_argument('--dest', default="../images", type=str,
-                        help='What folder to save images in')
-    parser.add_argument('--test', default=False, type=bool,
-                        help='Whether to test the dataset or not')
-    parser.add_argument('--seed', default=42, type=int,
-                        help='Random seed for reproducibility')
+    parser = build_parser('Generate images using DALL-E.', backend='dall-e-3')
+    parser.set_defaults(model='dall-e-3')
 
     arguments = parser.parse_args()
-    main(arguments)
+    run(arguments)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import queue
+import random
+import tarfile
+import threading
+import time
+
+SHARD_PATTERN = "shard-{:06d}.tar"
+INDEX_FILE = 'index.json'
+
+
+def add_member(tar, name, data, mtime):
+    """ Add a file with the given bytes to a tar archive and return the offset of its data in the archive. """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+    tar.addfile(info, io.BytesIO(data))
+    return offset
+
+
+def pack_dataset(dataset_dir, shard_dir, metadata_file='metadata.json', max_shard_size=1 << 30,
+                 max_shard_samples=10000):
+    """
+    Pack an enumerated dataset into tar shards for sequential streaming reads.
+
+    Every sample is stored as two consecutive files, "<id>.png" with the image and "<id>.json" with its metadata
+    record, following the WebDataset layout. A new shard is started whenever a shard would exceed `max_shard_size`
+    bytes or `max_shard_samples` samples. The position of every sample is written to an index for random access.
+
+    Args:
+        dataset_dir (str): The directory of the enumerated dataset (see `generate_dataset.enumerate_dataset`).
+        shard_dir (str): The directory to write the shards to.
+        metadata_file (str): Name of the JSON file containing the metadata of the dataset.
+        max_shard_size (int): The maximum size of a shard in bytes. A single larger sample gets a shard of its own.
+        max_shard_samples (int): The maximum number of samples per shard.
+    """
+    start_time = time.perf_counter()
+    with open(os.path.join(dataset_dir, metadata_file), 'r', encoding='utf-8') as f:
+        metadata_dict = json.load(f)
+
+    os.makedirs(shard_dir, exist_ok=True)
+    shards, samples = [], {}
+    tar, shard_path, shard_size, shard_samples = None, None, 0, 0
+    total_size = 0
+
+    def finish_shard():
+        tar.close()
+        os.replace(shard_path + '.part', shard_path)
+
+    for image_id in sorted(metadata_dict, key=int):
+        with open(os.path.join(dataset_dir, f"{image_id}.png"), 'rb') as f:
+            image = f.read()
+        record = json.dumps({'id': int(image_id), **metadata_dict[image_id]}, ensure_ascii=False).encode('utf-8')
+        # Both files take a 512 byte header and are padded to 512 byte blocks
+        sample_size = 1024 + -(-len(image) // 512) * 512 + -(-len(record) // 512) * 512
+
+        if tar is not None and (shard_size + sample_size > max_shard_size or shard_samples >= max_shard_samples):
+            finish_shard()
+            tar = None
+        if tar is None:
+            shard_path = os.path.join(shard_dir, SHARD_PATTERN.format(len(shards)))
+            tar = tarfile.open(shard_path + '.part', 'w', format=tarfile.USTAR_FORMAT)
+            shards.append(os.path.basename(shard_path))
+            shard_size, shard_samples = 0, 0
+
+        mtime = int(time.time())
+        image_offset = add_member(tar, f"{image_id}.png", image, mtime)
+        record_offset = add_member(tar, f"{image_id}.json", record, mtime)
+        samples[image_id] = [len(shards) - 1, image_offset, len(image), record_offset, len(record)]
+        shard_size += sample_size
+        shard_samples += 1
+        total_size += len(image)
+
+    if tar is not None:
+        finish_shard()
+
+    with open(os.path.join(shard_dir, INDEX_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'shards': shards, 'samples': samples}, f)
+
+    print(f"Packed {len(samples)} images ({total_size / 1e6:.1f} MB) into {len(shards)} shards "
+          f"in {time.perf_counter() - start_time:.1f}s")
+
+
+class ShardIndex:
+    """
+    Random access to the samples of a sharded dataset by image id. Every lookup reads exactly the bytes of the sample
+    from its shard, without scanning the archive.
+
+    Args:
+        shard_dir (str): The directory of the shards (see `pack_dataset`).
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.shards = index['shards']
+        self.samples = index['samples']
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __contains__(self, image_id):
+        return str(image_id) in self.samples
+
+    def get(self, image_id):
+        """
+        Read a sample.
+
+        Args:
+            image_id (int): The id of the image.
+
+        Returns:
+            tuple: The PNG bytes of the image and its metadata record.
+        """
+        shard, image_offset, image_size, record_offset, record_size = self.samples[str(image_id)]
+        with open(os.path.join(self.shard_dir, self.shards[shard]), 'rb') as f:
+            f.seek(image_offset)
+            image = f.read(image_size)
+            f.seek(record_offset)
+            record = json.loads(f.read(record_size))
+        return image, record
+
+
+def read_shard(path):
+    """
+    Stream the samples of a shard in a single sequential pass.
+
+    Yields:
+        tuple: The PNG bytes of an image and its metadata record.
+    """
+    sample_key, image, record = None, None, None
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, extension = member.name.rsplit('.', 1)
+            if key != sample_key:
+                if image is not None and record is not None:
+                    yield image, record
+                sample_key, image, record = key, None, None
+
+            data = tar.extractfile(member).read()
+            if extension == 'png':
+                image = data
+            elif extension == 'json':
+                record = json.loads(data)
+    if image is not None and record is not None:
+        yield image, record
+
+
+def stream_dataset(shard_dir, num_workers=4, shuffle_buffer=0, seed=None, max_pending=256):
+    """
+    Stream the samples of a sharded dataset, reading several shards in parallel.
+
+    Every worker thread reads whole shards sequentially. With `shuffle_buffer > 0`, the shard order is shuffled and
+    samples are drawn at random from a buffer of that many samples, which mixes samples across shards without random
+    reads.
+
+    Args:
+        shard_dir (str): The directory of the shards (see `pack_dataset`).
+        num_workers (int): The number of shards read in parallel.
+        shuffle_buffer (int): The number of samples to shuffle in memory. 0 keeps the order within each shard.
+        seed (int): The seed of the shuffle.
+        max_pending (int): The maximum number of samples read ahead.
+
+    Yields:
+        tuple: The PNG bytes of an image and its metadata record.
+    """
+    with open(os.path.join(shard_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+        shards = [os.path.join(shard_dir, shard) for shard in json.load(f)['shards']]
+
+    rng = random.Random(seed)
+    if shuffle_buffer > 0:
+        rng.shuffle(shards)
+
+    shard_queue = queue.Queue()
+    for shard in shards:
+        shard_queue.put(shard)
+    samples = queue.Queue(maxsize=max_pending)
+    stopped = threading.Event()
+    done = object()
+
+    def worker():
+        try:
+            while not stopped.is_set():
+                try:
+                    shard = shard_queue.get_nowait()
+                except queue.Empty:
+                    return
+                for sample in read_shard(shard):
+                    while not stopped.is_set():
+                        try:
+                            samples.put(sample, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+        except Exception as e:
+            if not stopped.is_set():
+                samples.put(e)
+        finally:
+            # Once the reader has stopped, nobody takes from the queue anymore
+            if not stopped.is_set():
+                samples.put(done)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, min(num_workers, len(shards))))]
+    for thread in workers:
+        thread.start()
+
+    buffer = []
+    running = len(workers)
+    try:
+        while running:
+            sample = samples.get()
+            if sample is done:
+                running -= 1
+                continue
+            if isinstance(sample, Exception):
+                raise sample
+
+            if shuffle_buffer <= 0:
+                yield sample
+                continue
+            buffer.append(sample)
+            if len(buffer) >= shuffle_buffer:
+                i = rng.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield buffer.pop()
+
+        rng.shuffle(buffer)
+        yield from buffer
+    finally:
+        stopped.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack an enumerated dataset into tar shards for streaming reads.')
+    parser.add_argument('--dataset_directory', default='../images_dataset', type=str,
+                        help='Path to the directory containing the enumerated dataset')
+    parser.add_argument('--shard_directory', default='../images_shards', type=str,
+                        help='Path to the directory where the shards will be saved')
+    parser.add_argument('--max_shard_size', default=1024, type=int,
+                        help='Maximum size of a shard in MB')
+    parser.add_argument('--max_shard_samples', default=10000, type=int,
+                        help='Maximum number of images per shard')
+
+    args = parser.parse_args()
+
+    pack_dataset(args.dataset_directory, args.shard_directory, max_shard_size=args.max_shard_size * 1024 * 1024,
+                 max_shard_samples=args.max_shard_samples)
@@ -0,0 +1,307 @@
+import gc
+import importlib
+import logging
+import os
+import re
+import time
+from functools import lru_cache
+
+import torch
+
+from embedding_cache import EmbeddingCache
+from jobs import image_directory, image_name
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+COMMIT_HASH_PATTERN = re.compile(r"[0-9a-f]{40}")
+
+# How prompts are encoded by each pipeline family. `components` are the text encoders and tokenizers, which are not
+# loaded when the embedding cache is used, and `denoiser` is the component which is not needed to encode prompts.
+# `names` are the embeddings of each prompt and `shared` the embeddings of the empty negative prompt, which are
+# cached once.
+TEXT_EMBEDDINGS = {
+    'flux': {
+        'components': ['text_encoder', 'text_encoder_2', 'tokenizer', 'tokenizer_2'],
+        'denoiser': 'transformer',
+        'names': ['prompt_embeds', 'pooled_prompt_embeds'],
+        'shared': [],
+    },
+    'sd3': {
+        'components': ['text_encoder', 'text_encoder_2', 'text_encoder_3', 'tokenizer', 'tokenizer_2', 'tokenizer_3'],
+        'denoiser': 'transformer',
+        'names': ['prompt_embeds', 'pooled_prompt_embeds'],
+        'shared': ['negative_prompt_embeds', 'negative_pooled_prompt_embeds'],
+    },
+    'sdxl': {
+        'components': ['text_encoder', 'text_encoder_2', 'tokenizer', 'tokenizer_2'],
+        'denoiser': 'unet',
+        'names': ['prompt_embeds', 'pooled_prompt_embeds'],
+        'shared': ['negative_prompt_embeds', 'negative_pooled_prompt_embeds'],
+    },
+}
+
+
+@lru_cache(maxsize=None)
+def resolve_revision(model_id, revision):
+    """
+    Return the commit hash a revision of a model on the Hugging Face Hub points to. Branches like "main" move when the
+    weights are updated, so the weights are loaded and the text embeddings are cached by commit hash. Without network
+    access, the revision is resolved from the local Hugging Face cache.
+
+    Args:
+    model_id (str): The model id on the Hub.
+
+    revision (str): A branch, tag or commit hash.
+
+    Returns:
+    str: The commit hash.
+    """
+    if COMMIT_HASH_PATTERN.fullmatch(revision):
+        return revision
+
+    from huggingface_hub import model_info, snapshot_download
+
+    try:
+        return model_info(model_id, revision=revision).sha
+    except Exception as e:
+        logger.warning(f"Could not resolve revision {revision} of {model_id} on the Hub, using the local cache: {e}")
+    # The snapshot folder of a cached revision is named after its commit hash
+    return os.path.basename(snapshot_download(model_id, revision=revision, allow_patterns=['model_index.json'],
+                                              local_files_only=True))
+
+
+def load_model(backend, text_encoders_only=False):
+    """
+    Load the diffusers pipeline of a backend and move it to the available device.
+
+    Args:
+    backend (dict): The backend configuration (see `backends.BACKENDS`).
+
+    text_encoders_only (bool): Whether to load only the components needed to encode prompts. Otherwise, the text
+    encoders are not loaded if the embedding cache is used.
+
+    Returns:
+    DiffusionPipeline: The loaded pipeline.
+    """
+    module_name, class_name = backend['pipeline'].rsplit(".", 1)
+    pipeline_class = getattr(importlib.import_module(module_name), class_name)
+
+    family = TEXT_EMBEDDINGS[backend['text_embeddings']]
+    kwargs = dict(backend['pretrained_kwargs'])
+    if text_encoders_only:
+        kwargs.update({family['denoiser']: None, 'vae': None})
+    elif backend.get('embedding_cache'):
+        kwargs.update({component: None for component in family['components']})
+
+    revision = resolve_revision(backend['model_id'], backend['revision'])
+    pipe = pipeline_class.from_pretrained(backend['model_id'], revision=revision,
+                                          torch_dtype=getattr(torch, backend['torch_dtype']), **kwargs)
+    # set the device to train on (run export CUDA_VISIBLE_DEVICES beforehand)
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    pipe.to(device)
+    logger.info(f"Running {backend['description']} at revision {revision} on device: {device}")
+
+    return pipe
+
+
+def get_embedding_cache(backend):
+    """ Return the text embedding cache of a backend, or None if the cache is disabled. """
+    if not backend.get('embedding_cache'):
+        return None
+    return EmbeddingCache(backend['embedding_cache'], backend['model_id'],
+                          resolve_revision(backend['model_id'], backend['revision']), backend['torch_dtype'])
+
+
+@metrics.timed('text_encode')
+def encode_prompts(pipe, family, prompts):
+    """
+    Encode prompts with the text encoders of a pipeline.
+
+    Returns:
+    dict: The embeddings by name, with one row per prompt.
+    """
+    device = pipe._execution_device
+    with torch.no_grad():
+        if family == 'flux':
+            prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(prompt=prompts, prompt_2=None, device=device)
+            return {'prompt_embeds': prompt_embeds, 'pooled_prompt_embeds': pooled_prompt_embeds}
+
+        if family == 'sd3':
+            embeddings = pipe.encode_prompt(prompt=prompts, prompt_2=None, prompt_3=None, device=device,
+                                            do_classifier_free_guidance=True)
+        else:
+            embeddings = pipe.encode_prompt(prompt=prompts, device=device, do_classifier_free_guidance=True)
+        names = ['prompt_embeds', 'negative_prompt_embeds', 'pooled_prompt_embeds', 'negative_pooled_prompt_embeds']
+        return dict(zip(names, embeddings))
+
+
+def to_numpy(tensor, dtype):
+    """ Convert a tensor to a NumPy array in the given dtype. bfloat16 is stored bitwise as int16. """
+    tensor = tensor.detach().to(dtype=dtype).cpu()
+    if dtype == torch.bfloat16:
+        return tensor.view(torch.int16).numpy()
+    return tensor.numpy()
+
+
+def from_numpy(array, dtype, device):
+    """ Convert an array created with `to_numpy` back to a tensor on the device. """
+    tensor = torch.from_numpy(array.copy())
+    if dtype == torch.bfloat16:
+        tensor = tensor.view(torch.bfloat16)
+    return tensor.to(device=device, dtype=dtype)
+
+
+def prepare(jobs, backend, batch_size=8):
+    """
+    Encode and cache the embeddings of all prompts which are missing from the text embedding cache. The text encoders
+    are only loaded if an embedding is missing and are released before the denoising model is loaded.
+
+    Args:
+    jobs (list): A list of PromptJob tuples to generate images for.
+
+    backend (dict): The backend configuration (see `backends.BACKENDS`).
+
+    batch_size (int): The number of prompts to encode at once.
+    """
+    cache = get_embedding_cache(backend)
+    if cache is None:
+        return
+
+    family = TEXT_EMBEDDINGS[backend['text_embeddings']]
+    missing = sorted({job.prompt for job in jobs if not cache.contains(job.prompt, family['names'])})
+    if family['shared'] and not cache.contains("", family['shared']):
+        missing = missing or [""]
+    logger.info(f"{len(missing)} of {len({job.prompt for job in jobs})} prompt embeddings missing from the cache")
+    if not missing:
+        return
+
+    pipe = load_model(backend, text_encoders_only=True)
+    dtype = getattr(torch, backend['torch_dtype'])
+    for start in range(0, len(missing), batch_size):
+        prompts = missing[start:start + batch_size]
+        embeddings = encode_prompts(pipe, backend['text_embeddings'], prompts)
+
+        for i, prompt in enumerate(prompts):
+            cache.save(prompt, {name: to_numpy(embeddings[name][i:i + 1], dtype) for name in family['names']})
+        if family['shared']:
+            cache.save("", {name: to_numpy(embeddings[name][:1], dtype) for name in family['shared']})
+
+    del pipe
+    gc.collect()
+    torch.cuda.empty_cache()
+
+
+@metrics.timed('embedding_load')
+def embedding_inputs(cache, backend, prompts, device):
+    """ Return the cached embeddings of prompts as pipeline inputs. """
+    family = TEXT_EMBEDDINGS[backend['text_embeddings']]
+    dtype = getattr(torch, backend['torch_dtype'])
+
+    cached = [cache.load(prompt, family['names']) for prompt in prompts]
+    inputs = {name: torch.cat([from_numpy(embeddings[name], dtype, device) for embeddings in cached])
+              for name in family['names']}
+
+    if family['shared']:
+        for name, array in cache.load("", family['shared']).items():
+            tensor = from_numpy(array, dtype, device)
+            inputs[name] = tensor.repeat(len(prompts), *[1] * (tensor.dim() - 1))
+
+    return inputs
+
+
+def is_out_of_memory(error):
+    """ Check whether an exception was raised because the accelerator ran out of memory. """
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+
+def record_saved(results, manifest):
+    """ Record the images saved by the image writer in the manifest and log failed saves. """
+    for key, error in results:
+        if error is None:
+            manifest.add(key)
+        else:
+            logger.error(f"Failed to save image {key}: {str(error)}")
+
+
+def generate_images(jobs, model, backend, image_dir, manifest, writer, batch_size=1):
+    """
+    Generate images for each prompt job using the specified diffusers pipeline and save them to the image directory.
+
+    Several prompts are packed into a single pipeline call. Only consecutive jobs with the same number of pending images
+    are batched together. If the accelerator runs out of memory, the batch size is halved and the batch is retried
+    until a batch size of one is reached. Images are encoded and saved by the image writer while the next batch is
+    generated. If the text embedding cache is used, the cached prompt embeddings are passed to the pipeline instead
+    of the prompts.
+
+    Args:
+    jobs (list): A list of PromptJob tuples to generate images for.
+
+    model (DiffusionPipeline): The pipeline to use for image generation.
+
+    backend (dict): The backend configuration (see `backends.BACKENDS`).
+
+    image_dir (str): The directory to save the images to.
+
+    manifest (CompletionManifest): The manifest to record every saved image in.
+
+    writer (ImageWriter): The writer to save the images with.
+
+    batch_size (int): The number of prompts to generate images for in a single pipeline call.
+    """
+    cache = get_embedding_cache(backend)
+
+    start = 0
+    while start < len(jobs):
+        num_images = len(jobs[start].indices)
+        end = start + 1
+        while end < min(len(jobs), start + batch_size) and len(jobs[end].indices) == num_images:
+            end += 1
+        batch = jobs[start:end]
+        prompts = [job.prompt for job in batch]
+
+        try:
+            if cache is None:
+                inputs = {'prompt': prompts}
+            else:
+                inputs = embedding_inputs(cache, backend, prompts, model._execution_device)
+
+            pipeline_start = time.perf_counter()
+            images = model(
+                **inputs,
+                num_inference_steps=backend['num_inference_steps'],
+                height=backend['height'],
+                width=backend['width'],
+                guidance_scale=backend['guidance_scale'],
+                num_images_per_prompt=num_images
+            ).images
+            pipeline_time = time.perf_counter() - pipeline_start
+        except Exception as e:
+            if is_out_of_memory(e) and batch_size > 1:
+                # Retry the same prompts with a smaller batch
+                batch_size = max(1, batch_size // 2)
+                torch.cuda.empty_cache()
+                metrics.increment('oom_retries')
+                logger.warning(f"Out of memory, reducing batch size to {batch_size}")
+                continue
+
+            metrics.increment('pipeline_errors')
+            logger.error(f"An error occurred with prompts {prompts}: {str(e)}")
+            start += len(batch)
+            continue
+
+        metrics.observe('pipeline', pipeline_time)
+        metrics.observe('denoising_step', pipeline_time / backend['num_inference_steps'])
+        metrics.increment('images_generated', len(images))
+
+        # The pipeline returns num_images consecutive images for every prompt in the batch
+        for j, job in enumerate(batch):
+            path = image_directory(image_dir, job, backend['folder'])
+            for i, image in zip(job.indices, images[j * num_images:(j + 1) * num_images]):
+                writer.submit(image, os.path.join(path, image_name(job.prompt, i, writer.extension)),
+                              key=manifest.key(backend['folder'], job, i))
+
+        record_saved(writer.poll(), manifest)
+        start += len(batch)
+
+    record_saved(writer.flush(), manifest)
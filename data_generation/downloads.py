@@ -0,0 +1,126 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import backoff
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_TRAILER = b"IEND\xaeB`\x82"
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    """ Raised if a downloaded file is incomplete or not a valid image. """
+
+
+def get_session(pool_size=16):
+    """ Return the HTTP session shared by all downloads, which keeps connections to each host alive. """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def is_permanent_error(error):
+    """ Check whether a download failed with a client error which will not go away on retry. """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return 400 <= error.response.status_code < 500 and error.response.status_code != 429
+    return False
+
+
+def count_retry(details):
+    """ Backoff handler which counts retried downloads. """
+    metrics.increment('download_retries')
+
+
+@backoff.on_exception(backoff.expo, (requests.RequestException, DownloadError), max_tries=4,
+                      giveup=is_permanent_error, on_backoff=count_retry)
+@metrics.timed('download')
+def download_file(url, path, headers=None, timeout=(10, 60), chunk_size=1 << 16, validate_png=True):
+    """
+    Download a file in chunks to a temporary file next to the target path and atomically rename it once it is
+    complete, so the target path never holds a partial file. Failed downloads are retried with exponential backoff.
+
+    Args:
+    url (str): The URL of the file to download.
+
+    path (str): The path to save the file to.
+
+    headers (dict): Additional request headers.
+
+    timeout (tuple): The connect and read timeouts in seconds.
+
+    chunk_size (int): The number of bytes to write at a time.
+
+    validate_png (bool): Whether to check that the file starts with the PNG signature and ends with the IEND chunk.
+
+    Returns:
+    int: The number of bytes downloaded.
+    """
+    temp_path = f"{path}.part"
+    try:
+        with get_session().get(url, headers=headers, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+
+            size = 0
+            head = b""
+            tail = b""
+            with open(temp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if len(head) < len(PNG_SIGNATURE):
+                        head += chunk[:len(PNG_SIGNATURE)]
+                    tail = (tail + chunk)[-len(PNG_TRAILER):]
+                    f.write(chunk)
+                    size += len(chunk)
+
+            expected = response.headers.get("Content-Length")
+            if expected is not None and 'Content-Encoding' not in response.headers and int(expected) != size:
+                raise DownloadError(f"Incomplete download of {url}: {size} of {expected} bytes")
+            if validate_png and (not head.startswith(PNG_SIGNATURE) or tail != PNG_TRAILER):
+                raise DownloadError(f"Downloaded file from {url} is not a complete PNG image")
+
+        os.replace(temp_path, path)
+        return size
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def download_files(downloads, max_workers=8, **kwargs):
+    """
+    Download several files concurrently over the shared session.
+
+    Args:
+    downloads (list): A list of (url, path) tuples.
+
+    max_workers (int): The number of concurrent downloads.
+
+    kwargs: Additional arguments passed to `download_file`.
+
+    Returns:
+    list: A list of (url, path, error) tuples in the order of the downloads, where error is None if the file was
+    saved.
+    """
+    def download(url, path):
+        try:
+            download_file(url, path, **kwargs)
+            return url, path, None
+        except (requests.RequestException, DownloadError, OSError) as e:
+            logger.error(f"Error downloading {url}: {e}")
+            return url, path, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda d: download(*d), downloads))
@@ -0,0 +1,63 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of prompt embeddings keyed by (model, commit hash of the weights, prompt hash).
+
+    Embeddings are stored separately for every dtype. Every embedding is stored as a single `.npy` file, which is
+    loaded as a read-only memory map, so only the embeddings of the prompts in the current batch are read from disk.
+    """
+
+    def __init__(self, cache_dir, model_id, revision, dtype):
+        # Use a commit hash as revision: a branch name would keep stale embeddings when the branch moves
+        self.directory = os.path.join(cache_dir, model_id.replace("/", "--"), revision, dtype)
+
+    @staticmethod
+    def prompt_hash(prompt):
+        """ Return the hash of a prompt used as cache key. """
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    def path(self, prompt, name):
+        """ Return the path of the named embedding of a prompt. """
+        digest = self.prompt_hash(prompt)
+        return os.path.join(self.directory, digest[:2], f"{digest}.{name}.npy")
+
+    def contains(self, prompt, names):
+        """ Check whether all named embeddings of a prompt are cached. """
+        return all(os.path.exists(self.path(prompt, name)) for name in names)
+
+    def load(self, prompt, names):
+        """
+        Load the named embeddings of a prompt.
+
+        Args:
+        prompt (str): The prompt.
+
+        names (list): The names of the embeddings, e.g. ["prompt_embeds", "pooled_prompt_embeds"].
+
+        Returns:
+        dict: The embeddings as read-only memory mapped arrays by name.
+        """
+        return {name: np.load(self.path(prompt, name), mmap_mode='r') for name in names}
+
+    def save(self, prompt, embeddings):
+        """
+        Save the embeddings of a prompt. Files are written to a temporary path and renamed, so concurrent workers
+        never read partially written embeddings.
+
+        Args:
+        prompt (str): The prompt.
+
+        embeddings (dict): The embeddings as arrays by name.
+        """
+        for name, array in embeddings.items():
+            path = self.path(prompt, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(temp_path, path)
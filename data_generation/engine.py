@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import logging
+import os
+import time
+from collections import Counter
+
+from backends import BACKENDS
+from image_writer import IMAGE_FORMATS, ImageWriter
+from jobs import LANGUAGE_CODES, build_jobs, shard_jobs
+from manifest import CompletionManifest, filter_completed, print_skip_summary
+from metrics import metrics
+from planner import RUN_HISTORY, load_plan, record_run
+from prompt_source import PROMPTS_DIR, PromptSource
+
+logger = logging.getLogger(__name__)
+
+# Map backend types to the modules implementing them. Every module provides `load_model(backend)` and
+# `generate_images(jobs, model, backend, image_dir, manifest, writer, ...)`, and optionally `prepare(jobs, backend)`,
+# which runs before the model is loaded. Modules are imported lazily, so that e.g. the DALL-E backend can run without
+# torch installed.
+BACKEND_TYPES = {
+    'diffusers': 'diffusers_backend',
+    'openai': 'dall_e',
+    'midjourney': 'midjourney',
+}
+
+
+def build_parser(description, backend=None):
+    """
+    Build the command line parser shared by all generation scripts.
+
+    Args:
+    description (str): The description of the script.
+
+    backend (str): The backend the script is bound to. If None, the backend is selected with `--backend`.
+
+    Returns:
+    argparse.ArgumentParser: The argument parser.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    if backend is None:
+        parser.add_argument('--backend', required=True, type=str, choices=sorted(BACKENDS),
+                            help='Which model backend to generate images with')
+    else:
+        parser.set_defaults(backend=backend)
+    parser.add_argument('--model', default=None, type=str,
+                        help='Override the model name of an API backend (e.g. dall-e-2)')
+    parser.add_argument('--data', default=['magbig'], type=str, nargs='+',
+                        help='Which datasets to use, e.g. magbig bafis (the model is loaded once for all of them)')
+    parser.add_argument('--split', default=None, type=str, nargs='+',
+                        help='Which splits of the dataset to use, e.g. direct (matches exactly)')
+    parser.add_argument('--prompts_directory', default=PROMPTS_DIR, type=str,
+                        help='Path to the directory containing the prompt files')
+    parser.add_argument('--plan', default=None, type=str,
+                        help='Generate the jobs of this backend from a plan file (see planner.py) in plan order, '
+                             'instead of the data, split and language options')
+    parser.add_argument('--metrics_dir', default='../logs/metrics', type=str,
+                        help='Where to export run metrics as JSON lines and a Prometheus textfile ("" disables it)')
+    parser.add_argument('--history', default=RUN_HISTORY, type=str,
+                        help='Where to record the throughput of runs for the job planner ("" disables it)')
+    parser.add_argument('--prompt_cache', default='../cache/prompts', type=str,
+                        help='Directory to cache parsed prompt files in (empty string to disable)')
+    parser.add_argument('--language', default=['german'], type=str, nargs='+',
+                        choices=sorted(LANGUAGE_CODES),
+                        help='What languages to prompt in')
+    parser.add_argument('--num_images', default=4, type=int,
+                        help='How many images to generate per prompt')
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help='How many prompts to generate images for in a single pipeline call')
+    parser.add_argument('--dest', default="../images", type=str,
+                        help='What folder to save images in')
+    parser.add_argument('--concurrency', default=None, type=int,
+                        help='How many API requests or Midjourney jobs to run at a time')
+    parser.add_argument('--requests_per_minute', default=None, type=float,
+                        help='Override the requests per minute limit of an API backend')
+    parser.add_argument('--images_per_minute', default=None, type=float,
+                        help='Override the images per minute limit of an API backend')
+    parser.add_argument('--no_gateway', dest='gateway', action='store_false', default=None,
+                        help='Poll the Midjourney channel instead of listening to the Discord gateway')
+    parser.add_argument('--image_format', default='png', type=str, choices=sorted(IMAGE_FORMATS),
+                        help='Which format to save generated images in (diffusers backends only)')
+    parser.add_argument('--save_workers', default=2, type=int,
+                        help='How many threads encode and save images in the background (0 saves synchronously)')
+    parser.add_argument('--save_queue', default=16, type=int,
+                        help='How many generated images may wait to be saved before generation blocks')
+    parser.add_argument('--embedding_cache', default='../cache/text_embeddings', type=str,
+                        help='Where to cache prompt embeddings of diffusers backends ("" disables the cache)')
+    parser.add_argument('--shard_index', '--shard-index', default=0, type=int,
+                        help='Which shard of the work to generate, between 0 and num_shards - 1')
+    parser.add_argument('--num_shards', '--num-shards', default=1, type=int,
+                        help='How many workers share the work (start all of them with the same splits and languages)')
+    parser.add_argument('--manifest', default=None, type=str,
+                        help='Path of the completion manifest (default: <dest>/.manifest.jsonl)')
+    resume = parser.add_mutually_exclusive_group()
+    resume.add_argument('--resume', dest='force', action='store_false',
+                        help='Skip images which were already generated (default)')
+    resume.add_argument('--force', dest='force', action='store_true',
+                        help='Generate all images again, even if they were already generated')
+    parser.set_defaults(force=False)
+    parser.add_argument('--test', default=False, type=bool,
+                        help='Whether to test the dataset or not')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='Random seed for reproducibility')
+    return parser
+
+
+def run(args):
+    """
+    Load the model of the selected backend once and generate images for every requested split and language.
+
+    Args:
+    args (argparse.Namespace): The parsed command line arguments (see `build_parser`).
+    """
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f"--shard_index must be between 0 and {args.num_shards - 1}")
+
+    backend = dict(BACKENDS[args.backend])
+    if args.model:
+        if backend['type'] == 'diffusers':
+            raise ValueError("--model can only be used with API backends")
+        backend['model_id'] = backend['folder'] = args.model
+    backend['embedding_cache'] = args.embedding_cache
+    for option in ['concurrency', 'requests_per_minute', 'images_per_minute', 'gateway']:
+        if getattr(args, option) is not None:
+            backend[option] = getattr(args, option)
+
+    if args.plan:
+        jobs = load_plan(args.plan, args.backend)
+    else:
+        source = PromptSource(args.prompts_directory, cache_dir=args.prompt_cache)
+        languages = [LANGUAGE_CODES[language] for language in args.language]
+        records = source.records(args.data, args.split, languages, sample=0.01 if args.test else None, seed=args.seed)
+        jobs = build_jobs(records, args.num_images)
+
+    prompt_counts = Counter((job.split, job.lang) for job in jobs)
+    for (split, lang), count in sorted(prompt_counts.items()):
+        print(f"{split} ({lang}): {count} prompts")
+    if args.split and not args.plan and not prompt_counts:
+        raise ValueError(f"No prompts found for splits {args.split} of {args.data} in {args.prompts_directory}")
+
+    # Plan files are identical for every worker, so their priority and cost order is kept
+    jobs = shard_jobs(jobs, args.shard_index, args.num_shards, keep_order=bool(args.plan))
+    if args.num_shards > 1:
+        logger.info(f"Shard {args.shard_index} of {args.num_shards}: {sum(len(job.indices) for job in jobs)} images")
+
+    # Skip completed images before any model is loaded
+    manifest = CompletionManifest(args.manifest or os.path.join(args.dest, ".manifest.jsonl"))
+    if not args.force:
+        manifest.add_existing(args.dest, backend['folder'])
+        jobs, skipped = filter_completed(jobs, manifest, backend['folder'])
+        print_skip_summary(skipped, jobs)
+    if not jobs:
+        print("Nothing left to generate.")
+        return
+
+    logger.info(f"Generating images for {len(jobs)} prompts with {backend['description']}")
+
+    metrics.start(labels={'backend': args.backend}, progress_total=sum(len(job.indices) for job in jobs),
+                  export_dir=args.metrics_dir)
+    module = importlib.import_module(BACKEND_TYPES[backend['type']])
+    if hasattr(module, 'prepare'):
+        module.prepare(jobs, backend)
+    model = module.load_model(backend)
+    completed, start_time = len(manifest), time.perf_counter()
+    try:
+        with ImageWriter(args.save_workers, args.save_queue, args.image_format) as writer:
+            module.generate_images(jobs, model, backend, args.dest, manifest, writer, batch_size=args.batch_size)
+    finally:
+        metrics.finish()
+        # Feed the time estimates of the job planner, also for interrupted runs
+        if args.history and len(manifest) > completed:
+            record_run(args.backend, len(manifest) - completed, time.perf_counter() - start_time, args.history)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename="../logs/engine.log",
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    arguments = build_parser('Generate images with any of the supported model backends.').parse_args()
+    run(arguments)
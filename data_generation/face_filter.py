@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import argparse
+import inspect
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from checksums import content_hash
+from generate_dataset import LINK_MODES, place_file
+
+logger = logging.getLogger(__name__)
+
+
+class StubDetector:
+    """
+    Local stand-in for a face detector, e.g. for tests of the filter stage. Counts one face in every image which is
+    not (nearly) a single flat color.
+    """
+
+    def __init__(self, min_std=8.0):
+        self.min_std = min_std
+
+    def detect(self, images):
+        return [int(np.asarray(image.convert('L'), dtype=np.float32).std() >= self.min_std) for image in images]
+
+
+class DeepFaceDetector:
+    """
+    Face detection with DeepFace, as used to filter the released dataset.
+
+    Args:
+        detector_backend (str): The DeepFace detector backend.
+        min_confidence (float): The minimum confidence of a detected face.
+    """
+
+    def __init__(self, detector_backend='yolov8', min_confidence=0.5):
+        from deepface import DeepFace
+
+        self.deepface = DeepFace
+        self.detector_backend = detector_backend
+        self.min_confidence = min_confidence
+
+    def detect(self, images):
+        counts = []
+        for image in images:
+            # DeepFace expects BGR images
+            faces = self.deepface.extract_faces(np.asarray(image)[:, :, ::-1], detector_backend=self.detector_backend,
+                                                enforce_detection=False, align=False)
+            counts.append(sum(1 for face in faces if face.get('confidence', 0) >= self.min_confidence))
+        return counts
+
+
+# A detector takes a list of RGB images and returns the number of faces in every image
+DETECTORS = {
+    'deepface': DeepFaceDetector,
+    'stub': StubDetector,
+}
+
+# The detector of a worker process, created once by `init_worker`
+detector = None
+
+
+def detector_key(detector_type, options=None):
+    """
+    Return the name of a detector with its complete configuration, e.g. 'stub {"min_std": 8.0}', so cached results
+    are only reused for the same detector settings.
+
+    Args:
+        detector_type (str): The face detector, one of DETECTORS.
+        options (dict): The arguments the detector is created with. Missing arguments take their defaults.
+    """
+    parameters = inspect.signature(DETECTORS[detector_type]).parameters
+    config = {name: parameter.default for name, parameter in parameters.items()}
+    config.update(options or {})
+    return f"{detector_type} {json.dumps(config, sort_keys=True)}"
+
+
+def init_worker(detector_type, options):
+    global detector
+    detector = DETECTORS[detector_type](**options)
+
+
+def detect_faces(paths):
+    """
+    Count the faces in a batch of images. Runs in a worker process.
+
+    Returns:
+        list: The number of faces per image, or None if the image could not be read.
+    """
+    images, readable = [], []
+    for path in paths:
+        try:
+            with Image.open(path) as img:
+                images.append(img.convert('RGB'))
+            readable.append(True)
+        except Exception as e:
+            logger.error(f"Error reading image {path}: {str(e)}")
+            readable.append(False)
+
+    counts = iter(detector.detect(images) if images else [])
+    return [next(counts) if ok else None for ok in readable]
+
+
+class DetectionCache:
+    """
+    Persistent record of the number of faces per image content hash and detector configuration (see `detector_key`).
+
+    Like the completion manifest, the cache is an append-only JSON lines file, so results of an interrupted run are
+    kept. Since the key is the image content, renamed or copied images are never scanned again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        self.results[(entry['detector'], entry['sha256'])] = entry['faces']
+            logger.info(f"Loaded {len(self.results)} cached face detections from {path}")
+
+    def get(self, detector_name, sha256):
+        return self.results.get((detector_name, sha256))
+
+    def add(self, detector_name, entries):
+        """ Record the number of faces of a list of (sha256, faces) tuples. """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for sha256, faces in entries:
+                self.results[(detector_name, sha256)] = faces
+                f.write(json.dumps({'detector': detector_name, 'sha256': sha256, 'faces': faces}) + "\n")
+
+
+def filter_faces(source_dir, target_dir, detector_type='deepface', cache_file='../cache/face_detections.jsonl',
+                 min_faces=1, batch_size=16, max_workers=None, link_mode='auto', detector_options=None):
+    """
+    Place all images of the source directory which show at least `min_faces` faces in the target directory, keeping
+    the directory structure, so the target directory can be enumerated by `generate_dataset.enumerate_dataset`.
+
+    Images are identified by the hash of their content, and only images without a cached result for the detector are
+    scanned, in batches on a process pool with one detector per process. Results are cached per detector
+    configuration, so changing e.g. the minimum confidence scans all images again.
+
+    Args:
+        source_dir (str): The directory containing the generated images.
+        target_dir (str): The directory where the images with faces will be placed.
+        detector_type (str): The face detector, one of DETECTORS.
+        cache_file (str): The JSON lines file caching the detection results.
+        min_faces (int): The minimum number of faces of a kept image.
+        batch_size (int): The number of images per detector call.
+        max_workers (int): The number of worker processes. Defaults to the number of CPUs.
+        link_mode (str): How to place the images in the target directory, one of `generate_dataset.LINK_MODES`.
+        detector_options (dict): Arguments of the detector, e.g. {'min_confidence': 0.7} for DeepFace.
+
+    Returns:
+        dict: The number of kept, dropped, unreadable and newly scanned images.
+    """
+    start_time = time.perf_counter()
+    paths = []
+    for root, _, files in os.walk(source_dir):
+        paths.extend(os.path.join(root, file) for file in sorted(files) if file.lower().endswith('.png'))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        hashes = list(executor.map(content_hash, paths))
+
+    cache = DetectionCache(cache_file)
+    detector_options = detector_options or {}
+    detector_name = detector_key(detector_type, detector_options)
+
+    # Scan every distinct content only once
+    pending = {}
+    for path, sha256 in zip(paths, hashes):
+        if cache.get(detector_name, sha256) is None and sha256 not in pending:
+            pending[sha256] = path
+    pending = list(pending.items())
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    unreadable = set()
+    if batches:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(detector_type, detector_options)) as executor:
+            results = executor.map(detect_faces, [[path for _, path in batch] for batch in batches])
+            for batch, counts in zip(batches, results):
+                cache.add(detector_name, [(sha256, faces) for (sha256, _), faces in zip(batch, counts)
+                                          if faces is not None])
+                unreadable.update(sha256 for (sha256, _), faces in zip(batch, counts) if faces is None)
+
+    kept, dropped = 0, 0
+    for path, sha256 in zip(paths, hashes):
+        faces = cache.get(detector_name, sha256)
+        if faces is None:
+            continue
+        if faces < min_faces:
+            dropped += 1
+            continue
+        target_file = os.path.join(target_dir, os.path.relpath(path, source_dir))
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        place_file(path, target_file, link_mode)
+        kept += 1
+
+    counts = {'kept': kept, 'dropped': dropped, 'unreadable': len(unreadable), 'scanned': len(pending)}
+    print(f"Kept {kept} of {len(paths)} images with faces, dropped {dropped}, {len(unreadable)} unreadable, "
+          f"scanned {len(pending)} new images in {time.perf_counter() - start_time:.1f}s")
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Keep only generated images which show a face')
+    parser.add_argument('--source_directory', default='../images', type=str,
+                        help='Path to the directory containing the generated images')
+    parser.add_argument('--target_directory', default='../images_filtered', type=str,
+                        help='Path to the directory where the images with faces will be placed')
+    parser.add_argument('--detector', default='deepface', type=str, choices=list(DETECTORS),
+                        help='Face detector to use')
+    parser.add_argument('--detector_backend', default='yolov8', type=str,
+                        help='DeepFace detector backend (with --detector deepface)')
+    parser.add_argument('--min_confidence', default=0.5, type=float,
+                        help='Minimum confidence of a detected face (with --detector deepface)')
+    parser.add_argument('--cache', default='../cache/face_detections.jsonl', type=str,
+                        help='JSON lines file caching the detection results by image content hash')
+    parser.add_argument('--min_faces', default=1, type=int,
+                        help='Minimum number of faces of a kept image')
+    parser.add_argument('--batch_size', default=16, type=int,
+                        help='Number of images per detector call')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of detector processes (default: number of CPUs)')
+    parser.add_argument('--link_mode', default='auto', type=str, choices=LINK_MODES,
+                        help='How to place images in the target directory (auto links if possible, else copies)')
+
+    args = parser.parse_args()
+
+    options = {}
+    if args.detector == 'deepface':
+        options = {'detector_backend': args.detector_backend, 'min_confidence': args.min_confidence}
+    filter_faces(args.source_directory, args.target_directory, detector_type=args.detector, cache_file=args.cache,
+                 min_faces=args.min_faces, batch_size=args.batch_size, max_workers=args.workers,
+                 link_mode=args.link_mode, detector_options=options)
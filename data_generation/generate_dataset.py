@@ -2,24 +2,98 @@ import argparse
 import os
 import json
 import shutil
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pandas as pd
 
+from metadata_store import write_metadata_store
+from prompt_catalog import PROMPTS_DIR, load_prompt_catalog
 
-def enumerate_dataset(source_dir, target_dir, metadata_file='metadata.json'):
+
+# Ways to place an image in the target directory. "auto" uses a hardlink or reflink if possible and copies otherwise.
+LINK_MODES = ['auto', 'hardlink', 'reflink', 'symlink', 'copy']
+
+# ioctl request to clone a file on copy-on-write file systems (Linux, e.g. Btrfs or XFS)
+FICLONE = 0x40049409
+
+
+def reflink(source_file, target_file):
+    """ Clone a file without copying its data. Raises OSError if the file system does not support it. """
+    import fcntl
+
+    with open(source_file, 'rb') as src, open(target_file, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target_file)
+            raise
+
+
+def place_file(source_file, target_file, link_mode):
+    """
+    Place a source file at the target path without copying its data if possible.
+
+    Args:
+        source_file (str): The path of the source file.
+        target_file (str): The path to place the file at. An existing file is replaced.
+        link_mode (str): One of LINK_MODES.
+
+    Returns:
+        str: The mode which was used, "hardlink", "reflink", "symlink" or "copy".
+    """
+    if os.path.lexists(target_file):
+        os.remove(target_file)
+
+    if link_mode in ('auto', 'hardlink'):
+        try:
+            os.link(source_file, target_file)
+            return 'hardlink'
+        except OSError:
+            if link_mode == 'hardlink':
+                raise
+    if link_mode in ('auto', 'reflink'):
+        try:
+            reflink(source_file, target_file)
+            return 'reflink'
+        except OSError:
+            if link_mode == 'reflink':
+                raise
+    if link_mode == 'symlink':
+        os.symlink(os.path.abspath(source_file), target_file)
+        return 'symlink'
+
+    shutil.copy2(source_file, target_file)
+    return 'copy'
+
+
+def enumerate_dataset(source_dir, target_dir, metadata_file='metadata.json', link_mode='auto', max_workers=8):
     """
     Enumerate all images in the source directory, extract their metadata and save them to the target directory.
 
+    Images are hardlinked or reflinked into the target directory if both directories are on the same file system,
+    which avoids copying the image data. Hardlinked images share their data with the source images, so they must not
+    be modified in place. Otherwise, the images are copied in parallel. Images are numbered in sorted order of their
+    occupation, model, prompt group, language and file name, so the same image tree always gets the same ids.
+
     Args:
         source_dir (str): The directory containing the images to convert.
         target_dir (str): The directory where the converted images will be saved.
         metadata_file (str): Name of the JSON file to store metadata.
+        link_mode (str): How to place the images in the target directory, one of LINK_MODES.
+        max_workers (int): The number of threads placing images in parallel.
     """
+    start_time = time.perf_counter()
     os.makedirs(target_dir, exist_ok=True)
     image_counter = 0
     metadata_dict = {}
+    placements = []
 
-    for root, _, files in os.walk(source_dir):
+    for root, dirs, files in os.walk(source_dir):
+        # Walk in sorted order, so ids are reproducible and contiguous per occupation, model, prompt group and language
+        dirs.sort()
         png_files = sorted([f for f in files if f.lower().endswith('.png')])
 
         for file in png_files:
@@ -39,51 +113,64 @@ def enumerate_dataset(source_dir, target_dir, metadata_file='metadata.json'):
 
             new_filename = f"{image_counter}.png"
             target_file = os.path.join(target_dir, new_filename)
-            shutil.copy2(source_file, target_file)
+            placements.append((source_file, target_file))
 
             metadata_dict[str(image_counter)] = metadata
             image_counter += 1
 
+    # Links are impossible across file systems, so copy right away
+    if link_mode in ('auto', 'hardlink', 'reflink') and os.stat(source_dir).st_dev != os.stat(target_dir).st_dev:
+        if link_mode != 'auto':
+            raise ValueError(f"Cannot {link_mode} images from {source_dir} to {target_dir} on another file system")
+        link_mode = 'copy'
+
+    def place(placement):
+        source_file, target_file = placement
+        return place_file(source_file, target_file, link_mode), os.path.getsize(source_file)
+
+    modes = Counter()
+    bytes_avoided = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for mode, size in executor.map(place, placements):
+            modes[mode] += 1
+            if mode != 'copy':
+                bytes_avoided += size
+
     metadata_path = os.path.join(target_dir, metadata_file)
     with open(metadata_path, 'w', encoding='utf-8') as f:
         json.dump(metadata_dict, f, indent=2, ensure_ascii=False)
 
-    print(f"Processed {image_counter} images")
+    print(f"Processed {image_counter} images in {time.perf_counter() - start_time:.1f}s "
+          f"({', '.join(f'{count} {mode}' for mode, count in sorted(modes.items())) or 'nothing placed'})")
+    print(f"Avoided copying {bytes_avoided / 1024 ** 2:.1f} MiB")
     print(f"Metadata saved to {metadata_path}")
 
 
-def add_prompt_to_metadata(metadata_file='metadata.json'):
+def add_prompt_to_metadata(metadata_file='metadata.json', prompts_dir=PROMPTS_DIR, cache_dir=None):
     """
-    Add prompt to metadata.
+    Add prompt to metadata by joining the metadata with the prompt catalog of all prompt files.
 
     Args:
         metadata_file (str): Name of the JSON file to store metadata.
+        prompts_dir (str): The directory containing the prompt files.
+        cache_dir (str): Optional directory to cache parsed prompt files in.
     """
     with open(metadata_file, 'r', encoding='utf-8') as f:
         metadata_dict = json.load(f)
 
-    for key in metadata_dict:
-        # Look up the prompt for each image
-        if metadata_dict[key]['prompt_group'] == 'bafis_occupations_groups':
-            df = pd.read_csv('../data/bafis_occupations_groups.csv')
-            row = df.loc[df['occupation'] == metadata_dict[key]['occupation']]
-            prompt = row[metadata_dict[key]['language']].values[0]
-        elif metadata_dict[key]['prompt_group'] == 'magbig_occupations_direct':
-            df = pd.read_csv('../data/magbig_occupations_direct.csv')
-            row = df.loc[df['occupation'] == metadata_dict[key]['occupation']]
-            prompt = row[metadata_dict[key]['language']].values[0]
-        elif metadata_dict[key]['prompt_group'] == 'magbig_occupations_direct_feminine':
-            df = pd.read_csv('../data/magbig_occupations_direct_feminine.csv')
-            row = df.loc[df['occupation'] == metadata_dict[key]['occupation']]
-            prompt = row[metadata_dict[key]['language']].values[0]
-        elif metadata_dict[key]['prompt_group'] == 'magbig_occupations_indirect':
-            df = pd.read_csv('../data/magbig_occupations_indirect.csv')
-            row = df.loc[df['occupation'] == metadata_dict[key]['occupation']]
-            prompt = row[metadata_dict[key]['language']].values[0]
-        else :
-            prompt = None
-
-        metadata_dict[key]['prompt'] = prompt
+    catalog = load_prompt_catalog(prompts_dir, cache_dir=cache_dir)
+
+    # Look up the prompt for each image
+    metadata = pd.DataFrame.from_dict(metadata_dict, orient='index')
+    if metadata.empty:
+        return
+    metadata = metadata.drop(columns=['prompt'], errors='ignore')
+    merged = metadata.merge(catalog.frame, how='left', left_on=['prompt_group', 'occupation', 'language'],
+                            right_on=['prompt_group', 'occupation', 'language'])
+    merged.index = metadata.index
+    merged['prompt'] = merged['prompt'].astype(object).where(merged['prompt'].notna(), None)
+
+    metadata_dict = merged.to_dict(orient='index')
 
     with open(metadata_file, 'w', encoding='utf-8') as f:
         json.dump(metadata_dict, f, indent=2, ensure_ascii=False)
@@ -95,9 +182,20 @@ if __name__ == "__main__":
                         help='Path to the directory containing the images')
     parser.add_argument('--target_directory', default='../images_dataset', type=str,
                         help='Path to the directory where the converted images will be saved')
+    parser.add_argument('--prompts_directory', default=PROMPTS_DIR, type=str,
+                        help='Path to the directory containing the prompt files')
+    parser.add_argument('--prompt_cache', default='../cache/prompts', type=str,
+                        help='Directory to cache parsed prompt files in (empty string to disable)')
+    parser.add_argument('--link_mode', default='auto', type=str, choices=LINK_MODES,
+                        help='How to place images in the target directory (auto links if possible, else copies)')
+    parser.add_argument('--workers', default=8, type=int,
+                        help='Number of threads placing images in parallel')
 
     args = parser.parse_args()
 
-    enumerate_dataset(args.source_directory, args.target_directory)
-    add_prompt_to_metadata(metadata_file=os.path.join(args.target_directory, 'metadata.json'))
+    enumerate_dataset(args.source_directory, args.target_directory, link_mode=args.link_mode,
+                      max_workers=args.workers)
+    add_prompt_to_metadata(metadata_file=os.path.join(args.target_directory, 'metadata.json'),
+                           prompts_dir=args.prompts_directory, cache_dir=args.prompt_cache)
+    write_metadata_store(os.path.join(args.target_directory, 'metadata.json'), args.target_directory)
     print("Enumeration complete.")
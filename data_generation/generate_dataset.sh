@@ -3,7 +3,7 @@
 if [ -z "$1" ]; then
   echo "No model specified. Please provide a model as an argument."
   echo "Usage: $0 <model>"
-  echo "Where <model> can be 'dall_e', 'stable_diffusion', or 'midjourney'"
+  echo "Where <model> can be 'dall_e', 'stable_diffusion', 'flux', 'playground' or 'midjourney'"
   exit 1
 fi
 
@@ -17,8 +17,6 @@ echo "Environment variables set:"
 echo "CUDA_VISIBLE_DEVICES=$CUDA_VISIBLE_DEVICES"
 echo "HF_HOME=$HF_HOME"
 
-python "${model}.py"
-python "${model}.py" --language "english"
-python "${model}.py" --data "bafis"
-python "${model}.py" --data "bafis" --language "english"
+# A single call loads the model once and generates every split of both datasets in both languages
+python "${model}.py" --data "magbig" "bafis" --language "german" "english"
 echo "Completed generating dataset for ${model}."
\ No newline at end of file
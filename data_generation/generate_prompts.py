@@ -1,44 +1,88 @@
 #!/usr/bin/env python3
 
 import argparse
+import csv
 import logging
+import os
 import re
+import time
+from functools import lru_cache
 
-import pandas as pd
-import inflect
+from prompt_source import PROMPTS_DIR, PromptSource
 
-logging.basicConfig(
-    filename="../logs/generate_prompts.log",
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
-ENGLISH_TEMPLATE = "A photo of the faces of a group of {occupation}."
-GERMAN_TEMPLATE = "Ein Foto von den Gesichtern einer Gruppe von {occupation}."
+# Templates of group prompts by language. The occupation is the plural of the occupation in the source prompt. Other
+# languages need their own plural rules (see `group_occupations`), so they are not supported.
+GROUP_TEMPLATES = {
+    'en': "A photo of the faces of a group of {occupation}.",
+    'de': "Ein Foto von den Gesichtern einer Gruppe von {occupation}.",
+}
 
+# Phrases which are removed from the prompts of a language for the reduced splits, as regular expressions. The Arabic
+# prompts read "صورة لوجه ..." (a photo of the face of ...), which becomes "صورة ل..." (a photo of ...), and the
+# Chinese prompts name the face with one of several words, e.g. "一张会计脸部的照片" becomes "一张会计的照片".
+REDUCED_PHRASES = {
+    'en': 'of the face ',
+    'ar': 'وجه ',
+    'de': 'vom Gesicht ',
+    'es': 'la cara de ',
+    'fr': 'du visage ',
+    'it': 'del volto ',
+    'ja': 'の顔',
+    'ko': '의 얼굴',
+    'ru': 'лица ',
+    'zh': '脸部|面部|长相|脸',
+}
 
-def extract_occupations(data):
-    """ Extract English and German occupations from the dataset. """
-    eng_occupations = data['occupation'].dropna().unique()
-    sentence_pattern = r"Ein Foto vom Gesicht eines (.*?)\."
-    ger_occupations = [re.match(sentence_pattern, occ).group(1)
-                       if re.match(sentence_pattern, occ) else ''
-                       for occ in data['de']]
-    return eng_occupations, ger_occupations
+# Extracts the German occupation from a direct prompt, e.g. "Buchhalters" from "Ein Foto vom Gesicht eines Buchhalters."
+GERMAN_OCCUPATION_PATTERN = re.compile(r"Ein Foto vom Gesicht eines (.*?)\.")
 
+# Splits to generate, with the split they are generated from and the expansion applied to every prompt
+EXPANSIONS = {
+    'bafis_occupations_groups': {'source': 'magbig_occupations_direct', 'expansion': 'group'},
+    'bafis_occupations_direct': {'source': 'magbig_occupations_direct', 'expansion': 'reduced'},
+    'bafis_occupations_indirect': {'source': 'magbig_occupations_indirect', 'expansion': 'reduced'},
+    'bafis_occupations_direct_feminine': {'source': 'magbig_occupations_direct_feminine', 'expansion': 'reduced'},
+    'bafis_occupations_german_gender_star': {'source': 'magbig_occupations_german_gender_star',
+                                             'expansion': 'reduced'},
+}
 
-def pluralize_english(eng_occupations):
-    """ Pluralize English occupations using the inflect library. """
-    engine = inflect.engine()
-    return [engine.plural(occ) for occ in eng_occupations]
+# Words after which inflect pluralizes an earlier word of an occupation, e.g. "attorneys general" or "chiefs of police"
+COMPOUND_WORDS = {'general', 'of', 'in', 'at', 'to', 'for', 'from', 'on', 'with', 'by', 'de', 'du'}
 
 
+@lru_cache(maxsize=None)
+def inflect_engine():
+    import inflect
+
+    return inflect.engine()
+
+
+@lru_cache(maxsize=None)
+def pluralize_english_word(word):
+    """ Pluralize a single English noun using the inflect library. """
+    return inflect_engine().plural(word)
+
+
+@lru_cache(maxsize=None)
+def pluralize_english(occupation):
+    """
+    Pluralize an English occupation. Occupations are pluralized by their last word, which most occupations of a
+    taxonomy share (e.g. "engineer" or "technician"), so inflect only runs once per distinct word.
+    """
+    words = occupation.split(' ')
+    if len(words) == 1 or COMPOUND_WORDS.intersection(word.lower() for word in words[1:]):
+        return inflect_engine().plural(occupation)
+    return ' '.join(words[:-1] + [pluralize_english_word(words[-1])])
+
+
+@lru_cache(maxsize=None)
 def pluralize_german(occupation):
     """ Pluralize German using a rule-based approach. Manual cleaning afterward is required. """
     if occupation[-1] == 'n':
         return occupation
-    if occupation.endswith("tors") or occupation.endswith("kars") or occupation.endswith("iers") or occupation.endswith("tivs"):
+    if occupation.endswith(("tors", "kars", "iers", "tivs")):
         return occupation[:-1] + "en"
     if occupation[-1] == 's':
         if occupation.endswith("eurs"):
@@ -52,74 +96,161 @@ def pluralize_german(occupation):
     return occupation + "n"
 
 
-def pluralize_occupations(eng_occupations, ger_occupations):
-    """ Pluralize English and German occupations. """
-    eng_plurals = pluralize_english(eng_occupations)
-    ger_plurals = [pluralize_german(occ) for occ in ger_occupations]
-    return eng_plurals, ger_plurals
+def group_occupations(columns, lang):
+    """
+    Return the plural occupations of a language for the group prompts, or None for rows without an occupation.
 
+    Args:
+        columns (dict): The columns of the source split by name, with the English occupations under "occupation".
+        lang (str): The language code.
+    """
+    if lang == 'en':
+        return [pluralize_english(occupation) if occupation else None for occupation in columns['occupation']]
 
-def generate_prompts(data, eng_plurals, ger_plurals):
-    """ Generate English and German prompts based on pluralized occupations. """
-    prompts = {'occupation': [], 'en': [], 'de': []}
-    for occ, eng_pl, ger_pl in zip(data['occupation'], eng_plurals, ger_plurals):
-        prompts['occupation'].append(occ)
-        prompts['en'].append(ENGLISH_TEMPLATE.format(occupation=eng_pl))
-        prompts['de'].append(GERMAN_TEMPLATE.format(occupation=ger_pl))
-    return pd.DataFrame(prompts)
+    plurals = []
+    match = GERMAN_OCCUPATION_PATTERN.match
+    for prompt in columns['de']:
+        found = match(prompt)
+        plurals.append(pluralize_german(found.group(1)) if found and found.group(1) else None)
+    return plurals
 
 
-def generate_reduced_split(data, eng_reduced_str='of the face ', ger_reduced_str='vom Gesicht '):
-    """ Generate reduced prompts for a dataset split. """
-    prompts = {'occupation': [], 'en': [], 'de': []}
-    for occ, eng_prompt, ger_prompt in zip(data['occupation'], data['en'], data['de']):
-        prompts['occupation'].append(occ)
-        prompts['en'].append(eng_prompt.replace(eng_reduced_str, ''))
-        prompts['de'].append(ger_prompt.replace(ger_reduced_str, ''))
-    return pd.DataFrame(prompts)
+def expand_split(columns, expansion, languages):
+    """
+    Generate the prompts of a split from the columns of its source split.
 
+    Args:
+        columns (dict): The columns of the source split by name: "occupation" and one column per language code.
+        expansion (str): "group" for group prompts or "reduced" for prompts without the face phrase.
+        languages (list): The language codes to generate. Languages which are missing in the source split are
+            skipped.
 
-def generate_language_reduced_split(data, lang='de', reduced_str='vom Gesicht '):
-    """ Generate reduced prompts for a language for a dataset split. """
-    prompts = {'occupation': [], lang: []}
-    for occ, prompt in zip(data['occupation'], data[lang]):
-        prompts['occupation'].append(occ)
-        prompts[lang].append(prompt.replace(reduced_str, ''))
-    return pd.DataFrame(prompts)
+    Returns:
+        dict: The columns of the generated split: "occupation" and one column per generated language.
+    """
+    expanded = {'occupation': columns['occupation']}
+    for lang in languages:
+        if lang not in columns:
+            continue
 
+        if expansion == 'group':
+            template = GROUP_TEMPLATES[lang]
+            prompts = [template.format(occupation=plural) if plural else ''
+                       for plural in group_occupations(columns, lang)]
+            missing = prompts.count('')
+            if missing:
+                logger.warning(f"Could not extract {missing} {lang} occupations for group prompts")
+        else:
+            phrase = re.compile(REDUCED_PHRASES[lang])
+            prompts = [phrase.sub('', prompt) for prompt in columns[lang]]
 
-def main():
-    if args.groups:
-        csv = pd.read_csv("../data/magbig_occupations_direct.csv")
-        eng_occupations, ger_occupations = extract_occupations(csv)
-        eng_plurals, ger_plurals = pluralize_occupations(eng_occupations, ger_occupations)
+        expanded[lang] = prompts
+    return expanded
 
-        generate_prompts(csv, eng_plurals, ger_plurals).to_csv("../data/bafis_occupations_groups.csv", index=False)
-        print("Prompts generated and saved successfully.")
 
-    elif args.reduced:
-        direct_csv = pd.read_csv("../data/magbig_occupations_direct.csv")
-        generate_reduced_split(direct_csv).to_csv("../data/bafis_occupations_direct.csv", index=False)
+def check_languages(splits, languages):
+    """ Raise a ValueError if a split cannot be generated in one of the languages, before any file is written. """
+    rules = {'group': GROUP_TEMPLATES, 'reduced': REDUCED_PHRASES}
+    for split in splits:
+        supported = rules[EXPANSIONS[split]['expansion']]
+        unsupported = [lang for lang in languages if lang not in supported]
+        if unsupported:
+            raise ValueError(f"Cannot generate {split} in {', '.join(unsupported)}: supported languages are "
+                             f"{', '.join(sorted(supported))}")
+
+
+def write_columns(path, columns):
+    """ Write columns to a prompt file. """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(zip(*columns.values()))
+    os.replace(temp_path, path)
 
-        indirect_csv = pd.read_csv("../data/magbig_occupations_indirect.csv")
-        generate_reduced_split(indirect_csv).to_csv("../data/bafis_occupations_indirect.csv", index=False)
 
-        fem_csv = pd.read_csv("../data/magbig_occupations_direct_feminine.csv")
-        generate_language_reduced_split(fem_csv).to_csv("../data/bafis_occupations_direct_feminine.csv", index=False)
+def generate_splits(splits, languages, prompts_dir=PROMPTS_DIR, output_dir=None):
+    """
+    Generate the prompt files of several splits in all languages in one pass. Every source split is read once, and
+    every split is generated column by column.
 
-        ger_csv = pd.read_csv("../data/magbig_occupations_german_gender_star.csv")
-        generate_language_reduced_split(ger_csv).to_csv("../data/bafis_occupations_german_gender_star.csv", index=False)
-        print("Reduced prompts generated and saved successfully.")
+    Args:
+        splits (list): The splits to generate, keys of EXPANSIONS.
+        languages (list): The language codes to generate.
+        prompts_dir (str): The directory containing the source prompt files.
+        output_dir (str): The directory to write the generated prompt files to. Defaults to prompts_dir.
+
+    Returns:
+        dict: The columns of every generated split.
+
+    Raises:
+        ValueError: If a split has no template or phrase for one of the languages (see `check_languages`).
+    """
+    check_languages(splits, languages)
+    source = PromptSource(prompts_dir)
+    available = set(source.splits())
+    output_dir = output_dir or prompts_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    generated = {}
+    for split in splits:
+        source_split = EXPANSIONS[split]['source']
+        if source_split not in available:
+            logger.error(f"Source prompts {source_split} for {split} not found in {prompts_dir}")
+            print(f"Skipping {split}: source prompts {source_split} not found.")
+            continue
+
+        parsed = source.read(source_split)
+        values = list(zip(*parsed['rows'])) if parsed['rows'] else [[] for _ in range(len(parsed['languages']) + 1)]
+        columns = dict(zip(['occupation'] + parsed['languages'], map(list, values)))
+
+        generated[split] = expand_split(columns, EXPANSIONS[split]['expansion'], languages)
+        write_columns(os.path.join(output_dir, f"{split}.csv"), generated[split])
+    return generated
+
+
+def main():
+    if args.groups and args.reduced:
+        splits = list(EXPANSIONS)
+    elif args.groups:
+        splits = ['bafis_occupations_groups']
+    elif args.reduced:
+        splits = [split for split in EXPANSIONS if EXPANSIONS[split]['expansion'] == 'reduced']
     else:
-        print("No action taken. Please specify either --groups or --reduced.")
+        splits = args.splits
+
+    if not splits:
+        print("No action taken. Please specify either --groups, --reduced or --splits.")
+        return
+
+    start_time = time.perf_counter()
+    generated = generate_splits(splits, args.languages, args.prompts_directory, args.output_directory)
+    prompt_count = sum(len(columns['occupation']) * (len(columns) - 1) for columns in generated.values())
+    print(f"Generated {prompt_count} prompts in {len(generated)} splits in {time.perf_counter() - start_time:.2f}s.")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        filename="../logs/generate_prompts.log",
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
     parser = argparse.ArgumentParser(description='Generate additional prompts using MAGBIG.')
     parser.add_argument('--groups', action='store_true',
                         help='Generate group prompts for every occupation.')
     parser.add_argument('--reduced', action='store_true',
                         help='Generate reduced prompts for every dataset split.')
+    parser.add_argument('--splits', default=None, type=str, nargs='+', choices=sorted(EXPANSIONS),
+                        help='Generate these splits.')
+    parser.add_argument('--languages', default=['en', 'de'], type=str, nargs='+',
+                        help='Language codes to generate prompts in, e.g. en ar de es fr it ja ko ru zh (group prompts '
+                             'only in en de)')
+    parser.add_argument('--prompts_directory', default=PROMPTS_DIR, type=str,
+                        help='Path to the directory containing the MAGBIG prompt files')
+    parser.add_argument('--output_directory', default=None, type=str,
+                        help='Path to the directory to save the generated prompt files to (default: the prompts '
+                             'directory)')
 
     args = parser.parse_args()
     main()
@@ -0,0 +1,101 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+# Encoder options of the supported image formats
+IMAGE_FORMATS = {
+    'png': {'format': 'PNG'},
+    'webp': {'format': 'WEBP', 'quality': 95},
+}
+
+
+class ImageWriter:
+    """
+    Encode and save images on a thread pool while the caller keeps generating.
+
+    At most `max_pending` images are queued or being encoded at a time; `submit` blocks while the queue is full
+    (backpressure). The result of every save is reported back to the caller through `poll`. With `max_workers=0`
+    images are saved synchronously in `submit`.
+    """
+
+    def __init__(self, max_workers=2, max_pending=8, image_format='png'):
+        self.options = IMAGE_FORMATS[image_format]
+        self.extension = image_format
+        self.executor = ThreadPoolExecutor(max_workers) if max_workers > 0 else None
+        self.max_pending = max(max_pending, 1)
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.results = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _save(self, image, path, key):
+        # Encode to a temporary file and rename it, so an interrupted save never leaves a partial image under its name
+        temp_path = path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with metrics.timer('save'):
+                image.save(temp_path, **self.options)
+            os.replace(temp_path, path)
+            self.results.put((key, None))
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.results.put((key, e))
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def submit(self, image, path, key=None):
+        """
+        Queue an image to be saved.
+
+        Args:
+        image (PIL.Image.Image): The image to save.
+
+        path (str): The path to save the image to. Missing directories are created.
+
+        key: An identifier of the image which is reported back by `poll`.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending < self.max_pending)
+            self.pending += 1
+
+        if self.executor is None:
+            self._save(image, path, key)
+        else:
+            self.executor.submit(self._save, image, path, key)
+
+    def poll(self):
+        """
+        Return the results of all saves finished since the last call.
+
+        Returns:
+        list: A list of (key, error) tuples, where error is None if the image was saved.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def flush(self):
+        """ Wait until all queued images are saved and return their results (see `poll`). """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+        return self.poll()
+
+    def close(self):
+        """ Wait for all queued images and shut down the thread pool. """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,83 @@
+import logging
+import os
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Map prompt languages to column names in the prompt files
+LANGUAGE_CODES = {
+    'english': 'en',
+    'german': 'de',
+}
+
+# A single prompt of a dataset split in one language and the (zero based) indices of the images to generate for it
+PromptJob = namedtuple('PromptJob', ['split', 'lang', 'occupation', 'prompt', 'indices'])
+
+
+def build_jobs(records, num_images):
+    """
+    Build the list of prompts to generate images for.
+
+    Args:
+    records (iterable): The PromptRecord tuples to prompt with (see `prompt_source.PromptSource.records`).
+
+    num_images (int): The number of images to generate per prompt.
+
+    Returns:
+    list: A list of PromptJob tuples, in the order of the records.
+    """
+    indices = tuple(range(num_images))
+    return [PromptJob(record.split, record.language, record.occupation, record.prompt, indices) for record in records]
+
+
+def image_directory(image_dir, job, folder):
+    """ Return the `occ/model/split/lang` directory of a job's images. """
+    return os.path.join(os.curdir, image_dir, job.occupation, folder, job.split, job.lang)
+
+
+def image_name(prompt, index, extension='png'):
+    """ Return the file name of the image with the (zero based) index generated for a prompt. """
+    return prompt.replace(" ", "_").replace(",", "").replace(".", "") + f"_{index + 1}.{extension}"
+
+
+def shard_bounds(total, shard_index, num_shards):
+    """ Return the [start, end) range of a shard when splitting `total` items into `num_shards` contiguous shards. """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} is out of range for {num_shards} shards")
+    return total * shard_index // num_shards, total * (shard_index + 1) // num_shards
+
+
+def shard_jobs(jobs, shard_index, num_shards, keep_order=False):
+    """
+    Select the images of one shard from the full work list.
+
+    The work list is expanded to single (split, language, occupation, image) units and sorted, so every worker
+    computes the same order regardless of file system listing order. Each shard gets a contiguous range of units, so
+    shard sizes differ by at most one image and images of a prompt mostly stay in the same shard.
+
+    Args:
+    jobs (list): The full list of PromptJob tuples. Every worker must be started with the same splits and languages.
+
+    shard_index (int): The index of this shard, between 0 and num_shards - 1.
+
+    num_shards (int): The total number of shards.
+
+    keep_order (bool): Whether to slice the work list in the given order instead of sorting it, e.g. for the jobs of
+    a plan file, which is ordered by priority or cost and identical for every worker.
+
+    Returns:
+    list: The PromptJob tuples of the shard, with only the image indices belonging to it.
+    """
+    if num_shards == 1:
+        return jobs
+
+    units = [(job, i) for job in (jobs if keep_order else sorted(jobs)) for i in job.indices]
+    start, end = shard_bounds(len(units), shard_index, num_shards)
+
+    sharded = []
+    for job, i in units[start:end]:
+        if sharded and sharded[-1][0] == job:
+            sharded[-1][1].append(i)
+        else:
+            sharded.append((job, [i]))
+    return [job._replace(indices=tuple(indices)) for job, indices in sharded]
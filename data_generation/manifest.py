@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import re
+from collections import Counter
+
+from PIL import Image
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Matches the image index suffix of a generated image, e.g. "A_photo_of_an_accountant_3.png"
+IMAGE_INDEX_PATTERN = re.compile(r"_(\d{1,9})\.(?:png|webp)$")
+
+# Matches the copies saved by the original DALL-E script, which appended the unix time instead of an index, e.g.
+# "A_photo_of_an_accountant_1718000000.png". Its first image has no suffix at all.
+LEGACY_COPY_PATTERN = re.compile(r"^(.*)_(\d{10})\.png$")
+
+IMAGE_EXTENSIONS = ('.png', '.webp')
+
+
+def is_complete_image(path):
+    """ Return whether a file is a non-empty image which can be decoded, so partially saved files are not counted. """
+    try:
+        if os.path.getsize(path) == 0:
+            return False
+        with Image.open(path) as img:
+            # Verifying checks all PNG chunks without decoding; other formats have to be decoded
+            img.verify() if img.format == 'PNG' else img.load()
+        return True
+    except Exception:
+        return False
+
+
+def existing_indices(directory, files):
+    """
+    Return the (zero based) indices of the complete images of a `occ/model/split/lang` directory.
+
+    Images named by `jobs.image_name` carry their index. Images of the original DALL-E script are named after the
+    prompt, plus the unix time for all but the first one; they take the lowest indices not used by indexed images.
+    Leftovers of interrupted saves (`.tmp`, `.part`) and empty or undecodable images are ignored.
+    """
+    indices = set()
+    legacy_copies = set()
+    candidates = []
+    for file in sorted(files):
+        if not file.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        if not is_complete_image(os.path.join(directory, file)):
+            logger.warning(f"Ignoring incomplete image {os.path.join(directory, file)}")
+            continue
+        copy = LEGACY_COPY_PATTERN.match(file)
+        if copy:
+            legacy_copies.add(copy.group(1))
+        candidates.append((file, copy))
+
+    legacy = 0
+    for file, copy in candidates:
+        match = IMAGE_INDEX_PATTERN.search(file)
+        if copy or os.path.splitext(file)[0] in legacy_copies or not match:
+            legacy += 1
+        else:
+            indices.add(int(match.group(1)) - 1)
+
+    index = 0
+    for _ in range(legacy):
+        while index in indices:
+            index += 1
+        indices.add(index)
+    return indices
+
+
+class CompletionManifest:
+    """
+    Persistent record of completed (model, split, language, occupation, image index) units.
+
+    The manifest is an append-only JSON lines file, so units completed before a crash are never lost. All completed
+    units are kept in a set, which makes checking a unit O(1).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.completed.add(tuple(json.loads(line)))
+            logger.info(f"Loaded {len(self.completed)} completed images from {path}")
+
+    @staticmethod
+    def key(folder, job, index):
+        """ Return the unit key of the image with the given index generated for a job. """
+        return folder, job.split, job.lang, job.occupation, index
+
+    def __contains__(self, key):
+        return key in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def add(self, key):
+        """ Record a completed unit. """
+        if key in self.completed:
+            return
+        self.completed.add(key)
+        metrics.increment('images_saved')
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(key, ensure_ascii=False) + "\n")
+
+    def add_existing(self, image_dir, folder):
+        """
+        Index images of a model which already exist in the `occ/model/split/lang` image tree, e.g. from runs before the
+        manifest was introduced. The units are only kept in memory. Only complete images are indexed (see
+        `existing_indices`).
+
+        Args:
+        image_dir (str): The directory the images are saved in.
+
+        folder (str): The model folder name of the backend.
+        """
+        found = 0
+        if not os.path.isdir(image_dir):
+            return found
+
+        for occ in os.listdir(image_dir):
+            model_dir = os.path.join(image_dir, occ, folder)
+            if not os.path.isdir(model_dir):
+                continue
+            for root, _, files in os.walk(model_dir):
+                parts = os.path.relpath(root, model_dir).split(os.sep)
+                if len(parts) != 2:
+                    continue
+                split, lang = parts
+                for index in existing_indices(root, files):
+                    self.completed.add((folder, split, lang, occ, index))
+                    found += 1
+
+        logger.info(f"Indexed {found} existing images of {folder} in {image_dir}")
+        return found
+
+
+def filter_completed(jobs, manifest, folder):
+    """
+    Remove completed images from the jobs.
+
+    Args:
+    jobs (list): A list of PromptJob tuples.
+
+    manifest (CompletionManifest): The manifest of completed units.
+
+    folder (str): The model folder name of the backend.
+
+    Returns:
+    tuple: The jobs with only the pending image indices (jobs without pending images are dropped) and a Counter of
+    skipped images per (split, lang).
+    """
+    pending = []
+    skipped = Counter()
+    for job in jobs:
+        indices = tuple(i for i in job.indices if CompletionManifest.key(folder, job, i) not in manifest)
+        skipped[(job.split, job.lang)] += len(job.indices) - len(indices)
+        if indices:
+            pending.append(job._replace(indices=indices))
+    return pending, skipped
+
+
+def print_skip_summary(skipped, pending):
+    """ Print a summary of the skipped images per split and language and the remaining work. """
+    total = sum(skipped.values())
+    if total:
+        print(f"\nSkipping {total} already generated images:")
+        for (split, lang), count in sorted(skipped.items()):
+            if count:
+                print(f"  {split} [{lang}]: {count}")
+    print(f"\n{sum(len(job.indices) for job in pending)} images in {len(pending)} prompts left to generate")
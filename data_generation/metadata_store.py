@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+METADATA_TABLE = 'metadata.parquet'
+GROUPS_TABLE = 'metadata_groups.parquet'
+
+# Categorical metadata columns, which are dictionary encoded and have precomputed group indexes
+GROUP_COLUMNS = ['occupation', 'model', 'prompt_group', 'language']
+
+
+def write_metadata_store(metadata_file, store_dir, row_group_size=4096):
+    """
+    Write the metadata of an enumerated dataset to a columnar store.
+
+    The store consists of a Parquet table with one row per image, sorted by image id, with dictionary encoded
+    categorical columns, and a Parquet table with the sorted image ids of every value of each categorical column.
+
+    Args:
+        metadata_file (str): The metadata JSON file written by `generate_dataset.enumerate_dataset`.
+        store_dir (str): The directory to write the store to.
+        row_group_size (int): The number of rows per Parquet row group.
+    """
+    with open(metadata_file, 'r', encoding='utf-8') as f:
+        metadata_dict = json.load(f)
+
+    ids = np.array(sorted(int(key) for key in metadata_dict), dtype=np.int32)
+    records = [metadata_dict[str(image_id)] for image_id in ids]
+
+    columns = {'id': pa.array(ids)}
+    for column in GROUP_COLUMNS:
+        columns[column] = pa.array([record.get(column) for record in records], pa.string()).dictionary_encode()
+    columns['prompt'] = pa.array([record.get('prompt') for record in records], pa.string())
+    table = pa.table(columns)
+
+    os.makedirs(store_dir, exist_ok=True)
+    pq.write_table(table, os.path.join(store_dir, METADATA_TABLE), row_group_size=row_group_size)
+
+    # Precompute the image ids of every value of the categorical columns
+    group_columns, group_values, group_ids = [], [], []
+    for column in GROUP_COLUMNS:
+        encoded = table[column].combine_chunks()
+        indices = encoded.indices.to_numpy(zero_copy_only=False)
+        order = np.argsort(indices, kind='stable')
+        boundaries = np.searchsorted(indices[order], np.arange(len(encoded.dictionary) + 1))
+        for code, value in enumerate(encoded.dictionary.to_pylist()):
+            group_columns.append(column)
+            group_values.append(value)
+            group_ids.append(ids[order[boundaries[code]:boundaries[code + 1]]])
+
+    groups = pa.table({
+        'column': pa.array(group_columns, pa.string()).dictionary_encode(),
+        'value': pa.array(group_values, pa.string()),
+        'ids': pa.array(group_ids, pa.list_(pa.int32())),
+    })
+    pq.write_table(groups, os.path.join(store_dir, GROUPS_TABLE))
+
+    print(f"Metadata store with {len(ids)} images saved to {store_dir}")
+
+
+class MetadataStore:
+    """
+    Read-only query API of a columnar metadata store.
+
+    Queries on categorical columns are answered from the precomputed group indexes without reading the metadata
+    table. Queries on other columns are pushed down to the Parquet reader, which skips row groups by their statistics.
+
+    Args:
+        store_dir (str): The directory of the store (see `write_metadata_store`).
+    """
+
+    def __init__(self, store_dir):
+        self.path = os.path.join(store_dir, METADATA_TABLE)
+        self.groups = {}
+
+        groups = pq.read_table(os.path.join(store_dir, GROUPS_TABLE))
+        for column, value, ids in zip(groups['column'].to_pylist(), groups['value'].to_pylist(),
+                                      groups['ids'].to_pylist()):
+            self.groups[(column, value)] = np.array(ids, dtype=np.int32)
+
+    def values(self, column):
+        """ Return the distinct values of a categorical column. """
+        return sorted(value for group_column, value in self.groups if group_column == column)
+
+    def query(self, **filters):
+        """
+        Return the ids of all images matching the filters, e.g. `query(model='flux-1-dev', language='de',
+        occupation='nurse')`. A filter value can be a single value or a list of values.
+
+        Returns:
+            np.ndarray: The sorted image ids.
+        """
+        indexed = {column: value for column, value in filters.items() if column in GROUP_COLUMNS}
+        other = {column: value for column, value in filters.items() if column not in GROUP_COLUMNS}
+
+        ids = None
+        for column, value in indexed.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            matches = [self.groups.get((column, v), np.empty(0, dtype=np.int32)) for v in values]
+            column_ids = np.unique(np.concatenate(matches)) if len(matches) > 1 else matches[0]
+            ids = column_ids if ids is None else np.intersect1d(ids, column_ids, assume_unique=True)
+
+        if other or ids is None:
+            pushed = [(column, 'in', list(value) if isinstance(value, (list, tuple, set)) else [value])
+                      for column, value in other.items()]
+            table = pq.read_table(self.path, columns=['id'], filters=pushed or None)
+            column_ids = table['id'].to_numpy()
+            ids = column_ids if ids is None else np.intersect1d(ids, column_ids, assume_unique=True)
+
+        return ids
+
+    def read(self, ids=None, columns=None):
+        """
+        Read the metadata of images.
+
+        Args:
+            ids (array-like): The image ids to read. If None, all images are read.
+            columns (list): The columns to read. If None, all columns are read.
+
+        Returns:
+            pyarrow.Table: The metadata table.
+        """
+        table = pq.read_table(self.path, columns=columns if columns is None or 'id' in columns else ['id'] + columns)
+        if ids is not None:
+            table = table.filter(pc.is_in(table['id'], value_set=pa.array(np.asarray(ids, dtype=np.int32))))
+        return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the image ids of an enumerated dataset by its metadata.')
+    parser.add_argument('--dataset_directory', default='../images_dataset', type=str,
+                        help='Path to the directory containing the metadata store')
+    for group_column in GROUP_COLUMNS:
+        parser.add_argument(f'--{group_column}', default=None, type=str, nargs='+',
+                            help=f'Only images with one of these {group_column} values')
+
+    args = parser.parse_args()
+
+    store = MetadataStore(args.dataset_directory)
+    query = {column: getattr(args, column) for column in GROUP_COLUMNS if getattr(args, column)}
+    matching_ids = store.query(**query)
+    print(f"{len(matching_ids)} images")
+    print(" ".join(str(image_id) for image_id in matching_ids))
@@ -0,0 +1,196 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Number of recent observations per timing kept for percentiles
+WINDOW_SIZE = 1024
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class Timing:
+    """ Count, sum and extremes of all observations of a stage, and a window of the most recent ones. """
+
+    __slots__ = ['count', 'total', 'min', 'max', 'window', 'position']
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.window = []
+        self.position = 0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        if len(self.window) < WINDOW_SIZE:
+            self.window.append(seconds)
+        else:
+            self.window[self.position] = seconds
+            self.position = (self.position + 1) % WINDOW_SIZE
+
+    def quantiles(self):
+        ordered = sorted(self.window)
+        return {q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] for q in QUANTILES} if ordered else {}
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'min': round(self.min, 6) if self.count else None,
+            'max': round(self.max, 6),
+            **{f"p{int(q * 100)}": round(value, 6) for q, value in self.quantiles().items()},
+        }
+
+
+class Metrics:
+    """
+    Per-stage timings and counters of a generation run.
+
+    Recording an observation takes a lock and a few arithmetic operations, so stages can be timed in hot loops. When
+    a progress total is set, every saved image updates a progress line with the measured throughput and the ETA, and
+    the metrics are exported to `export_dir` at most every `export_interval` seconds: `metrics.jsonl` gets a snapshot
+    per export, and `bafis.prom` is rewritten for the Prometheus node exporter textfile collector.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.labels = {}
+        self.started = time.time()
+        self.progress_total = None
+        self.progress_counter = 'images_saved'
+        self.export_dir = None
+        self.export_interval = 15
+        self.last_progress = 0
+        self.last_export = 0
+        self.first_progress = None
+
+    def start(self, labels=None, progress_total=None, export_dir=None, export_interval=15):
+        """ Reset the metrics and start reporting a run. """
+        with self.lock:
+            self.counters, self.timings = {}, {}
+        self.labels = dict(labels or {})
+        self.started = time.time()
+        self.progress_total = progress_total
+        self.export_dir = export_dir or None
+        self.export_interval = export_interval
+        self.last_progress = self.last_export = time.monotonic()
+        self.first_progress = None
+
+    def increment(self, name, value=1):
+        """ Add to a counter. """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if name == self.progress_counter and self.progress_total:
+            if self.first_progress is None:
+                self.first_progress = (time.time(), self.counters[name])
+            self.report()
+
+    def observe(self, name, seconds):
+        """ Record the duration of a stage in seconds. """
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """ Time the enclosed block as an observation of a stage. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """ Decorator which times every call of a function as an observation of a stage. """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """ Return the current counters and timing summaries. """
+        with self.lock:
+            return {
+                'time': time.time(),
+                'elapsed': round(time.time() - self.started, 3),
+                'labels': self.labels,
+                'counters': dict(self.counters),
+                'timings': {name: timing.summary() for name, timing in self.timings.items()},
+            }
+
+    def progress_line(self):
+        """ Return a progress line with the throughput and the ETA of the run. """
+        done = self.counters.get(self.progress_counter, 0)
+        # Measure the throughput from the first finished image on, so loading the model does not count
+        rate = 0
+        if self.first_progress is not None and done > self.first_progress[1]:
+            rate = (done - self.first_progress[1]) / max(time.time() - self.first_progress[0], 1e-9)
+        line = f"{done}/{self.progress_total} images ({100 * done / self.progress_total:.0f}%), {rate:.2f} images/s"
+        if rate > 0:
+            remaining = max(self.progress_total - done, 0) / rate
+            line += f", ETA {int(remaining // 3600)}h{int(remaining % 3600 // 60):02d}m{int(remaining % 60):02d}s"
+        return line
+
+    def report(self, final=False):
+        """ Update the progress line and export the metrics if their intervals have passed. """
+        now = time.monotonic()
+        interactive = sys.stderr.isatty()
+        if final or now - self.last_progress >= (1 if interactive else 30):
+            self.last_progress = now
+            end = "\n" if final or not interactive else ""
+            print(("\r" if interactive else "") + self.progress_line(), end=end, file=sys.stderr, flush=True)
+        if self.export_dir and (final or now - self.last_export >= self.export_interval):
+            self.last_export = now
+            self.export()
+
+    def export(self):
+        """ Append a snapshot to metrics.jsonl and rewrite the Prometheus textfile in the export directory. """
+        snapshot = self.snapshot()
+        os.makedirs(self.export_dir, exist_ok=True)
+        with open(os.path.join(self.export_dir, 'metrics.jsonl'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+
+        labels = ",".join(f'{key}="{value}"' for key, value in sorted(snapshot['labels'].items()))
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE bafis_{name}_total counter")
+            lines.append(f"bafis_{name}_total{{{labels}}} {value}")
+        for name, summary in sorted(snapshot['timings'].items()):
+            lines.append(f"# TYPE bafis_{name}_seconds summary")
+            for q in QUANTILES:
+                if f"p{int(q * 100)}" in summary:
+                    quantile_labels = ",".join(filter(None, [labels, f'quantile="{q}"']))
+                    lines.append(f"bafis_{name}_seconds{{{quantile_labels}}} {summary[f'p{int(q * 100)}']}")
+            lines.append(f"bafis_{name}_seconds_sum{{{labels}}} {summary['sum']}")
+            lines.append(f"bafis_{name}_seconds_count{{{labels}}} {summary['count']}")
+
+        path = os.path.join(self.export_dir, 'bafis.prom')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + '.tmp', path)
+
+    def finish(self):
+        """ Print the final progress line and export the final metrics. """
+        if self.progress_total:
+            self.report(final=True)
+        elif self.export_dir:
+            self.export()
+
+
+# The metrics of the current process, shared by all modules
+metrics = Metrics()
@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
 
 import logging
-import os
-import argparse
-import time
 
 from midjourney_api import MidjourneyAPI
-from utils import load_dataset
+from midjourney_gateway import GatewayListener
+from engine import build_parser, run
+from midjourney_jobs import DONE, MidjourneyPipeline
 
 logging.basicConfig(
     filename="../logs/midjourney.log",
@@ -16,97 +15,58 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def generate_images(dataset_map, model_name, image_dir, language, num_images):
-    """
-    Generate images for each prompt in the dataset using the specified model, language, and number of images and save
-    them to the image directory.
-
-    Args:
-    dataset_map (dict): A dictionary with keys as filenames and values as pandas DataFrames.
+def load_model(backend):
+    """ Initialize the Midjourney API. """
+    return MidjourneyAPI()
 
-    model_name (str): The name of the model to use for image generation.
 
-    image_dir (str): The directory to save the images to.
-
-    language (str): The language to prompt in. Can be "english" or "german", except for the splits "direct_feminine"
-    and "german_gender_star", which are only available in German.
-
-    num_images (int): The number of images to generate per prompt.
+def generate_images(jobs, api, backend, image_dir, manifest, writer, batch_size=1):
     """
-    # Map language to column name in the dataset
-    lang = "de" if language == "german" else "en"
-
-    # Initialize the API
-    api = MidjourneyAPI()
+    Generate images for each prompt job using Midjourney and save them to the image directory.
 
-    for file, data in dataset_map.items():
-        split = file.split(".")[0]
+    Up to `backend['concurrency']` prompts are in flight at a time. The pending images of each prompt are upscaled
+    from its image grid and downloaded as soon as the grid is ready. If `backend['gateway']` is set, new messages are
+    received from the Discord gateway instead of polling the channel.
 
-        occupations = data['occupation']
-
-        if lang not in data:
-            logger.error(f"Language {lang} not found in {file}")
-            continue
-        prompts = data[lang]
-
-        for occ, prompt in zip(occupations, prompts):
-            response = api.imagine(prompt)
-            if response is None:
-                logger.error(f"Failed to generate image for {occ}")
-                continue
-            time.sleep(50)
-
-            try:
-                api.upscale_images(num_images)
-            except Exception as e:
-                logger.error(f"Failed to upscale images for {occ}: {str(e)}")
-                continue
-            time.sleep(2)
+    Args:
+    jobs (list): A list of PromptJob tuples to generate images for.
 
-            # Create a directory for the generated images
-            path = os.path.join(os.curdir, image_dir, occ, model_name, split, lang)
-            if not os.path.exists(path):
-                os.makedirs(path)
+    api (MidjourneyAPI): The Midjourney API to use for image generation.
 
-            download_path = str(os.path.join(image_dir, occ, model_name, split, lang))
-            try:
-                api.download_images(download_path)
-            except Exception as e:
-                logger.error(f"Failed to download images for {occ}: {str(e)}")
-                continue
-            time.sleep(2)
+    backend (dict): The backend configuration (see `backends.BACKENDS`).
 
+    image_dir (str): The directory to save the images to.
 
-def main(args):
-    data = load_dataset(args.data, args.split, args.test, args.seed)
+    manifest (CompletionManifest): The manifest to record every saved image in.
 
-    # Pretty print the data frame
-    for file, df in data.items():
-        print(f"\nData from {file}:")
-        print(df.head())
+    writer (ImageWriter): Unused, the downloaded images are saved as they are.
 
-    generate_images(data, args.model, args.dest, args.language, args.num_images)
+    batch_size (int): Unused, Midjourney generates one prompt per job.
+    """
+    def on_done(job):
+        if job.state == DONE:
+            for i in job.job.indices:
+                manifest.add(manifest.key(backend['folder'], job.job, i))
+        else:
+            logger.error(f"Failed to generate images for {job.job.occupation} with prompt {job.job.prompt}")
+
+    gateway = None
+    if backend['gateway']:
+        gateway = GatewayListener(api.authorization, api.channel_id).start()
+
+    pipeline = MidjourneyPipeline(api, backend, image_dir, on_done, max_concurrent=backend['concurrency'],
+                                  poll_interval=backend['poll_interval'], timeout=backend['timeout'],
+                                  gateway=gateway, fallback_interval=backend['fallback_interval'])
+    try:
+        pipeline.run(jobs)
+    finally:
+        if gateway is not None:
+            gateway.stop()
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Generate images using Midjourney v6.1.')
-    parser.add_argument('--model', default='midjourney-v6-1', type=str,
-                        help='Which model to evaluate')
-    parser.add_argument('--data', default='magbig', type=str,
-                        help='Which dataset to use')
-    parser.add_argument('--split', default=None, type=str,
-                        help='Which split of the dataset to use')
-    parser.add_argument('--language', default='german', type=str,
-                        choices=['english', 'german'],
-                        help='What languages to prompt in')
-    parser.add_argument('--num_images', default=4, type=int,
-                        help='How many images to generate per prompt')
-    parser.add_argument('--dest', default="../images", type=str,
-                        help='What folder to save images in')
-    parser.add_argument('--test', default=False, type=bool,
-                        help='Whether to test the dataset or not')
-    parser.add_argument('--seed', default=42, type=int,
-                        help='Random seed for reproducibility')
+    parser = build_parser('Generate images using Midjourney v6.1.', backend='midjourney')
+    parser.set_defaults(model='midjourney-v6-1')
 
     arguments = parser.parse_args()
-    main(arguments)
+    run(arguments)
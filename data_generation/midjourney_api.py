@@ -3,12 +3,14 @@
 import argparse
 import logging
 import os
-import time
-import backoff
 import requests
 
 from dotenv import load_dotenv
 
+from jobs import PromptJob
+from metrics import metrics
+from midjourney_jobs import DONE, MidjourneyPipeline
+
 logging.basicConfig(
     filename="../logs/midjourney_api.log",
     level=logging.INFO,
@@ -28,27 +30,42 @@ class MidjourneyAPI:
         self.session_id = os.getenv('MIDJOURNEY_SESSION_ID')
         self.data_version = os.getenv('MIDJOURNEY_DATA_VERSION')
         self.data_id = os.getenv('MIDJOURNEY_DATA_ID')
-        self.download_queue = 0
+        # Can be pointed at a local fake of the Discord API for testing
+        self.api_base = os.getenv('MIDJOURNEY_API_BASE', "https://discord.com/api/v9").rstrip("/")
         self.logger = logging.getLogger(__name__)
 
-    def imagine(self, prompt):
+    @property
+    def headers(self):
+        return {
+            "Authorization": self.authorization,
+            "Content-Type": "application/json",
+        }
+
+    @metrics.timed('midjourney_imagine')
+    def imagine(self, prompt, nonce=None):
         """
         Sends a prompt to the Midjourney bot to generate an image.
 
         Args:
             prompt (str): The prompt to send to the bot.
+            nonce (str): An optional nonce to identify the interaction.
 
         Returns:
             requests.models.Response: The response from the API.
+
+        Raises:
+            requests.RequestException: If the request fails, e.g. because of a connection error or a timeout.
         """
+        nonce_field = {"nonce": nonce} if nonce else {}
         try:
             return requests.post(
-                "https://discord.com/api/v9/interactions",
+                f"{self.api_base}/interactions",
                 headers={
                     "Authorization": self.authorization,
                     "Content-Type": "application/json",
                 },
                 json={
+                    **nonce_field,
                     "type": 2,
                     "application_id": self.application_id,
                     "guild_id": self.guild_id,
@@ -92,134 +109,71 @@ class MidjourneyAPI:
                         },
                         "attachments": []
                     }
-                }
+                },
+                timeout=30
             )
         except requests.exceptions.HTTPError as err:
             self.logger.info(err)
 
-    @backoff.on_exception(backoff.expo, ValueError, max_time=300)
-    def upscale_images(self, n=4):
+    @metrics.timed('midjourney_get_messages')
+    def get_messages(self, limit=50):
         """
-        Upscale a number of images from the last prompt generated by the Midjourney bot.
-        This function uses an exponential backoff strategy to retry the request if an error occurs.
+        Get the most recent messages of the channel.
 
         Args:
-            n (int): The number of images to upscale.
-        """
-        try:
-            response = requests.get(
-                f"https://discord.com/api/v9/channels/{self.channel_id}/messages?limit=1",
-                headers={
-                    "Authorization": self.authorization,
-                    "Content-Type": "application/json",
-                }
-            )
+            limit (int): The number of messages to get (at most 100).
 
-            # Get the most recent message id
-            messages = response.json()
-            most_recent_message_id = messages[0]['id']
-
-            # Get the custom_ids of n buttons to upscale the images
-            components = messages[0]['components'][0]['components']
-            buttons = [comp for comp in components if comp.get('label') in ['U1', 'U2', 'U3', 'U4']]
-            custom_ids = [button['custom_id'] for button in buttons]
-
-            # Raise an error if the image generation is not complete
-            if not custom_ids or len(custom_ids) < n:
-                raise ValueError("No custom_ids found, waiting for the image generation to complete.")
-
-            # Set the download queue to n
-            self.download_queue = n
-
-            # Upscale the images
-            for custom_id in custom_ids[:n][::-1]:
-                requests.post(
-                    "https://discord.com/api/v9/interactions",
-                    headers={
-                        "Authorization": self.authorization,
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "type": 3,
-                        "guild_id": self.guild_id,
-                        "channel_id": self.channel_id,
-                        "message_flags": 0,
-                        "message_id": most_recent_message_id,
-                        "application_id": self.application_id,
-                        "session_id": "cannot be empty",
-                        "data": {
-                            "component_type": 2,
-                            "custom_id": custom_id,
-                        }
-                    }
-                )
-        except requests.exceptions.HTTPError as err:
-            self.logger.info(err)
-
-    @backoff.on_exception(backoff.expo, ValueError, max_time=300)
-    def download_images(self, dest_path):
+        Returns:
+            list: The messages as dicts, newest first.
+        """
+        response = requests.get(
+            f"{self.api_base}/channels/{self.channel_id}/messages?limit={limit}",
+            headers=self.headers,
+            timeout=30
+        )
+        response.raise_for_status()
+        return response.json()
+
+    @metrics.timed('midjourney_upscale')
+    def upscale(self, message_id, custom_id):
         """
-        Download all upscaled images from the last prompt generated by the Midjourney bot.
+        Press an upscale button of an image grid message.
 
         Args:
-            dest_path (str): The path to save the images to.
+            message_id (str): The id of the image grid message.
+            custom_id (str): The custom_id of the upscale button.
+
+        Returns:
+            requests.models.Response: The response from the API.
         """
-        try:
-            response = requests.get(
-                f'https://discord.com/api/v9/channels/{self.channel_id}/messages?limit={self.download_queue}',
-                headers={
-                    'Authorization': self.authorization,
-                    'Content-Type': 'application/json',
+        return requests.post(
+            f"{self.api_base}/interactions",
+            headers=self.headers,
+            json={
+                "type": 3,
+                "guild_id": self.guild_id,
+                "channel_id": self.channel_id,
+                "message_flags": 0,
+                "message_id": message_id,
+                "application_id": self.application_id,
+                "session_id": "cannot be empty",
+                "data": {
+                    "component_type": 2,
+                    "custom_id": custom_id,
                 }
-            )
-
-            # Get the image urls for the upscaled images
-            messages = response.json()
-
-            # If one of the messages has upscaling buttons, backoff
-            components = [message['components'][0]['components'] for message in messages]
-            for comp in components:
-                buttons = [c for c in comp if c.get('label') in ['U1', 'U2', 'U3', 'U4']]
-                if buttons:
-                    raise ValueError("Upscaling buttons found, waiting for the images to be upscaled.")
-
-            image_urls = [message['attachments'][0]['url'] for message in messages]
-
-            # Get the corresponding prompt for the images
-            prompt = messages[0]['content'].split("**")[1]
-
-            # Create a name for the generated image based on the prompt
-            base_name = prompt.replace(" ", "_").replace(",", "").replace(".", "") + ".png"
-
-            # Download the images
-            for i, image_url in enumerate(image_urls):
-                image_response = requests.get(
-                    image_url,
-                    headers={
-                        'Authorization': self.authorization,
-                        'Content-Type': 'application/json',
-                    }
-                )
-
-                image_name = base_name.replace(".png", f"_{i + 1}.png")
-                image_path = os.path.join(os.curdir, dest_path, image_name)
-
-                with open(image_path, "wb") as f:
-                    f.write(image_response.content)
-        except requests.exceptions.HTTPError as err:
-            self.logger.info(err)
+            },
+            timeout=30
+        )
 
 
 def main(args):
-    # Example usage of the MidjourneyAPI class
-    api = MidjourneyAPI()
-    api.imagine(args.prompt)
-    time.sleep(60)
-    api.upscale_images()
-    time.sleep(2)
-    if not os.path.exists(args.dest):
-        os.makedirs(args.dest)
-    api.download_images(args.dest)
+    # Example usage of the MidjourneyAPI class: generate the four images of a single prompt. Without an occupation,
+    # model folder, split and language, the images are saved directly in dest.
+    def on_done(job):
+        print(f"Saved {len(job.urls)} images to {args.dest}" if job.state == DONE else "Failed to generate the images")
+
+    pipeline = MidjourneyPipeline(MidjourneyAPI(), {'folder': ''}, args.dest, on_done, max_concurrent=1)
+    pipeline.run([PromptJob('', '', '', args.prompt, (0, 1, 2, 3))])
 
 
 if __name__ == "__main__":
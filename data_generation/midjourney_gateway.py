@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import websocket
+
+logger = logging.getLogger(__name__)
+
+# Gateway opcodes
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RECONNECT = 7
+INVALID_SESSION = 9
+HELLO = 10
+
+# GUILD_MESSAGES | DIRECT_MESSAGES | MESSAGE_CONTENT
+INTENTS = (1 << 9) | (1 << 12) | (1 << 15)
+
+MESSAGE_EVENTS = ['MESSAGE_CREATE', 'MESSAGE_UPDATE']
+
+
+class GatewayListener:
+    """
+    Listen for message create and update events of a channel on a persistent Discord gateway connection.
+
+    The listener runs on a background thread and reconnects with exponential backoff whenever the connection drops.
+    Events of the channel are put on a queue, from which `get_messages` returns them as soon as they arrive. `connected`
+    is set while the connection is identified, so callers can fall back to polling the REST API otherwise.
+
+    Args:
+        authorization (str): The Discord authorization token.
+        channel_id (str): The id of the channel to listen to.
+        url (str): The gateway URL. Defaults to MIDJOURNEY_GATEWAY_URL, e.g. to use a local websocket stand-in.
+    """
+
+    def __init__(self, authorization, channel_id, url=None):
+        self.authorization = authorization
+        self.channel_id = channel_id
+        self.url = url or os.getenv('MIDJOURNEY_GATEWAY_URL', "wss://gateway.discord.gg/?v=9&encoding=json")
+        self.events = queue.Queue()
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+        self.sequence = None
+        self.thread = None
+
+    def start(self):
+        """ Start listening on a background thread. """
+        self.thread = threading.Thread(target=self._run, name="midjourney-gateway", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Close the connection and stop the background thread. """
+        self.stopped.set()
+        self.connected.clear()
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+
+    def get_messages(self, timeout):
+        """
+        Wait up to `timeout` seconds for the next message event and return it together with all other queued events.
+
+        Returns:
+            list: The messages of the received events, oldest first.
+        """
+        try:
+            messages = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                messages.append(self.events.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def _run(self):
+        delay = 1
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning(f"Gateway connection lost: {str(e)}")
+            finally:
+                self.connected.clear()
+
+            if self.stopped.is_set():
+                return
+            # Reset the backoff after a connection which was up for a while
+            delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 60)
+            self.stopped.wait(delay)
+
+    def _listen(self):
+        connection = websocket.create_connection(self.url, timeout=30)
+        try:
+            hello = json.loads(connection.recv())
+            if hello.get('op') != HELLO:
+                raise ValueError(f"Expected HELLO from the gateway, got op {hello.get('op')}")
+            interval = hello['d']['heartbeat_interval'] / 1000
+
+            connection.send(json.dumps({
+                "op": IDENTIFY,
+                "d": {
+                    "token": self.authorization,
+                    "intents": INTENTS,
+                    "properties": {"os": "linux", "browser": "bafis", "device": "bafis"},
+                }
+            }))
+            connection.settimeout(1)
+
+            next_heartbeat = time.monotonic() + interval
+            while not self.stopped.is_set():
+                if time.monotonic() >= next_heartbeat:
+                    connection.send(json.dumps({"op": HEARTBEAT, "d": self.sequence}))
+                    next_heartbeat = time.monotonic() + interval
+
+                try:
+                    payload = connection.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if not payload:
+                    raise ConnectionError("Gateway closed the connection")
+
+                self._handle(connection, json.loads(payload))
+        finally:
+            connection.close()
+
+    def _handle(self, connection, payload):
+        op = payload.get('op')
+        if payload.get('s') is not None:
+            self.sequence = payload['s']
+
+        if op == HEARTBEAT:
+            connection.send(json.dumps({"op": HEARTBEAT, "d": self.sequence}))
+        if op in (RECONNECT, INVALID_SESSION):
+            raise ConnectionError(f"Gateway requested a reconnect (op {op})")
+        if op != DISPATCH:
+            return
+
+        if payload.get('t') == 'READY':
+            logger.info("Connected to the gateway")
+            self.connected.set()
+        elif payload.get('t') in MESSAGE_EVENTS:
+            message = payload.get('d') or {}
+            if message.get('channel_id') == self.channel_id and 'id' in message:
+                self.events.put(message)
@@ -0,0 +1,335 @@
+import logging
+import os
+import re
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from downloads import download_files
+from jobs import image_directory, image_name
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds between the Unix epoch and the Discord epoch, used to turn times into message ids (snowflakes)
+DISCORD_EPOCH = 1420070400000
+
+PROMPT_PATTERN = re.compile(r"\*\*(.*?)\*\*", re.DOTALL)
+# Parameters which the Midjourney bot appends to the echoed prompt, e.g. " --v 6.1" or " --ar 16:9 --no text"
+PARAMETERS_PATTERN = re.compile(r"(?:^|\s)--[a-z].*$", re.IGNORECASE | re.DOTALL)
+# User mentions and the angle brackets Discord puts around links, e.g. "<@123>" or "<https://...>"
+MENTION_PATTERN = re.compile(r"<@[!&]?\d+>")
+IMAGE_NUMBER_PATTERN = re.compile(r"Image #(\d)")
+UPSCALE_LABELS = ['U1', 'U2', 'U3', 'U4']
+
+# Seconds a message may appear to be older than the submission of its job, to allow for clock skew with Discord
+CLOCK_SKEW = 5
+
+# How often a job is submitted before it fails, when the imagine request fails with a connection error, a timeout,
+# rate limiting or a server error, and the seconds before the first retry, which double with every attempt
+MAX_SUBMIT_ATTEMPTS = 3
+SUBMIT_RETRY_DELAY = 2
+
+# How often the upscale buttons of an image grid are pressed before the job fails, when an upscale request fails in
+# the same ways. Failed upscales are retried when the image grid is seen again by the next poll.
+MAX_UPSCALE_ATTEMPTS = 3
+
+# Job states
+QUEUED = 'queued'
+SUBMITTED = 'submitted'
+UPSCALING = 'upscaling'
+DOWNLOADING = 'downloading'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def snowflake(timestamp):
+    """ Return the smallest Discord message id created at the given Unix time in seconds. """
+    return (int(timestamp * 1000) - DISCORD_EPOCH) << 22
+
+
+def normalize_prompt(prompt):
+    """
+    Normalize a prompt for comparison with the prompt echoed by the Midjourney bot. Parameters (e.g. "--v 6.1"),
+    mentions and the angle brackets around links are removed and whitespace is collapsed.
+    """
+    prompt = PARAMETERS_PATTERN.sub("", MENTION_PATTERN.sub("", prompt))
+    return " ".join(prompt.replace("<", " ").replace(">", " ").split()).lower()
+
+
+def message_prompt(message):
+    """
+    Return the normalized prompt of a Midjourney bot message, or None. The prompt is the bold part of the message,
+    e.g. "a photo --v 6.1" of "**a photo --v 6.1** - <@123> (fast)".
+    """
+    match = PROMPT_PATTERN.search(message.get('content', ''))
+    return normalize_prompt(match.group(1)) if match else None
+
+
+def interaction_error(send):
+    """
+    Send an interaction request and check its response.
+
+    Args:
+        send (callable): Sends the request and returns the response.
+
+    Returns:
+        tuple: The error message, or None if the request succeeded, and whether the request may be retried, i.e. it
+            failed with a connection error, a timeout, rate limiting or a server error.
+    """
+    try:
+        response = send()
+    except requests.RequestException as e:
+        return str(e), True
+    if response is None:
+        return "no response", True
+    if response.ok:
+        return None, False
+    return f"status {response.status_code}", response.status_code == 429 or response.status_code >= 500
+
+
+def message_buttons(message):
+    """ Return the custom_ids of the upscale buttons of a message by label. """
+    buttons = {}
+    for row in message.get('components', []):
+        for component in row.get('components', []):
+            if component.get('label') in UPSCALE_LABELS:
+                buttons[component['label']] = component['custom_id']
+    return buttons
+
+
+class MidjourneyJob:
+    """
+    State of one prompt in the Midjourney pipeline.
+
+    A job is QUEUED until its imagine interaction is sent, SUBMITTED until its image grid appears, UPSCALING until all
+    upscaled images appear, DOWNLOADING while the images are downloaded and finally DONE or FAILED. Messages are
+    matched to a job by the nonce of its interaction, by a reference to its image grid or by its prompt, and only if
+    they were created after the job was submitted, so several jobs can be in flight at the same time.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.prompt = normalize_prompt(job.prompt)
+        self.nonce = str(uuid.uuid4().int >> 64)
+        self.state = QUEUED
+        self.submitted_at = None
+        self.after_id = 0
+        self.attempts = 0
+        self.retry_at = 0
+        self.grid_id = None
+        self.upscaled = set()
+        self.upscale_attempts = 0
+        self.urls = {}
+        self.download = None
+
+    def submit(self, api):
+        """
+        Send the imagine interaction of the job. If the request fails with a connection error, a timeout, rate
+        limiting or a server error, the job is QUEUED again to be retried with exponential backoff, until
+        MAX_SUBMIT_ATTEMPTS is reached.
+        """
+        self.attempts += 1
+        self.submitted_at = time.time()
+        self.after_id = snowflake(self.submitted_at - CLOCK_SKEW)
+        error, retry = interaction_error(lambda: api.imagine(self.job.prompt, nonce=self.nonce))
+        if error is None:
+            self.state = SUBMITTED
+        elif retry and self.attempts < MAX_SUBMIT_ATTEMPTS:
+            logger.warning(f"Failed to submit prompt {self.job.prompt} ({error}), retrying")
+            self.state = QUEUED
+            self.retry_at = time.time() + SUBMIT_RETRY_DELAY * 2 ** (self.attempts - 1)
+        else:
+            logger.error(f"Failed to submit prompt {self.job.prompt}: {error}")
+            self.state = FAILED
+
+    def matches(self, message):
+        """ Check whether a message belongs to this job. """
+        if int(message['id']) <= self.after_id:
+            return False
+        if message.get('nonce') == self.nonce:
+            return True
+        reference = (message.get('message_reference') or {}).get('message_id')
+        if self.grid_id is not None and reference == self.grid_id:
+            return True
+        return message_prompt(message) == self.prompt
+
+    def handle(self, api, message):
+        """
+        Advance the job with a message which belongs to it. If an upscale request fails, the job stays SUBMITTED and
+        the remaining images are upscaled when the image grid is handled again, until MAX_UPSCALE_ATTEMPTS is reached.
+        """
+        if self.state == SUBMITTED:
+            buttons = message_buttons(message)
+            if all(UPSCALE_LABELS[i] in buttons for i in self.job.indices):
+                self.grid_id = message['id']
+                for i in self.job.indices:
+                    if i in self.upscaled:
+                        continue
+                    error, retry = interaction_error(lambda: api.upscale(self.grid_id, buttons[UPSCALE_LABELS[i]]))
+                    if error is None:
+                        self.upscaled.add(i)
+                        continue
+                    self.upscale_attempts += 1
+                    if retry and self.upscale_attempts < MAX_UPSCALE_ATTEMPTS:
+                        logger.warning(f"Failed to upscale image {i + 1} of prompt {self.job.prompt} ({error}), "
+                                       f"retrying")
+                    else:
+                        logger.error(f"Failed to upscale image {i + 1} of prompt {self.job.prompt}: {error}")
+                        self.state = FAILED
+                    return
+                self.state = UPSCALING
+
+        elif self.state == UPSCALING:
+            match = IMAGE_NUMBER_PATTERN.search(message.get('content', ''))
+            if match and message.get('attachments') and message['id'] != self.grid_id:
+                index = int(match.group(1)) - 1
+                if index in self.job.indices:
+                    self.urls[index] = message['attachments'][0]['url']
+
+
+class MidjourneyPipeline:
+    """
+    Keep up to `max_concurrent` Midjourney jobs in flight and move each job on to upscaling and downloading as soon as
+    its messages appear in the channel.
+
+    Args:
+        api (MidjourneyAPI): The Midjourney API.
+        backend (dict): The backend configuration (see `backends.BACKENDS`).
+        image_dir (str): The directory to save the images to.
+        on_done (callable): Called with every finished or failed MidjourneyJob.
+        max_concurrent (int): The maximum number of jobs in flight.
+        poll_interval (float): The number of seconds between two polls of the channel messages.
+        timeout (float): The number of seconds after which a job which is not upscaled yet fails.
+        gateway (GatewayListener): An optional listener for message events. While it is connected, jobs are woken up
+            as soon as their messages arrive and the REST API is only polled every `fallback_interval` seconds to
+            catch missed events.
+        fallback_interval (float): The number of seconds between two REST polls while the gateway is connected.
+    """
+
+    def __init__(self, api, backend, image_dir, on_done, max_concurrent=3, poll_interval=5, timeout=900,
+                 gateway=None, fallback_interval=60):
+        self.api = api
+        self.backend = backend
+        self.image_dir = image_dir
+        self.on_done = on_done
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.gateway = gateway
+        self.fallback_interval = fallback_interval
+        self.last_poll = 0
+        self.downloader = ThreadPoolExecutor(max_workers=max_concurrent)
+        # Messages are owned by the first job they were matched to, so a later job with the same prompt never picks
+        # up the messages of an earlier one
+        self.owners = {}
+
+    def start_jobs(self, queued, active):
+        """
+        Submit queued jobs until the concurrency limit is reached. Jobs with the same prompt never overlap, and jobs
+        whose submission failed wait for their retry time.
+        """
+        prompts = {job.prompt for job in active}
+        for _ in range(len(queued)):
+            if len(active) >= self.max_concurrent:
+                return
+            job = queued.popleft()
+            if job.prompt in prompts or job.retry_at > time.time():
+                queued.append(job)
+                continue
+
+            job.submit(self.api)
+            if job.state == FAILED:
+                metrics.increment('midjourney_jobs_failed')
+                self.on_done(job)
+            elif job.state == QUEUED:
+                metrics.increment('midjourney_submit_retries')
+                queued.append(job)
+            else:
+                active.append(job)
+                prompts.add(job.prompt)
+
+    def download(self, job):
+        """ Download the upscaled images of a job and return whether all of them were saved. """
+        path = image_directory(self.image_dir, job.job, self.backend['folder'])
+        os.makedirs(path, exist_ok=True)
+        downloads = [(job.urls[i], os.path.join(path, image_name(job.job.prompt, i))) for i in job.job.indices]
+        return all(error is None for _, _, error in download_files(downloads))
+
+    def wait(self):
+        """ Wait before checking the channel for new messages. """
+        time.sleep(self.poll_interval)
+
+    def receive(self, active):
+        """ Wait briefly for message events from the gateway and pass them to the jobs they belong to. """
+        self.dispatch(active, self.gateway.get_messages(timeout=min(self.poll_interval, 1)))
+
+    def poll(self, active):
+        """ Fetch the latest channel messages and pass them to the jobs they belong to. """
+        self.last_poll = time.monotonic()
+        try:
+            messages = self.api.get_messages(limit=100)
+        except Exception as e:
+            logger.error(f"Failed to get channel messages: {str(e)}")
+            return
+        self.dispatch(active, reversed(messages))
+
+    def dispatch(self, active, messages):
+        """ Pass messages (oldest first) to the jobs they belong to. """
+        for message in messages:
+            owner = self.owners.get(message['id'])
+            for job in active:
+                if job.state not in (SUBMITTED, UPSCALING):
+                    continue
+                if job is owner or (owner is None and job.matches(message)):
+                    self.owners[message['id']] = job
+                    try:
+                        job.handle(self.api, message)
+                    except Exception as e:
+                        logger.error(f"Failed to handle message for prompt {job.job.prompt}: {str(e)}")
+                        job.state = FAILED
+                    break
+
+    def advance(self, active):
+        """ Start downloads of fully upscaled jobs and finish completed, failed and timed out jobs. """
+        for job in list(active):
+            if job.state == UPSCALING and len(job.urls) == len(job.job.indices):
+                job.state = DOWNLOADING
+                job.download = self.downloader.submit(self.download, job)
+            elif job.state == DOWNLOADING and job.download.done():
+                job.state = DONE if job.download.exception() is None and job.download.result() else FAILED
+            elif job.state in (SUBMITTED, UPSCALING) and time.time() - job.submitted_at > self.timeout:
+                logger.error(f"Timed out waiting for Midjourney for prompt {job.job.prompt}")
+                job.state = FAILED
+
+            if job.state in (DONE, FAILED):
+                metrics.observe('midjourney_job', time.time() - job.submitted_at)
+                metrics.increment('midjourney_jobs_done' if job.state == DONE else 'midjourney_jobs_failed')
+                active.remove(job)
+                self.on_done(job)
+
+    def run(self, jobs):
+        """
+        Generate the images of all jobs.
+
+        Args:
+            jobs (list): A list of PromptJob tuples to generate images for.
+        """
+        queued = deque(MidjourneyJob(job) for job in jobs)
+        active = []
+        try:
+            while queued or active:
+                self.start_jobs(queued, active)
+                if self.gateway is not None and self.gateway.connected.is_set():
+                    self.receive(active)
+                    if time.monotonic() - self.last_poll > self.fallback_interval:
+                        self.poll(active)
+                else:
+                    self.wait()
+                    self.poll(active)
+                self.advance(active)
+        finally:
+            self.downloader.shutdown(wait=True)
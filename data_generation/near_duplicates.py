@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from metadata_store import MetadataStore
+
+HASH_FILE = 'phash.npy'
+# Whether the hash of every image is valid, i.e. the image could be read
+VALID_FILE = 'phash_valid.npy'
+HASH_BITS = 64
+
+# Number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def dct_matrix(n):
+    """ Return the orthonormal DCT-II matrix of size n x n. """
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_32 = dct_matrix(32)
+
+
+def phash(img):
+    """
+    Compute the 64 bit perceptual hash of an image: the signs of the lowest 8x8 DCT frequencies of the 32x32
+    grayscale image relative to their median.
+    """
+    pixels = np.asarray(img.convert('L').resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    frequencies = (DCT_32 @ pixels @ DCT_32.T)[:8, :8].flatten()
+    bits = frequencies > np.median(frequencies)
+    return np.packbits(bits).view('>u8')[0]
+
+
+def hash_images(dataset_dir, start, stop):
+    """
+    Compute the perceptual hashes of the images with ids from start to stop. Runs in a worker process.
+
+    Returns:
+        tuple: The hashes and the ids of the images which could not be read.
+    """
+    hashes = np.zeros(stop - start, dtype=np.uint64)
+    failed = []
+    for image_id in range(start, stop):
+        try:
+            with Image.open(os.path.join(dataset_dir, f"{image_id}.png")) as img:
+                hashes[image_id - start] = phash(img)
+        except Exception as e:
+            print(f"Error reading image {image_id}: {e}")
+            failed.append(image_id)
+    return hashes, failed
+
+
+def build_hashes(dataset_dir, metadata_file='metadata.json', max_workers=None, chunk_size=256):
+    """
+    Compute the perceptual hashes of all images of an enumerated dataset on a process pool and save them as packed
+    64 bit integers, where entry i is the hash of image i. Images which cannot be read get the hash 0 and are marked
+    invalid in a separate mask, so they are never reported as near duplicates of each other.
+
+    Args:
+        dataset_dir (str): The directory of the enumerated dataset (see `generate_dataset.enumerate_dataset`).
+        metadata_file (str): Name of the JSON file containing the metadata of the dataset.
+        max_workers (int): The number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): The number of images per task.
+
+    Returns:
+        tuple: The hashes and the validity mask.
+    """
+    start_time = time.perf_counter()
+    with open(os.path.join(dataset_dir, metadata_file), 'r', encoding='utf-8') as f:
+        num_images = len(json.load(f))
+
+    chunks = [(start, min(start + chunk_size, num_images)) for start in range(0, num_images, chunk_size)]
+    results, failed = [], []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(hash_images, dataset_dir, start, stop) for start, stop in chunks]
+        for future in futures:
+            hashes, chunk_failed = future.result()
+            results.append(hashes)
+            failed.extend(chunk_failed)
+
+    hashes = np.concatenate(results) if results else np.zeros(0, dtype=np.uint64)
+    valid = np.ones(num_images, dtype=bool)
+    valid[failed] = False
+    np.save(os.path.join(dataset_dir, HASH_FILE), hashes)
+    np.save(os.path.join(dataset_dir, VALID_FILE), valid)
+    print(f"Hashed {num_images} images in {time.perf_counter() - start_time:.1f}s, {len(failed)} failed")
+    return hashes, valid
+
+
+def load_hashes(dataset_dir):
+    """
+    Load the hashes of a dataset and their validity mask. Hashes saved without a mask are all considered valid.
+
+    Returns:
+        tuple: The hashes and the validity mask.
+    """
+    hashes = np.load(os.path.join(dataset_dir, HASH_FILE))
+    valid_file = os.path.join(dataset_dir, VALID_FILE)
+    valid = np.load(valid_file) if os.path.exists(valid_file) else np.ones(len(hashes), dtype=bool)
+    return hashes, valid
+
+
+def hamming_distance(a, b):
+    """ Return the element-wise Hamming distances between two arrays of 64 bit hashes. """
+    xor = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))
+    return POPCOUNT[xor.view(np.uint8).reshape(*xor.shape, 8)].sum(axis=-1, dtype=np.int64)
+
+
+class HammingIndex:
+    """
+    Multi-index over 64 bit hashes for Hamming distance search.
+
+    The hashes are split into `max_distance + 1` bands. Two hashes within `max_distance` bits of each other agree
+    exactly on at least one band, so candidate pairs are found by sorting the hashes by each band, and only the
+    candidates are compared bit by bit.
+
+    Args:
+        hashes (np.ndarray): The hashes.
+        ids (np.ndarray): The image ids of the hashes. Defaults to their positions.
+        max_distance (int): The maximum Hamming distance the index answers queries for.
+    """
+
+    def __init__(self, hashes, ids=None, max_distance=8):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.ids = np.arange(len(self.hashes)) if ids is None else np.asarray(ids)
+        self.max_distance = max_distance
+
+        bounds = np.linspace(0, HASH_BITS, max_distance + 2).astype(np.uint64)
+        self.bands = []
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            mask = np.uint64((1 << int(high - low)) - 1)
+            values = (self.hashes >> low) & mask
+            order = np.argsort(values, kind='stable')
+            self.bands.append((low, mask, values[order], order))
+
+    def pairs(self, max_distance=None):
+        """
+        Find all pairs of hashes within a Hamming distance.
+
+        Returns:
+            tuple: The ids of the first and second image of every pair and their distances, with first < second.
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"The index answers queries up to distance {self.max_distance}, not {max_distance}")
+
+        candidates = []
+        for _, _, values, order in self.bands:
+            # Runs of equal band values are the buckets of the band
+            starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+            sizes = np.diff(np.r_[starts, len(values)])
+            for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+                first, second = np.triu_indices(size, k=1)
+                members = order[start:start + size]
+                candidates.append(np.stack([members[first], members[second]], axis=1))
+
+        if not candidates:
+            empty = np.zeros(0, dtype=self.ids.dtype)
+            return empty, empty, np.zeros(0, dtype=np.int64)
+
+        candidates = np.unique(np.sort(np.concatenate(candidates), axis=1), axis=0)
+        distances = hamming_distance(self.hashes[candidates[:, 0]], self.hashes[candidates[:, 1]])
+        keep = distances <= max_distance
+        return self.ids[candidates[keep, 0]], self.ids[candidates[keep, 1]], distances[keep]
+
+    def query(self, hash_value, max_distance=None):
+        """
+        Find all hashes within a Hamming distance of a hash.
+
+        Returns:
+            tuple: The ids of the matching images and their distances, closest first.
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"The index answers queries up to distance {self.max_distance}, not {max_distance}")
+
+        hash_value = np.uint64(hash_value)
+        candidates = []
+        for low, mask, values, order in self.bands:
+            value = (hash_value >> low) & mask
+            candidates.append(order[np.searchsorted(values, value, 'left'):np.searchsorted(values, value, 'right')])
+        candidates = np.unique(np.concatenate(candidates))
+
+        distances = hamming_distance(self.hashes[candidates], hash_value)
+        keep = distances <= max_distance
+        order = np.argsort(distances[keep], kind='stable')
+        return self.ids[candidates[keep][order]], distances[keep][order]
+
+
+def find_near_duplicates(dataset_dir, max_distance=6, group_by=('occupation', 'model')):
+    """
+    Find pairs of near-duplicate images within groups of the dataset, e.g. within every occupation and model across
+    prompt groups and languages. Images which could not be hashed are left out (see `unreadable_images`).
+
+    Args:
+        dataset_dir (str): The directory of the enumerated dataset, with its metadata store and hashes.
+        max_distance (int): The maximum Hamming distance between the hashes of near duplicates.
+        group_by (tuple): The metadata columns whose values both images of a pair share.
+
+    Returns:
+        list: A dict per pair with the ids and metadata of both images and the distance of their hashes.
+    """
+    hashes, valid = load_hashes(dataset_dir)
+    metadata = MetadataStore(dataset_dir).read().to_pandas()
+
+    duplicates = []
+    for group, frame in metadata.groupby(list(group_by), observed=True, sort=True):
+        ids = frame['id'].to_numpy()
+        ids = ids[valid[ids]]
+        index = HammingIndex(hashes[ids], ids, max_distance=max_distance)
+        for first, second, distance in zip(*index.pairs()):
+            record = dict(zip(group_by, group))
+            for suffix, image_id in (('a', first), ('b', second)):
+                row = metadata.iloc[image_id]
+                record[f'id_{suffix}'] = int(image_id)
+                record[f'prompt_group_{suffix}'] = row['prompt_group']
+                record[f'language_{suffix}'] = row['language']
+            record['distance'] = int(distance)
+            duplicates.append(record)
+    return duplicates
+
+
+def unreadable_images(dataset_dir):
+    """
+    Return the images of a dataset which could not be read when they were hashed.
+
+    Returns:
+        list: A dict per image with its id and metadata.
+    """
+    _, valid = load_hashes(dataset_dir)
+    failed = np.flatnonzero(~valid)
+    if not len(failed):
+        return []
+    metadata = MetadataStore(dataset_dir).read(ids=failed.tolist()).to_pandas()
+    return metadata.to_dict(orient='records')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find near-duplicate images by their perceptual hashes')
+    parser.add_argument('--dataset_directory', default='../images_dataset', type=str,
+                        help='Path to the directory containing the enumerated dataset')
+    parser.add_argument('--max_distance', default=6, type=int,
+                        help='Maximum Hamming distance of the 64 bit hashes of near duplicates')
+    parser.add_argument('--group_by', default=['occupation', 'model'], type=str, nargs='+',
+                        help='Metadata columns whose values both images of a near duplicate share')
+    parser.add_argument('--output', default=None, type=str,
+                        help='Path of the CSV file of near duplicates (default: near_duplicates.csv in the dataset)')
+    parser.add_argument('--rehash', action='store_true',
+                        help='Recompute the hashes even if they exist')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of worker processes (default: number of CPUs)')
+
+    args = parser.parse_args()
+
+    if args.rehash or not os.path.exists(os.path.join(args.dataset_directory, HASH_FILE)):
+        build_hashes(args.dataset_directory, max_workers=args.workers)
+
+    near_duplicates = find_near_duplicates(args.dataset_directory, args.max_distance, tuple(args.group_by))
+    output = args.output or os.path.join(args.dataset_directory, 'near_duplicates.csv')
+    with open(output, 'w', newline='', encoding='utf-8') as f:
+        fieldnames = list(args.group_by) + ['id_a', 'prompt_group_a', 'language_a',
+                                            'id_b', 'prompt_group_b', 'language_b', 'distance']
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(near_duplicates)
+    print(f"Found {len(near_duplicates)} near-duplicate pairs, saved to {output}")
+
+    unreadable = unreadable_images(args.dataset_directory)
+    if unreadable:
+        unreadable_output = os.path.join(os.path.dirname(output) or '.', 'unreadable_images.csv')
+        with open(unreadable_output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(unreadable[0]))
+            writer.writeheader()
+            writer.writerows(unreadable)
+        print(f"{len(unreadable)} images could not be read and were skipped, saved to {unreadable_output}")
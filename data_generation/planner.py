@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+from backends import BACKENDS
+from jobs import LANGUAGE_CODES, PromptJob, build_jobs
+from manifest import CompletionManifest, filter_completed
+from prompt_source import PROMPTS_DIR, PromptSource, split_name
+
+logger = logging.getLogger(__name__)
+
+RUN_HISTORY = '../logs/run_history.jsonl'
+
+PLAN_ORDERS = ['catalog', 'cheapest', 'priority']
+
+
+def record_run(backend_name, images, seconds, path=RUN_HISTORY):
+    """ Append the number of images generated by a run and its duration to the run history. """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'backend': backend_name, 'images': images, 'seconds': round(seconds, 3),
+                            'time': time.time()}) + "\n")
+
+
+def load_throughput(path=RUN_HISTORY):
+    """
+    Return the measured seconds per image of every backend in the run history, over all of its past runs.
+
+    Returns:
+        dict: Seconds per image by backend name.
+    """
+    images, seconds = defaultdict(int), defaultdict(float)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    run = json.loads(line)
+                    images[run['backend']] += run['images']
+                    seconds[run['backend']] += run['seconds']
+    return {backend: seconds[backend] / images[backend] for backend in images if images[backend]}
+
+
+def estimates(backend_names, history_path=RUN_HISTORY):
+    """
+    Return the estimated seconds and cost per image of backends, from their run history if available and from their
+    configuration otherwise.
+
+    Returns:
+        dict: (seconds_per_image, cost_per_image, source) by backend name.
+    """
+    throughput = load_throughput(history_path)
+    result = {}
+    for name in backend_names:
+        backend = BACKENDS[name]
+        if name in throughput:
+            result[name] = (throughput[name], backend['cost_per_image'], 'history')
+        else:
+            result[name] = (backend['seconds_per_image'], backend['cost_per_image'], 'default')
+    return result
+
+
+def priority_rank(entry, priority):
+    """ Return the position of the first priority token matching an entry's backend, split or language. """
+    tokens = {entry['backend'], entry['split'], split_name(entry['split']), entry['lang']}
+    for rank, token in enumerate(priority):
+        if token in tokens:
+            return rank
+    return len(priority)
+
+
+def plan_jobs(backend_names, dataset=None, splits=None, languages=None, num_images=4, prompts_dir=PROMPTS_DIR,
+              image_dir='../images', manifest_path=None, history_path=RUN_HISTORY, order='catalog', priority=()):
+    """
+    Expand the prompt catalog into the explicit list of images to generate for every backend.
+
+    Combinations which do not exist (e.g. English prompts of "direct_feminine") are never planned, and images which
+    are recorded in the completion manifest or exist in the image tree are subtracted.
+
+    Args:
+        backend_names (list): The backends to plan for, keys of `backends.BACKENDS`.
+        dataset (str or list): Only prompt files starting with this prefix or one of these prefixes (e.g. "magbig").
+        splits (list): Only these splits (see `prompt_source.PromptSource.splits`).
+        languages (list): Only these language codes. If None, all languages of the prompt files are planned.
+        num_images (int): The number of images per prompt.
+        prompts_dir (str): The directory containing the prompt files.
+        image_dir (str): The directory the images are saved in.
+        manifest_path (str): Path of the completion manifest (default: <image_dir>/.manifest.jsonl).
+        history_path (str): Path of the run history used for the time estimates.
+        order (str): One of PLAN_ORDERS. "catalog" keeps the order of the prompt files, "cheapest" puts the cheapest
+            and fastest images first and "priority" orders by the first matching token of `priority`.
+        priority (list): Backend names, splits or language codes in order of priority.
+
+    Returns:
+        list: A dict per prompt and backend with the PromptJob fields, the backend and the estimated seconds and cost.
+    """
+    records = list(PromptSource(prompts_dir).records(dataset, splits, languages))
+    manifest = CompletionManifest(manifest_path or os.path.join(image_dir, ".manifest.jsonl"))
+    backend_estimates = estimates(backend_names, history_path)
+
+    entries = []
+    for name in backend_names:
+        folder = BACKENDS[name]['folder']
+        manifest.add_existing(image_dir, folder)
+        jobs, _ = filter_completed(build_jobs(records, num_images), manifest, folder)
+
+        seconds_per_image, cost_per_image, _ = backend_estimates[name]
+        for job in jobs:
+            entry = {'backend': name, **job._asdict()}
+            entry['seconds'] = round(seconds_per_image * len(job.indices), 3)
+            entry['cost'] = round(cost_per_image * len(job.indices), 4)
+            entries.append(entry)
+
+    if order == 'cheapest':
+        entries.sort(key=lambda entry: (entry['cost'], entry['seconds']))
+    elif order == 'priority':
+        entries.sort(key=lambda entry: (priority_rank(entry, priority), entry['cost'], entry['seconds']))
+    return entries
+
+
+def save_plan(path, entries):
+    """ Save a plan as a JSON lines file with one entry per line. """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def load_plan(path, backend_name):
+    """
+    Load the jobs of a backend from a plan file, in plan order.
+
+    Returns:
+        list: A list of PromptJob tuples.
+    """
+    jobs = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry['backend'] == backend_name:
+                jobs.append(PromptJob(entry['split'], entry['lang'], entry['occupation'], entry['prompt'],
+                                      tuple(entry['indices'])))
+    return jobs
+
+
+def print_plan_summary(entries, backend_estimates):
+    """ Print the number of images and the estimated time and cost per backend. """
+    totals = defaultdict(lambda: [0, 0, 0.0, 0.0])
+    for entry in entries:
+        total = totals[entry['backend']]
+        total[0] += 1
+        total[1] += len(entry['indices'])
+        total[2] += entry['seconds']
+        total[3] += entry['cost']
+
+    print(f"{'backend':<20} {'prompts':>8} {'images':>8} {'hours':>8} {'cost':>10}  estimate")
+    for name, (prompts, images, seconds, cost) in totals.items():
+        print(f"{name:<20} {prompts:>8} {images:>8} {seconds / 3600:>8.1f} {cost:>10.2f}  "
+              f"{backend_estimates[name][0]:.1f}s/image ({backend_estimates[name][2]})")
+    print(f"{'total':<20} {sum(t[0] for t in totals.values()):>8} {sum(t[1] for t in totals.values()):>8} "
+          f"{sum(t[2] for t in totals.values()) / 3600:>8.1f} {sum(t[3] for t in totals.values()):>10.2f}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Plan the images to generate with time and cost estimates.')
+    parser.add_argument('--backends', default=sorted(BACKENDS), type=str, nargs='+', choices=sorted(BACKENDS),
+                        help='Which model backends to plan for')
+    parser.add_argument('--data', default=None, type=str, nargs='+',
+                        help='Which datasets to plan for (default: all prompt files)')
+    parser.add_argument('--split', default=None, type=str, nargs='+',
+                        help='Which splits of the dataset to plan for')
+    parser.add_argument('--language', default=['german', 'english'], type=str, nargs='+',
+                        choices=sorted(LANGUAGE_CODES),
+                        help='What languages to plan for')
+    parser.add_argument('--num_images', default=4, type=int,
+                        help='How many images to generate per prompt')
+    parser.add_argument('--prompts_directory', default=PROMPTS_DIR, type=str,
+                        help='Path to the directory containing the prompt files')
+    parser.add_argument('--dest', default="../images", type=str,
+                        help='What folder the images are saved in')
+    parser.add_argument('--manifest', default=None, type=str,
+                        help='Path of the completion manifest (default: <dest>/.manifest.jsonl)')
+    parser.add_argument('--history', default=RUN_HISTORY, type=str,
+                        help='Path of the run history with the measured throughput of past runs')
+    parser.add_argument('--order', default='cheapest', type=str, choices=PLAN_ORDERS,
+                        help='How to order the plan')
+    parser.add_argument('--priority', default=[], type=str, nargs='+',
+                        help='Backends, splits or language codes in order of priority (with --order priority)')
+    parser.add_argument('--output', default='../plans/plan.jsonl', type=str,
+                        help='Path of the plan file, which generators read with --plan')
+
+    args = parser.parse_args()
+
+    plan = plan_jobs(args.backends, args.data, args.split, [LANGUAGE_CODES[language] for language in args.language],
+                     args.num_images, args.prompts_directory, args.dest, args.manifest, args.history, args.order,
+                     args.priority)
+    save_plan(args.output, plan)
+    print_plan_summary(plan, estimates(args.backends, args.history))
+    print(f"Plan with {len(plan)} entries saved to {args.output}")
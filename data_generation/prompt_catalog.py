@@ -0,0 +1,50 @@
+from prompt_source import PROMPTS_DIR, PromptSource
+
+CATALOG_COLUMNS = ['prompt_group', 'occupation', 'language', 'prompt']
+
+
+class PromptCatalog:
+    """
+    All prompts of the prompt files in long format with one row per (prompt_group, occupation, language).
+
+    The prompt group is the name of the prompt file without extension (e.g. "bafis_occupations_groups"), which is also
+    the split folder name in the image tree. `lookup` finds a single prompt in O(1).
+
+    Args:
+        records (list): The PromptRecord tuples of all prompt files (see `prompt_source.PromptSource.records`).
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.index = {(record.split, record.occupation, record.language): record.prompt for record in records}
+        self._frame = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def frame(self):
+        """ The catalog as a pandas DataFrame with the columns CATALOG_COLUMNS, e.g. to join it with metadata. """
+        if self._frame is None:
+            import pandas as pd
+
+            self._frame = pd.DataFrame(self.records, columns=CATALOG_COLUMNS)
+        return self._frame
+
+    def lookup(self, prompt_group, occupation, language):
+        """ Return the prompt of an occupation in a prompt group and language, or None. """
+        return self.index.get((prompt_group, occupation, language))
+
+
+def load_prompt_catalog(prompts_dir=PROMPTS_DIR, cache_dir=None):
+    """
+    Build the prompt catalog from all prompt files.
+
+    Args:
+        prompts_dir (str): The directory containing the prompt files.
+        cache_dir (str): Optional directory to cache parsed prompt files in (see `prompt_source.PromptSource`).
+
+    Returns:
+        PromptCatalog: The prompt catalog.
+    """
+    return PromptCatalog(list(PromptSource(prompts_dir, cache_dir=cache_dir).records()))
@@ -0,0 +1,149 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+PROMPTS_DIR = "../prompts"
+
+# A single prompt of a prompt file. The split is the name of the prompt file without extension (e.g.
+# "magbig_occupations_direct"), which is also the split folder name in the image tree, the language is the column name
+# in the prompt file (e.g. "de").
+PromptRecord = namedtuple('PromptRecord', ['split', 'occupation', 'language', 'prompt'])
+
+
+def split_name(split, dataset=None):
+    """
+    Return the short name of a split of a dataset, e.g. "direct" for "magbig_occupations_direct". Without a dataset,
+    the prefix of any dataset is removed.
+    """
+    if dataset:
+        name = split[len(dataset):].lstrip('_') if split.startswith(dataset) else split
+    else:
+        name = split.split('_occupations_', 1)[1] if '_occupations_' in split else split
+    return name[len('occupations_'):] if name.startswith('occupations_') else name
+
+
+class PromptSource:
+    """
+    Lazy access to the prompt files of a directory without pandas.
+
+    Prompt files are only read when their records are requested. A parsed file is cached in memory and, if
+    `cache_dir` is set, on disk under the SHA-256 hash of its content, so an edited prompt file is parsed again and an
+    unchanged one never is.
+
+    Args:
+        prompts_dir (str): The directory containing the prompt files. All prompt files are `.csv` files with an
+            "occupation" column and one column per language code.
+        cache_dir (str): Optional directory to cache parsed prompt files in.
+    """
+
+    def __init__(self, prompts_dir=PROMPTS_DIR, cache_dir=None):
+        self.prompts_dir = prompts_dir
+        self.cache_dir = cache_dir
+        self.parsed = {}
+
+    def splits(self, dataset=None, splits=None):
+        """
+        Return the splits of the prompt files, in sorted order.
+
+        Args:
+            dataset (str or list): Only splits of prompt files starting with this prefix (e.g. "magbig") or with one
+                of these prefixes (e.g. ["magbig", "bafis"]). If None, the splits of all prompt files are used.
+            splits (list): Only these splits. A split matches exactly, either by its file name or by its short name
+                (e.g. "direct" matches "magbig_occupations_direct", but not "magbig_occupations_direct_feminine").
+                Without a dataset, a short name matches the split of every dataset.
+        """
+        names = sorted(os.path.splitext(file)[0] for file in os.listdir(self.prompts_dir) if file.endswith('.csv'))
+        datasets = [dataset] if isinstance(dataset, str) else dataset or []
+        if datasets:
+            names = [name for name in names if any(name.startswith(prefix) for prefix in datasets)]
+        if splits:
+            names = [name for name in names if name in splits or split_name(
+                name, next((prefix for prefix in datasets if name.startswith(prefix)), None)) in splits]
+        return names
+
+    def read(self, split):
+        """
+        Return the parsed prompt file of a split.
+
+        Returns:
+            dict: The language codes of the file under "languages" and its rows of [occupation, prompt, ...] under
+                "rows".
+        """
+        if split in self.parsed:
+            return self.parsed[split]
+
+        with open(os.path.join(self.prompts_dir, f"{split}.csv"), 'rb') as f:
+            content = f.read()
+
+        cache_file = None
+        if self.cache_dir:
+            cache_file = os.path.join(self.cache_dir, hashlib.sha256(content).hexdigest() + '.json')
+            if os.path.exists(cache_file):
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    self.parsed[split] = json.load(f)
+                return self.parsed[split]
+
+        reader = csv.reader(io.StringIO(content.decode('utf-8-sig')))
+        header = next(reader)
+        occupation_column = header.index('occupation')
+        columns = [occupation_column] + [i for i in range(len(header)) if i != occupation_column]
+        parsed = {
+            'languages': [header[i] for i in columns[1:]],
+            'rows': [[row[i] if i < len(row) else '' for i in columns] for row in reader if row],
+        }
+
+        if cache_file:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_file = cache_file + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(parsed, f, ensure_ascii=False)
+            os.replace(temp_file, cache_file)
+
+        self.parsed[split] = parsed
+        return parsed
+
+    def records(self, dataset=None, splits=None, languages=None, sample=None, seed=None):
+        """
+        Stream the prompts of the prompt files, ordered by language, split and row, or by split, language and row if
+        no languages are given.
+
+        Args:
+            dataset (str or list): Only prompt files starting with this prefix or one of these prefixes (see `splits`).
+            splits (list): Only these splits (see `splits`).
+            languages (list): Only these language codes (e.g. ["de", "en"]). Splits which are not available in a
+                language (e.g. "direct_feminine" in English) are skipped. If None, all languages are used.
+            sample (float): Only a random fraction of the rows of every prompt file, e.g. 0.01 for a test run.
+            seed (int): Random seed of the sample.
+
+        Yields:
+            PromptRecord: The prompts with a non-empty text.
+        """
+        split_names = self.splits(dataset, splits)
+        if languages is None:
+            units = [(language, split) for split in split_names for language in self.read(split)['languages']]
+        else:
+            units = [(language, split) for language in languages for split in split_names]
+
+        for language, split in units:
+            parsed = self.read(split)
+            if language not in parsed['languages']:
+                # Not every split exists in every language, e.g. "direct_feminine" in English
+                logger.debug(f"Language {language} not found in {split}")
+                continue
+            column = parsed['languages'].index(language) + 1
+
+            rows = parsed['rows']
+            if sample is not None:
+                rng = random.Random(seed)
+                rows = [rows[i] for i in sorted(rng.sample(range(len(rows)), max(1, round(len(rows) * sample))))]
+
+            for row in rows:
+                if row[column]:
+                    yield PromptRecord(split, row[0], language, row[column])
@@ -0,0 +1,38 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Asynchronous token bucket which limits the rate of operations per minute.
+
+    Tokens are refilled continuously at `rate_per_minute / 60` tokens per second, up to `capacity` tokens. With the
+    default capacity of one token, operations are evenly spaced instead of being sent in bursts.
+    """
+
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens=1):
+        """ Wait until the given number of tokens is available and take them. """
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def drain(self):
+        """ Remove all tokens, e.g. after the server reported a rate limit error. """
+        self._refill()
+        self.tokens = 0
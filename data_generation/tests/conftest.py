@@ -0,0 +1,55 @@
+import io
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+# The modules of data_generation are run as scripts and import each other by module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def png_bytes(color=(120, 80, 40), size=(8, 8)):
+    """ Return a small PNG image. """
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Request handler of the stub server, which answers with the responses of the server's `respond` function. """
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.requests.append((self.command, self.path, body))
+        status, content_type, content = self.server.respond(self.command, self.path, body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = _dispatch
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Start a local HTTP server on a free port. Assign `server.respond(method, path, body)` to return a
+    (status, content type, content) tuple; `server.requests` records all requests.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    server.respond = lambda method, path, body: (200, 'image/png', png_bytes())
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,94 @@
+import asyncio
+import importlib
+import json
+import os
+import time
+
+import pytest
+
+from jobs import PromptJob
+from manifest import CompletionManifest
+from metrics import metrics
+from rate_limit import TokenBucket
+
+
+def test_token_bucket_spaces_operations():
+    async def acquire_all():
+        bucket = TokenBucket(rate_per_minute=600)
+        times = []
+        for _ in range(4):
+            await bucket.acquire()
+            times.append(time.monotonic())
+        return times
+
+    times = asyncio.run(acquire_all())
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    # 600 per minute are 10 per second, so operations are 0.1s apart after the first
+    assert all(0.08 <= gap <= 0.2 for gap in gaps)
+
+
+def test_token_bucket_capacity_allows_bursts():
+    async def burst():
+        bucket = TokenBucket(rate_per_minute=60, capacity=3)
+        start = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(burst()) < 0.05
+
+
+def test_token_bucket_drain_pauses_operations():
+    async def drain_and_acquire():
+        bucket = TokenBucket(rate_per_minute=300, capacity=5)
+        bucket.drain()
+        start = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - start
+
+    assert 0.15 <= asyncio.run(drain_and_acquire()) <= 0.4
+
+
+@pytest.fixture
+def dall_e(stub_server, tmp_path, monkeypatch):
+    """ Import the DALL-E backend with its API clients pointed at the stub server. """
+    (tmp_path / 'logs').mkdir()
+    (tmp_path / 'run').mkdir()
+    # The module logs to ../logs
+    monkeypatch.chdir(tmp_path / 'run')
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    monkeypatch.setenv('OPENAI_BASE_URL', f"{stub_server.url}/v1")
+    import dall_e
+
+    return importlib.reload(dall_e)
+
+
+def test_generate_images_async_retries_rate_limited_requests(dall_e, stub_server, tmp_path):
+    generations = []
+    serve_image = stub_server.respond
+
+    def respond(method, path, body):
+        if path.endswith('/images/generations'):
+            generations.append(json.loads(body)['prompt'])
+            if len(generations) == 1:
+                error = {'error': {'message': 'Rate limit exceeded', 'type': 'requests', 'code': 'rate_limit_exceeded'}}
+                return 429, 'application/json', json.dumps(error).encode()
+            data = {'created': 0, 'data': [{'url': f"{stub_server.url}/images/{len(generations)}.png"}]}
+            return 200, 'application/json', json.dumps(data).encode()
+        return serve_image(method, path, body)
+
+    stub_server.respond = respond
+    jobs = [PromptJob('magbig_occupations_direct', 'en', 'accountant', 'A photo of the face of an accountant.', (0, 1))]
+    backend = {'concurrency': 2, 'requests_per_minute': 6000, 'images_per_minute': 6000, 'folder': 'dall-e-3'}
+    image_dir = str(tmp_path / 'images')
+    manifest = CompletionManifest(str(tmp_path / 'images' / '.manifest.jsonl'))
+
+    metrics.start()
+    asyncio.run(dall_e.generate_images_async(jobs, 'dall-e-3', backend, image_dir, manifest))
+
+    assert len(generations) == 3
+    assert metrics.counters.get('api_retries') == 1
+    assert len(manifest) == 2
+    directory = os.path.join(image_dir, 'accountant', 'dall-e-3', 'magbig_occupations_direct', 'en')
+    assert sorted(os.listdir(directory)) == ['A_photo_of_the_face_of_an_accountant_1.png',
+                                             'A_photo_of_the_face_of_an_accountant_2.png']
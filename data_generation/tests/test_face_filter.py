@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from face_filter import filter_faces
+
+
+def make_dataset(source_dir):
+    """ Create a textured image (counted as a face by the stub detector), a flat image and an unreadable file. """
+    directory = os.path.join(source_dir, 'doctor', 'model', 'direct', 'en')
+    os.makedirs(directory)
+    noise = np.random.default_rng(0).integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+    Image.fromarray(noise).save(os.path.join(directory, '0.png'))
+    Image.new('RGB', (32, 32), (128, 128, 128)).save(os.path.join(directory, '1.png'))
+    with open(os.path.join(directory, '2.png'), 'wb') as f:
+        f.write(b'not a png')
+    return directory
+
+
+def test_filter_faces_keeps_images_with_faces(tmp_path):
+    source_dir, target_dir = str(tmp_path / 'images'), str(tmp_path / 'images_filtered')
+    make_dataset(source_dir)
+    kwargs = dict(detector_type='stub', cache_file=str(tmp_path / 'cache' / 'faces.jsonl'), max_workers=1,
+                  link_mode='copy')
+
+    counts = filter_faces(source_dir, target_dir, **kwargs)
+
+    assert counts == {'kept': 1, 'dropped': 1, 'unreadable': 1, 'scanned': 3}
+    kept = [os.path.relpath(os.path.join(root, file), target_dir)
+            for root, _, files in os.walk(target_dir) for file in files]
+    assert kept == [os.path.join('doctor', 'model', 'direct', 'en', '0.png')]
+
+
+def test_filter_faces_reuses_cached_detections(tmp_path):
+    source_dir = str(tmp_path / 'images')
+    make_dataset(source_dir)
+    kwargs = dict(detector_type='stub', cache_file=str(tmp_path / 'faces.jsonl'), max_workers=1, link_mode='copy')
+    filter_faces(source_dir, str(tmp_path / 'first'), **kwargs)
+
+    counts = filter_faces(source_dir, str(tmp_path / 'second'), **kwargs)
+
+    # Only the unreadable file has no cached result and is scanned again
+    assert counts['scanned'] == 1
+    assert (counts['kept'], counts['dropped']) == (1, 1)
+    assert os.path.exists(tmp_path / 'second' / 'doctor' / 'model' / 'direct' / 'en' / '0.png')
+
+
+def test_filter_faces_scans_again_with_other_detector_settings(tmp_path):
+    source_dir = str(tmp_path / 'images')
+    make_dataset(source_dir)
+    kwargs = dict(detector_type='stub', cache_file=str(tmp_path / 'faces.jsonl'), max_workers=1, link_mode='copy')
+    filter_faces(source_dir, str(tmp_path / 'first'), **kwargs)
+
+    # No image is textured enough to count as a face with this threshold
+    counts = filter_faces(source_dir, str(tmp_path / 'second'), detector_options={'min_std': 1000}, **kwargs)
+
+    assert counts == {'kept': 0, 'dropped': 2, 'unreadable': 1, 'scanned': 3}
@@ -0,0 +1,36 @@
+import os
+
+from PIL import Image
+
+from manifest import CompletionManifest
+
+
+def save_image(path, image_format='PNG'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', (16, 16), (200, 100, 50)).save(path, image_format)
+
+
+def test_add_existing_indexes_complete_images(tmp_path):
+    directory = tmp_path / 'doctor' / 'sd' / 'direct' / 'en'
+    save_image(str(directory / 'A_photo_of_a_doctor_1.png'))
+    save_image(str(directory / 'A_photo_of_a_doctor_3.webp'), 'WEBP')
+    (directory / 'A_photo_of_a_doctor_2.png').write_bytes(b'')
+    (directory / 'A_photo_of_a_doctor_4.png').write_bytes(b'\x89PNG\r\n\x1a\n truncated')
+    save_image(str(directory / 'A_photo_of_a_doctor_5.png.tmp'))
+
+    manifest = CompletionManifest(str(tmp_path / 'manifest.jsonl'))
+
+    assert manifest.add_existing(str(tmp_path), 'sd') == 2
+    assert manifest.completed == {('sd', 'direct', 'en', 'doctor', 0), ('sd', 'direct', 'en', 'doctor', 2)}
+
+
+def test_add_existing_maps_legacy_dall_e_names(tmp_path):
+    directory = tmp_path / 'doctor' / 'dall-e-3' / 'direct' / 'en'
+    save_image(str(directory / 'A_photo_of_a_doctor.png'))
+    save_image(str(directory / 'A_photo_of_a_doctor_1718000000.png'))
+    save_image(str(directory / 'A_photo_of_a_doctor_1718000042.png'))
+
+    manifest = CompletionManifest(str(tmp_path / 'manifest.jsonl'))
+
+    assert manifest.add_existing(str(tmp_path), 'dall-e-3') == 3
+    assert manifest.completed == {('dall-e-3', 'direct', 'en', 'doctor', index) for index in range(3)}
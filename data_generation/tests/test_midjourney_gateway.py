@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+
+import pytest
+
+from midjourney_gateway import DISPATCH, HELLO, IDENTIFY, RECONNECT, GatewayListener
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class WebSocketConnection:
+    """ Server side of a websocket connection with unfragmented text frames, enough to stand in for the gateway. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        request = b''
+        while b'\r\n\r\n' not in request:
+            request += sock.recv(4096)
+        headers = dict(line.split(': ', 1) for line in request.decode().split('\r\n')[1:] if ': ' in line)
+        accept = base64.b64encode(hashlib.sha1((headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode()).digest())
+        sock.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+
+    def _read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Client closed the connection")
+            data += chunk
+        return data
+
+    def send(self, payload):
+        data = json.dumps(payload).encode()
+        if len(data) < 126:
+            header = struct.pack('!BB', 0x81, len(data))
+        else:
+            header = struct.pack('!BBH', 0x81, 126, len(data))
+        self.sock.sendall(header + data)
+
+    def receive(self):
+        """ Return the next JSON payload sent by the client, or None when the client closes the connection. """
+        first, second = self._read(2)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        mask = self._read(4)
+        data = bytes(byte ^ mask[i % 4] for i, byte in enumerate(self._read(length)))
+        if first & 0x0f == 0x8:
+            return None
+        return json.loads(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeGateway:
+    """
+    Local stand-in for the Discord gateway. Every connection gets HELLO, must IDENTIFY and then gets READY, followed
+    by the events of `script`, a list of payloads per connection.
+    """
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.identified = []
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.url = f"ws://127.0.0.1:{self.server.getsockname()[1]}"
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def serve(self):
+        for events in self.script:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            connection = WebSocketConnection(sock)
+            connection.send({'op': HELLO, 'd': {'heartbeat_interval': 45000}})
+            self.identified.append(connection.receive())
+            connection.send({'op': DISPATCH, 's': 1, 't': 'READY', 'd': {}})
+            for event in events:
+                connection.send(event)
+            if events and events[-1].get('op') == RECONNECT:
+                connection.close()
+                continue
+            # Keep the connection open until the client closes it
+            try:
+                while connection.receive() is not None:
+                    pass
+            except (ConnectionError, OSError):
+                pass
+            connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.close()
+
+
+def message_event(sequence, message_id, channel_id, content, event='MESSAGE_CREATE'):
+    return {'op': DISPATCH, 's': sequence, 't': event,
+            'd': {'id': message_id, 'channel_id': channel_id, 'content': content}}
+
+
+@pytest.fixture
+def listener():
+    listeners = []
+
+    def start(url):
+        listeners.append(GatewayListener('token', '42', url=url).start())
+        return listeners[-1]
+
+    yield start
+    for started in listeners:
+        started.stop()
+
+
+def receive(listener, count, timeout=5):
+    messages = []
+    for _ in range(20):
+        messages.extend(listener.get_messages(timeout=timeout / 20))
+        if len(messages) >= count:
+            break
+    return messages
+
+
+def test_listener_receives_messages_of_its_channel(listener):
+    events = [
+        message_event(2, '1', '7', "**another channel** - <@1> (fast)"),
+        message_event(3, '2', '42', "**A photo --v 6.1** - <@1> (fast)"),
+        message_event(4, '2', '42', "**A photo --v 6.1** - <@1> (fast)", event='MESSAGE_UPDATE'),
+    ]
+    with FakeGateway([events]) as gateway:
+        gateway_listener = listener(gateway.url)
+        assert gateway_listener.connected.wait(5)
+        messages = receive(gateway_listener, 2)
+
+    assert [message['id'] for message in messages] == ['2', '2']
+    assert gateway.identified[0]['op'] == IDENTIFY
+    assert gateway.identified[0]['d']['token'] == 'token'
+    assert gateway_listener.sequence == 4
+
+
+def test_listener_reconnects_when_requested(listener):
+    script = [
+        [message_event(2, '1', '42', "**first connection** - <@1> (fast)"), {'op': RECONNECT, 'd': None}],
+        [message_event(2, '2', '42', "**second connection** - <@1> (fast)")],
+    ]
+    with FakeGateway(script) as gateway:
+        gateway_listener = listener(gateway.url)
+        messages = receive(gateway_listener, 2, timeout=10)
+
+    assert [message['id'] for message in messages] == ['1', '2']
+    assert len(gateway.identified) == 2
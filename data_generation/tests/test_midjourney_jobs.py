@@ -0,0 +1,157 @@
+import importlib
+import itertools
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import midjourney_jobs
+from conftest import png_bytes
+from jobs import PromptJob
+from midjourney_jobs import DONE, FAILED, MidjourneyPipeline, message_prompt, normalize_prompt, snowflake
+
+
+class FakeDiscord:
+    """
+    Fake of the Discord API with the Midjourney bot, served by the stub server. Like the bot, it echoes prompts in
+    bold with the parameters it appends, a mention and the speed, and only the interaction response carries the nonce.
+
+    Args:
+        url (str): The base URL of the stub server, which also serves the upscaled images.
+        fail_prompts (dict): The number of failed imagine requests by prompt, before it succeeds.
+        fail_upscales (int): The number of failed upscale requests, before they succeed.
+    """
+
+    def __init__(self, url, fail_prompts=None, fail_upscales=0):
+        self.url = url
+        self.fail_prompts = dict(fail_prompts or {})
+        self.fail_upscales = fail_upscales
+        self.messages = []
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+
+    def post(self, content, **fields):
+        message = {'id': str(snowflake(time.time()) + next(self.sequence)), 'content': content,
+                   'components': [], 'attachments': [], **fields}
+        self.messages.append(message)
+        return message
+
+    def imagine(self, interaction):
+        prompt = interaction['data']['options'][0]['value']
+        if self.fail_prompts.get(prompt):
+            self.fail_prompts[prompt] -= 1
+            return 503, 'application/json', b'{"message": "Service unavailable"}'
+        # A message of another user's job in the same channel
+        self.post("**A photo of a cat --v 6.1** - <@999> (fast)")
+        buttons = [{'type': 2, 'label': label, 'custom_id': f"MJ::JOB::upsample::{i + 1}::{interaction['nonce']}"}
+                   for i, label in enumerate(['U1', 'U2', 'U3', 'U4'])]
+        self.post(f"**{prompt} --v 6.1** - <@1234> (fast)", components=[{'type': 1, 'components': buttons}])
+        return 204, 'application/json', b''
+
+    def upscale(self, interaction):
+        if self.fail_upscales:
+            self.fail_upscales -= 1
+            return 429, 'application/json', b'{"message": "You are being rate limited.", "retry_after": 0.1}'
+        message_id = interaction['message_id']
+        grid = next(message for message in self.messages if message['id'] == message_id)
+        number = interaction['data']['custom_id'].split("::")[3]
+        self.post(f"{grid['content'].split(' - ')[0]} - Image #{number} <@1234>",
+                  attachments=[{'url': f"{self.url}/attachments/{message_id}/{number}.png"}],
+                  message_reference={'message_id': message_id})
+        return 204, 'application/json', b''
+
+    def respond(self, method, path, body):
+        with self.lock:
+            if method == 'POST' and path == '/api/v9/interactions':
+                interaction = json.loads(body)
+                return self.imagine(interaction) if interaction['type'] == 2 else self.upscale(interaction)
+            if method == 'GET' and path.startswith('/api/v9/channels/42/messages'):
+                limit = int(parse_qs(urlparse(path).query)['limit'][0])
+                return 200, 'application/json', json.dumps(list(reversed(self.messages[-limit:]))).encode()
+            if method == 'GET' and path.startswith('/attachments/'):
+                return 200, 'image/png', png_bytes()
+            return 404, 'application/json', b'{"message": "Unknown"}'
+
+
+@pytest.fixture
+def api(stub_server, tmp_path, monkeypatch):
+    """ Return a MidjourneyAPI pointed at the stub server. """
+    (tmp_path / 'logs').mkdir()
+    (tmp_path / 'run').mkdir()
+    # The module logs to ../logs
+    monkeypatch.chdir(tmp_path / 'run')
+    monkeypatch.setenv('MIDJOURNEY_API_BASE', f"{stub_server.url}/api/v9")
+    monkeypatch.setenv('MIDJOURNEY_AUTH', 'token')
+    monkeypatch.setenv('MIDJOURNEY_CHANNEL_ID', '42')
+    return importlib.import_module('midjourney_api').MidjourneyAPI()
+
+
+def test_message_prompt_removes_parameters_and_decoration():
+    prompt = normalize_prompt("A photo of the face of an accountant.")
+    assert message_prompt({'content': "**A photo of the face of an  accountant. --v 6.1** - <@1234> (fast)"}) == prompt
+    assert message_prompt({'content': "**A photo of the face of an accountant. --ar 1:1 --no text** - Image #2 "
+                                      "<@!1234>"}) == prompt
+    assert message_prompt({'content': "no prompt"}) is None
+
+
+@pytest.fixture
+def pipeline_jobs():
+    return [PromptJob('magbig_occupations_direct', 'en', occupation, f"A photo of the face of a {occupation}.", (0, 2))
+            for occupation in ['baker', 'pilot', 'nurse']]
+
+
+def run_pipeline(api, jobs, image_dir):
+    finished = []
+    pipeline = MidjourneyPipeline(api, {'folder': 'midjourney-v6-1'}, image_dir, finished.append, max_concurrent=2,
+                                  poll_interval=0.01, timeout=10)
+    pipeline.run(jobs)
+    return finished
+
+
+def test_pipeline_matches_echoed_prompts_with_parameters(stub_server, api, pipeline_jobs, tmp_path):
+    discord = FakeDiscord(stub_server.url)
+    stub_server.respond = discord.respond
+    finished = run_pipeline(api, pipeline_jobs, str(tmp_path))
+
+    assert sorted(job.job.occupation for job in finished) == ['baker', 'nurse', 'pilot']
+    assert all(job.state == DONE for job in finished)
+    for job in finished:
+        directory = os.path.join(tmp_path, job.job.occupation, 'midjourney-v6-1', job.job.split, job.job.lang)
+        assert len(os.listdir(directory)) == 2
+    # Only the requested images were upscaled
+    assert sum('Image #' in message['content'] for message in discord.messages) == 6
+    interactions = [json.loads(body) for method, path, body in stub_server.requests if path.endswith('/interactions')]
+    assert [interaction['type'] for interaction in interactions].count(3) == 6
+
+
+def test_pipeline_retries_failed_submissions(stub_server, api, pipeline_jobs, tmp_path, monkeypatch):
+    monkeypatch.setattr(midjourney_jobs, 'SUBMIT_RETRY_DELAY', 0)
+    failures = {pipeline_jobs[0].prompt: 1, pipeline_jobs[1].prompt: midjourney_jobs.MAX_SUBMIT_ATTEMPTS}
+    stub_server.respond = FakeDiscord(stub_server.url, fail_prompts=failures).respond
+    finished = {job.job.occupation: job for job in run_pipeline(api, pipeline_jobs, str(tmp_path))}
+
+    assert finished['baker'].state == DONE
+    assert finished['baker'].attempts == 2
+    assert finished['pilot'].state == FAILED
+    assert finished['nurse'].state == DONE
+
+
+def test_pipeline_retries_failed_upscales(stub_server, api, pipeline_jobs, tmp_path):
+    stub_server.respond = FakeDiscord(stub_server.url, fail_upscales=1).respond
+    finished = run_pipeline(api, pipeline_jobs[:1], str(tmp_path))
+
+    assert finished[0].state == DONE
+    assert finished[0].upscale_attempts == 1
+
+
+def test_pipeline_fails_jobs_whose_upscales_keep_failing(stub_server, api, pipeline_jobs, tmp_path):
+    stub_server.respond = FakeDiscord(stub_server.url, fail_upscales=midjourney_jobs.MAX_UPSCALE_ATTEMPTS).respond
+    start = time.time()
+    finished = run_pipeline(api, pipeline_jobs[:1], str(tmp_path))
+
+    assert finished[0].state == FAILED
+    # The job fails right away instead of waiting for the timeout
+    assert time.time() - start < 5
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from metadata_store import MetadataStore
+
+
+def store_path(dataset_dir, size):
+    """ Return the path of the thumbnail store of a dataset for a thumbnail size. """
+    return os.path.join(dataset_dir, f"thumbnails_{size}.npy")
+
+
+def letterbox(img, size):
+    """ Scale an image to fit into size x size pixels and pad it with black borders to exactly that size. """
+    img = img.convert('RGB')
+    img.thumbnail((size, size))
+    canvas = Image.new('RGB', (size, size))
+    canvas.paste(img, ((size - img.width) // 2, (size - img.height) // 2))
+    return np.asarray(canvas)
+
+
+def fill_thumbnails(path, dataset_dir, start, stop):
+    """
+    Write the thumbnails of the images with ids from start to stop into the store. Runs in a worker process, which
+    writes into its own memory map of the store, so no image data is sent between processes.
+
+    Returns:
+        list: The ids of the images which could not be read.
+    """
+    thumbnails = np.load(path, mmap_mode='r+')
+    size = thumbnails.shape[1]
+    failed = []
+    for image_id in range(start, stop):
+        try:
+            with Image.open(os.path.join(dataset_dir, f"{image_id}.png")) as img:
+                thumbnails[image_id] = letterbox(img, size)
+        except Exception as e:
+            print(f"Error reading image {image_id}: {e}")
+            failed.append(image_id)
+    thumbnails.flush()
+    return failed
+
+
+def build_thumbnail_store(dataset_dir, size=128, metadata_file='metadata.json', max_workers=None, chunk_size=256):
+    """
+    Pack the thumbnails of all images of an enumerated dataset into one memory-mappable array of shape
+    (N, size, size, 3) with dtype uint8. Row i holds the letterboxed thumbnail of image i, so the rows are ordered like
+    the metadata. Images which cannot be read are left black.
+
+    Args:
+        dataset_dir (str): The directory of the enumerated dataset (see `generate_dataset.enumerate_dataset`).
+        size (int): The width and height of the thumbnails in pixels.
+        metadata_file (str): Name of the JSON file containing the metadata of the dataset.
+        max_workers (int): The number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): The number of images per task.
+
+    Returns:
+        str: The path of the store.
+    """
+    start_time = time.perf_counter()
+    with open(os.path.join(dataset_dir, metadata_file), 'r', encoding='utf-8') as f:
+        num_images = len(json.load(f))
+
+    path = store_path(dataset_dir, size)
+    temp_path = path + '.tmp'
+    thumbnails = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=(num_images, size, size, 3))
+    del thumbnails
+
+    chunks = [(start, min(start + chunk_size, num_images)) for start in range(0, num_images, chunk_size)]
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fill_thumbnails, temp_path, dataset_dir, start, stop) for start, stop in chunks]
+        for future in futures:
+            failed.extend(future.result())
+    os.replace(temp_path, path)
+
+    print(f"Packed {num_images} thumbnails ({num_images * size * size * 3 / 1e6:.1f} MB) into {path} "
+          f"in {time.perf_counter() - start_time:.1f}s, {len(failed)} failed")
+    return path
+
+
+class ThumbnailStore:
+    """
+    Read-only access to the thumbnail store of a dataset. The store is memory mapped, so only the thumbnails which are
+    actually accessed are read from disk, and they are shared with the page cache of other processes.
+
+    Args:
+        dataset_dir (str): The directory of the enumerated dataset.
+        size (int): The thumbnail size of the store.
+    """
+
+    def __init__(self, dataset_dir, size=128):
+        self.dataset_dir = dataset_dir
+        self.thumbnails = np.load(store_path(dataset_dir, size), mmap_mode='r')
+        self._metadata = None
+
+    def __len__(self):
+        return len(self.thumbnails)
+
+    def __getitem__(self, index):
+        """ Return the thumbnails of an image id or a slice of ids. Slices are views without a copy. """
+        return self.thumbnails[index]
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = MetadataStore(self.dataset_dir)
+        return self._metadata
+
+    def select(self, **filters):
+        """
+        Return the thumbnails of all images matching metadata filters (see `MetadataStore.query`).
+
+        The enumeration numbers images in sorted order of occupation, model, prompt group and language (see
+        `generate_dataset.enumerate_dataset`), so most filters select a contiguous range of ids, which is returned as a
+        view without a copy. Other selections are gathered into a new array.
+
+        Returns:
+            tuple: The image ids and their thumbnails.
+        """
+        ids = self.metadata.query(**filters)
+        if len(ids) and ids[-1] - ids[0] + 1 == len(ids):
+            return ids, self.thumbnails[ids[0]:ids[-1] + 1]
+        return ids, self.thumbnails[ids]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack the thumbnails of a dataset into a memory-mapped array')
+    parser.add_argument('--dataset_directory', default='../images_dataset', type=str,
+                        help='Path to the directory containing the enumerated dataset')
+    parser.add_argument('--size', default=128, type=int,
+                        help='Width and height of the thumbnails in pixels')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of worker processes (default: number of CPUs)')
+
+    args = parser.parse_args()
+
+    build_thumbnail_store(args.dataset_directory, size=args.size, max_workers=args.workers)